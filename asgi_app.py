@@ -0,0 +1,600 @@
+# 非同步 (ASGI) 入口：/callback 由 asyncio 處理，所有對外呼叫共用同一個 aiohttp 連線池。
+# 啟動方式：uvicorn asgi_app:application --host 0.0.0.0 --port $PORT
+# 原本的 Flask `app` 仍可用 gunicorn app:app 啟動；其餘路由 (靜態音檔、管理頁面) 在這裡也會轉交給 Flask 處理。
+import asyncio
+import base64
+import contextvars
+import functools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from a2wsgi import WSGIMiddleware
+from linebot import WebhookParser
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, ImageMessage, StickerMessage, AudioMessage, TextSendMessage
+
+import app as sync_app
+import circuit_breaker
+import hedging
+import metrics
+import payload_codec
+import prompt_cache
+import timeouts
+import token_budget
+import tracing
+from app import (
+    LINE_CHANNEL_ACCESS_TOKEN, LINE_CHANNEL_SECRET, GEMINI_API_KEY, PEXELS_API_KEY, UNSPLASH_ACCESS_KEY,
+    CHAT_FALLBACK_RESPONSES, MAX_CANDIDATE_IMAGE_BYTES,
+    _extract_gemini_text, _clean_trailing_symbols, _image_relevance_from_result, _quick_replies_from_result,
+    build_image_relevance_payload, build_pexels_search_request, build_unsplash_search_request,
+    build_quick_reply_payload, build_reply_messages, attach_quick_replies, load_reply_objects, first_image_theme,
+    inline_quick_replies, with_inline_quick_replies_instruction,
+    build_chat_user_message, build_image_user_parts, build_sticker_user_parts, build_audio_user_parts,
+    is_special_text_command, get_conversation_history, add_to_conversation, TimedSignatureValidator,
+)
+
+logger = logging.getLogger(__name__)
+
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", "2000"))
+ASYNC_MAX_INFLIGHT_EVENTS = int(os.getenv("ASYNC_MAX_INFLIGHT_EVENTS", "5000"))
+ASYNC_SYNC_FALLBACK_THREADS = int(os.getenv("ASYNC_SYNC_FALLBACK_THREADS", "16"))
+ASYNC_STATE_THREADS = int(os.getenv("ASYNC_STATE_THREADS", "8"))
+
+parser = WebhookParser(LINE_CHANNEL_SECRET)
+parser.signature_validator = TimedSignatureValidator(parser.signature_validator)
+flask_fallback = WSGIMiddleware(sync_app.app)
+
+_http_session: aiohttp.ClientSession | None = None
+# 說明：目前已建立、還沒處理完的事件數 (只在事件迴圈裡讀寫，不必加鎖)
+_inflight_events = 0
+_inflight_tasks: set[asyncio.Task] = set()
+# 說明：Rich Menu 模板、情境選項、秘密請求等較少用的分支仍沿用同步實作，放在有上限的執行緒池裡跑，避免阻塞事件迴圈。
+_sync_fallback_executor = ThreadPoolExecutor(max_workers=ASYNC_SYNC_FALLBACK_THREADS, thread_name_prefix="sync-fallback")
+# 說明：讀寫用戶狀態要拿 app.user_state_lock (SQLite 後端還會讀 DB)，放在專用的小執行緒池裡做，事件迴圈不等鎖也不等 DB；
+# 跟上面的池分開，才不會排在慢的同步分支後面。
+_state_executor = ThreadPoolExecutor(max_workers=ASYNC_STATE_THREADS, thread_name_prefix="user-state")
+
+EVENTS_REJECTED = metrics.REGISTRY.counter(
+    "xiaoyun_events_rejected_total", "進行中的事件已達 ASYNC_MAX_INFLIGHT_EVENTS 而直接丟棄的 Webhook 事件數", ("message_type",))
+
+
+class UpstreamHTTPError(Exception):
+    def __init__(self, status: int, body: str, url: str):
+        super().__init__(f"HTTP {status} from {url.split('?')[0]}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=ASYNC_HTTP_MAX_CONNECTIONS, limit_per_host=0, ttl_dns_cache=300)
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+def _client_timeout(timeout) -> aiohttp.ClientTimeout:
+    # 說明：timeout 可以是秒數或 timeouts.TIMEOUTS 給的 (連線逾時, 讀取逾時)
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return aiohttp.ClientTimeout(total=connect + read, sock_connect=connect)
+    return aiohttp.ClientTimeout(total=timeout)
+
+
+async def _post_json(url: str, payload: dict, timeout, headers: dict | None = None) -> dict:
+    # 說明：本文由 payload_codec 編碼 (角色設定前綴預先編好)，在事件迴圈上的 CPU 時間比 aiohttp 的 json= 少
+    body = payload_codec.encode_body(payload)
+    async with get_http_session().post(url, data=body, headers=payload_codec.JSON_HEADERS | (headers or {}),
+                                       timeout=_client_timeout(timeout)) as response:
+        if response.status >= 400:
+            raise UpstreamHTTPError(response.status, await response.text(), url)
+        return payload_codec.loads(await response.read())
+
+
+async def _get_json(url: str, params: dict, headers: dict, timeout) -> dict:
+    async with get_http_session().get(url, params=params, headers=headers, timeout=_client_timeout(timeout)) as response:
+        if response.status >= 400:
+            raise UpstreamHTTPError(response.status, await response.text(), url)
+        return await response.json(content_type=None)
+
+
+async def gemini_generate_async(task: str, payload: dict, timeout: float | None = None) -> dict:
+    # 說明：與同步版 call_gemini 相同的生成設定、模型路由、退回主模型與自適應逾時的規則
+    timeout = timeout or timeouts.TIMEOUTS.read_timeout("gemini", task)
+    payload = sync_app.apply_generation_profile(task, payload)
+    with circuit_breaker.BREAKERS["gemini"].track():
+        models = sync_app.model_router.candidates(task)
+        for model in models[:-1]:
+            try:
+                return await _gemini_generate_hedged_async(task, model, payload, timeout)
+            except (UpstreamHTTPError, aiohttp.ClientConnectionError) as e:
+                reason = e.status if isinstance(e, UpstreamHTTPError) else type(e).__name__
+                logger.warning("Gemini %s 使用模型 %s 失敗 (%s)，改用 %s (async)。", task, model, reason, models[-1])
+                sync_app.model_router.record_fallback(task, "error")
+        return await _gemini_generate_hedged_async(task, models[-1], payload, timeout)
+
+
+async def _gemini_generate_hedged_async(task: str, model: str, payload: dict, timeout: float) -> dict:
+    started = time.perf_counter()
+    try:
+        return await hedging.run_hedged_async(sync_app.hedge_policy, task, functools.partial(_gemini_generate_model_async, task, model, payload), timeout)
+    finally:
+        sync_app.degradation_controller.observe(task, time.perf_counter() - started)
+
+
+async def _gemini_generate_model_async(task: str, model: str, payload: dict, timeout: float) -> dict:
+    gemini_url_with_key = f"{sync_app.gemini_url(model)}?key={GEMINI_API_KEY}"
+    # 說明：角色設定前綴快取與同步版共用；建立與延長 TTL 在快取自己的背景執行緒進行，不會卡住事件迴圈
+    send_payload, cache_name = sync_app.prompt_prefix_cache.prepare(model, payload)
+    status = "error"
+    started = time.perf_counter()
+    with tracing.span("gemini", task=task, model=model, prompt_cached=cache_name is not None) as trace_span:
+        try:
+            with metrics.INFLIGHT.labels("gemini").track_inprogress(), timeouts.TIMEOUTS.track("gemini", task, read=timeout) as request_timeout:
+                try:
+                    result = await _post_json(gemini_url_with_key, send_payload, request_timeout)
+                except UpstreamHTTPError as http_err:
+                    if not cache_name or http_err.status not in prompt_cache.INVALID_CACHE_STATUSES:
+                        raise
+                    sync_app.prompt_prefix_cache.invalidate(cache_name)
+                    cache_name = None
+                    result = await _post_json(gemini_url_with_key, payload, request_timeout)
+            status = "200"
+        except UpstreamHTTPError as http_err:
+            status = str(http_err.status)
+            raise
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.GEMINI_REQUEST_DURATION.labels(task).observe(elapsed)
+            metrics.GEMINI_REQUESTS.labels(task, status).inc()
+            sync_app.model_router.record(model, status, elapsed)
+            if trace_span:
+                trace_span.set(status=status)
+        metrics.record_gemini_usage(task, result)
+        metrics.record_generation_profile(task, sync_app.GENERATION_PROFILE_LABELS.get(task, "none"), elapsed, result)
+        sync_app.prompt_prefix_cache.record_usage(result)
+        if (token_usage := token_budget.ESTIMATOR.observe(task, payload, result)) and trace_span:
+            trace_span.set(estimated_prompt_tokens=token_usage[0], prompt_tokens=token_usage[1])
+    return result
+
+
+# --- 圖片搜尋與驗證 ---
+
+async def is_image_relevant_async(image_base64: str, english_theme_query: str, image_url_for_log: str, source_service: str) -> bool:
+    logger.info("開始使用 Gemini 判斷圖片相關性 (async, 來自 %s)。英文主題: '%s', 圖片URL (日誌用): %s", source_service, english_theme_query, image_url_for_log, extra={"payload": "image_candidates"})
+    try:
+        with metrics.observe_stage("image_validation"):
+            result = await gemini_generate_async("image_relevance", build_image_relevance_payload(image_base64, english_theme_query))
+        return _image_relevance_from_result(result, english_theme_query, image_url_for_log, source_service)
+    except UpstreamHTTPError as http_err:
+        if http_err.status == 429:
+            logger.warning("Gemini 圖片相關性判斷達到 API 頻率上限 (429)。")
+        else:
+            logger.error("Gemini 圖片相關性判斷 API 請求失敗 (來自 %s, 英文主題: %s): %s", source_service, english_theme_query, http_err)
+    except asyncio.TimeoutError:
+        logger.error("Gemini 圖片相關性判斷請求超時 (來自 %s, 英文主題: %s)", source_service, english_theme_query)
+    except Exception as e:
+        logger.error("Gemini 圖片相關性判斷時發生未知錯誤 (來自 %s, 英文主題: %s): %s", source_service, english_theme_query, e, exc_info=True)
+    return False
+
+
+async def _download_candidate_image(potential_image_url: str, source_service: str) -> bytes | None:
+    with circuit_breaker.BREAKERS[source_service.lower()].track(), timeouts.TIMEOUTS.track("image_download") as timeout:
+        async with get_http_session().get(potential_image_url, timeout=_client_timeout(timeout)) as image_response:
+            if image_response.status >= 400:
+                raise UpstreamHTTPError(image_response.status, "", potential_image_url)
+            content_length = image_response.headers.get("Content-Length")
+            if content_length and int(content_length) > MAX_CANDIDATE_IMAGE_BYTES:
+                logger.warning("%s 圖片 %s 過大 (%s bytes)，跳過驗證。", source_service, potential_image_url, content_length)
+                return None
+            image_bytes = await image_response.read()
+    if len(image_bytes) > MAX_CANDIDATE_IMAGE_BYTES:
+        logger.warning("%s 圖片 %s 下載後發現過大 (%s bytes)，跳過驗證。", source_service, potential_image_url, len(image_bytes))
+        return None
+    return image_bytes
+
+
+async def _first_relevant_candidate(candidates: list[tuple[str, str]], english_theme_query: str, max_candidates_to_check: int, source_service: str) -> str | None:
+    checked_count = 0
+    for potential_image_url, alt_description in candidates:
+        if checked_count >= max_candidates_to_check:
+            logger.info("已達到 %s Gemini 圖片檢查上限 (%s) for theme '%s'.", source_service, max_candidates_to_check, english_theme_query)
+            break
+        if not circuit_breaker.available(source_service.lower(), "gemini"):
+            logger.warning("%s 或 Gemini 的斷路器已打開，停止檢查剩下的 %s 圖片 (主題: '%s')。", source_service, source_service, english_theme_query)
+            break
+        logger.info("從 %s 獲取到待驗證圖片 URL: %s (Alt: %s) for theme '%s'", source_service, potential_image_url, alt_description, english_theme_query, extra={"payload": "image_candidates"})
+        try:
+            image_bytes = await _download_candidate_image(potential_image_url, source_service)
+            if image_bytes is None:
+                continue
+            image_base64 = base64.b64encode(image_bytes).decode("utf-8")
+            checked_count += 1
+            if await is_image_relevant_async(image_base64, english_theme_query, potential_image_url, source_service):
+                logger.info("Gemini 認為 %s 圖片 %s 與英文主題 '%s' 相關。", source_service, potential_image_url, english_theme_query, extra={"payload": "image_candidates"})
+                return potential_image_url
+            logger.info("Gemini 認為 %s 圖片 %s 與英文主題 '%s' 不相關。", source_service, potential_image_url, english_theme_query, extra={"payload": "image_candidates"})
+        except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamHTTPError, circuit_breaker.CircuitOpenError) as img_req_err:
+            logger.error("下載或處理 %s 圖片 %s 失敗: %s", source_service, potential_image_url, img_req_err)
+        except Exception as img_err:
+            logger.error("處理 %s 圖片 %s 時發生未知錯誤: %s", source_service, potential_image_url, img_err, exc_info=True)
+    logger.warning("遍歷了 %s 張 %s 圖片（實際檢查了 %s 張），未找到 Gemini 認為相關的圖片 for theme '%s'.", len(candidates), source_service, checked_count, english_theme_query)
+    return None
+
+
+async def fetch_image_from_pexels_async(english_theme_query: str, pexels_per_page: int, max_candidates_to_check: int) -> str | None:
+    api_url_search, params_search, headers = build_pexels_search_request(english_theme_query, pexels_per_page)
+    try:
+        with metrics.observe_stage("pexels_search"), circuit_breaker.BREAKERS["pexels"].track(), timeouts.TIMEOUTS.track("pexels_search") as timeout:
+            data_search = await _get_json(api_url_search, params_search, headers, timeout=timeout)
+    except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamHTTPError, circuit_breaker.CircuitOpenError) as e:
+        logger.error("Pexels API 搜尋請求失敗 (搜尋: '%s'): %s", english_theme_query, e)
+        return None
+    if not (data_search and data_search.get("photos")):
+        logger.warning("Pexels 搜尋 '%s' 無結果或格式錯誤。 Response: %s", english_theme_query, data_search)
+        return None
+    candidates = [(url, image_data.get("alt", "N/A")) for image_data in data_search["photos"]
+                  if (url := image_data.get("src", {}).get("large"))]
+    return await _first_relevant_candidate(candidates, english_theme_query, max_candidates_to_check, "Pexels")
+
+
+async def fetch_image_from_unsplash_async(english_theme_query: str, unsplash_per_page: int, max_candidates_to_check: int) -> str | None:
+    api_url_search, params_search, headers = build_unsplash_search_request(english_theme_query, unsplash_per_page)
+    try:
+        with metrics.observe_stage("unsplash_search"), circuit_breaker.BREAKERS["unsplash"].track(), timeouts.TIMEOUTS.track("unsplash_search") as timeout:
+            data_search = await _get_json(api_url_search, params_search, headers, timeout=timeout)
+    except (aiohttp.ClientError, asyncio.TimeoutError, UpstreamHTTPError, circuit_breaker.CircuitOpenError) as e:
+        logger.error("Unsplash API 搜尋請求失敗 (搜尋: '%s'): %s", english_theme_query, e)
+        return None
+    if not (data_search and data_search.get("results")):
+        logger.warning("Unsplash 搜尋 '%s' 無結果或格式錯誤。 Response: %s", english_theme_query, data_search)
+        return None
+    candidates = [(url, image_data.get("alt_description", "N/A")) for image_data in data_search["results"]
+                  if (url := image_data.get("urls", {}).get("regular"))]
+    return await _first_relevant_candidate(candidates, english_theme_query, max_candidates_to_check, "Unsplash")
+
+
+async def fetch_and_validate_image_async(english_theme_query: str) -> str | None:
+    logger.info("開始依優先順序搜尋圖片 (async)，主題: '%s'", english_theme_query)
+    if not circuit_breaker.available("gemini"):
+        logger.warning("Gemini 的斷路器已打開，跳過圖片搜尋 (主題: '%s')。", english_theme_query)
+        return None
+    if PEXELS_API_KEY and english_theme_query.strip() and circuit_breaker.available("pexels"):
+        if pexels_result_url := await fetch_image_from_pexels_async(english_theme_query, pexels_per_page=5, max_candidates_to_check=5):
+            return pexels_result_url
+    if UNSPLASH_ACCESS_KEY and english_theme_query.strip() and circuit_breaker.available("unsplash"):
+        if unsplash_result_url := await fetch_image_from_unsplash_async(english_theme_query, unsplash_per_page=3, max_candidates_to_check=3):
+            return unsplash_result_url
+    logger.warning("最終未能從 Pexels 或 Unsplash 找到與英文主題 '%s' 高度相關的圖片。", english_theme_query)
+    return None
+
+
+# --- LINE 相關 ---
+
+async def get_message_content_async(message_id: str) -> str | None:
+    url = f"{sync_app.LINE_DATA_API_ENDPOINT}/v2/bot/message/{message_id}/content"
+    headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"}
+    try:
+        with metrics.observe_stage("line_content_download"), timeouts.TIMEOUTS.track("line_content") as timeout:
+            async with get_http_session().get(url, headers=headers, timeout=_client_timeout(timeout)) as response:
+                if response.status >= 400:
+                    raise UpstreamHTTPError(response.status, await response.text(), url)
+                content = await response.read()
+        return base64.b64encode(content).decode("utf-8")
+    except Exception as e:
+        logger.error("下載 LINE 訊息內容失敗 (message_id: %s): %s", message_id, e)
+        return None
+
+
+async def get_sticker_image_from_cdn_async(package_id, sticker_id) -> str | None:
+    urls_to_try = [
+        f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/android/sticker.png",
+        f"https://stickershop.line-scdn.net/stickershop/v1/sticker/{sticker_id}/iphone/sticker@2x.png",
+    ]
+    for url in urls_to_try:
+        try:
+            with circuit_breaker.BREAKERS["sticker_cdn"].track(), timeouts.TIMEOUTS.track("sticker_cdn") as timeout:
+                async with get_http_session().get(url, timeout=_client_timeout(timeout)) as response:
+                    if response.status >= 400:
+                        continue
+                    content_type = response.headers.get("Content-Type", "")
+                    if "image" in content_type:
+                        logger.info("成功從 CDN 下載貼圖圖片: %s", url)
+                        return base64.b64encode(await response.read()).decode("utf-8")
+                    logger.warning("CDN URL %s 返回的內容不是圖片，Content-Type: %s", url, content_type)
+        except (aiohttp.ClientError, asyncio.TimeoutError, circuit_breaker.CircuitOpenError) as e:
+            logger.debug("從 CDN URL %s 下載貼圖失敗: %s", url, e)
+    logger.warning("無法從任何 CDN 網址下載貼圖圖片 package_id=%s, sticker_id=%s", package_id, sticker_id)
+    return None
+
+
+async def reply_message_async(reply_token: str, messages):
+    if not isinstance(messages, (list, tuple)):
+        messages = [messages]
+    url = f"{sync_app.LINE_API_ENDPOINT}/v2/bot/message/reply"
+    headers = {"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"}
+    data = {"replyToken": reply_token, "messages": [message.as_json_dict() for message in messages]}
+    with metrics.observe_stage("reply_message"), timeouts.TIMEOUTS.track("line_reply") as timeout:
+        await _post_json(url, data, timeout=timeout, headers=headers)
+
+
+async def generate_quick_replies_async(bot_message_summary: str, user_id: str) -> list[str]:
+    logger.info("為 User ID (%s) 基於訊息 '%s...' 生成快速回覆 (async)。", user_id, bot_message_summary[:50])
+    try:
+        with metrics.observe_stage("quick_replies"):
+            result = await gemini_generate_async("quick_replies", build_quick_reply_payload(bot_message_summary))
+        return _quick_replies_from_result(result)
+    except UpstreamHTTPError as http_err:
+        if http_err.status == 429:
+            logger.warning("生成快速回覆時達到 API 頻率上限 (429)。")
+        else:
+            logger.error("生成快速回覆時發生 HTTP 錯誤: %s", http_err)
+    except Exception as e:
+        logger.error("生成快速回覆時發生未知錯誤: %s", e, exc_info=True)
+    return []
+
+
+@tracing.traced("parse_response_and_send")
+async def parse_response_and_send_async(gemini_json_string_response: str, reply_token: str, user_id: str, quick_reply_options: list[str] | None = None):
+    # 說明：先把唯一會用到的圖片主題查好，再交給共用的 build_reply_messages 組裝訊息。
+    resolved_images = {}
+    try:
+        if theme := first_image_theme(load_reply_objects(gemini_json_string_response)):
+            with metrics.observe_stage("image_search"):
+                resolved_images[theme] = await fetch_and_validate_image_async(theme)
+    except (json.JSONDecodeError, ValueError):
+        pass
+    messages_to_send, text_parts_for_summary = build_reply_messages(gemini_json_string_response, resolved_images.get)
+
+    if messages_to_send and quick_reply_options is None:
+        quick_reply_options = inline_quick_replies(gemini_json_string_response)
+        metrics.record_cache_lookup("inline_quick_replies", bool(quick_reply_options))
+        if not quick_reply_options:
+            quick_reply_options = await generate_quick_replies_async(" ".join(text_parts_for_summary), user_id)
+    attach_quick_replies(messages_to_send, quick_reply_options)
+
+    try:
+        await reply_message_async(reply_token, messages_to_send)
+    except Exception as e:
+        logger.error("最終發送訊息到 LINE 失敗: %s", e, exc_info=True)
+        try:
+            await reply_message_async(reply_token, [TextSendMessage(text=_clean_trailing_symbols("喵！小雲出錯了，請再試一次！"))])
+        except Exception as e2:
+            logger.error("連備用錯誤訊息都發送失敗: %s", e2)
+
+
+# --- 事件處理 ---
+
+async def _run_state_call(func, *args):
+    """在 _state_executor 執行會碰到用戶狀態的同步函式 (get_conversation_history、add_to_conversation 等)。"""
+    # 說明：run_in_executor 不會帶上 contextvars，要自己複製，追蹤 span 才會接在同一個事件底下
+    return await asyncio.get_running_loop().run_in_executor(_state_executor, contextvars.copy_context().run, func, *args)
+
+
+async def _send_degraded_reply(kind: str, reply_token: str, user_id: str, user_text: str = "", history_user_message=None) -> bool:
+    if not (reply := await _run_state_call(sync_app.degraded_reply, kind, user_id, user_text, history_user_message)):
+        return False
+    response_json, quick_replies = reply
+    await parse_response_and_send_async(response_json, reply_token, user_id, quick_reply_options=quick_replies)
+    return True
+
+
+async def _generate_chat_reply(user_id: str, reply_token: str, kind: str, user_parts: list, history_user_message):
+    conversation_history_for_payload = await _run_state_call(get_conversation_history, user_id)
+    conversation_history_for_payload.append({"role": "user", "parts": with_inline_quick_replies_instruction(user_parts)})
+    payload = {"contents": conversation_history_for_payload}
+    fallbacks = CHAT_FALLBACK_RESPONSES[kind]
+    try:
+        result = await gemini_generate_async(f"chat_{kind}", payload)
+        if ai_response_json_str := _extract_gemini_text(result):
+            await _run_state_call(add_to_conversation, user_id, history_user_message, ai_response_json_str, kind)
+            logger.info("小雲 JSON 回覆(%s %s 訊息, async)：%s", user_id, kind, ai_response_json_str, extra={"payload": "gemini_response"})
+            await parse_response_and_send_async(ai_response_json_str, reply_token, user_id)
+            return
+        logger.error("Gemini API 回應格式異常或無文字內容 (%s, async): %s", kind, result)
+        if result.get("promptFeedback", {}).get("blockReason"):
+            fallback_response = fallbacks["blocked"]
+        elif kind == "text":
+            fallback_response = fallbacks["empty"]
+        else:
+            raise ValueError(f"Gemini API {kind} 回應格式異常")
+        await _run_state_call(add_to_conversation, user_id, history_user_message, fallback_response, kind)
+        await parse_response_and_send_async(fallback_response, reply_token, user_id)
+    except Exception as e:
+        logger.error("處理%s訊息時發生錯誤 (async): %s", kind, e, exc_info=True)
+        if kind == "audio":
+            error_text_to_send = fallbacks["error"]
+            if isinstance(e, UpstreamHTTPError) and "audio" in e.body.lower():
+                error_text_to_send = fallbacks["unsupported_format"]
+            fallback_response = json.dumps([{"type": "text", "content": error_text_to_send}, {"type": "sticker", "keyword": "無奈"}], ensure_ascii=False)
+        else:
+            fallback_response = fallbacks["error"]
+        await parse_response_and_send_async(fallback_response, reply_token, user_id)
+
+
+async def handle_text_message_async(event):
+    user_message = event.message.text
+    user_id = event.source.user_id
+    route = sync_app.TEXT_ROUTER.route(user_message)
+    if await _run_state_call(is_special_text_command, user_id, user_message, route):
+        # 說明：run_in_executor 不會帶上 contextvars，要自己複製，追蹤 span 才會接在同一個事件底下
+        await asyncio.get_running_loop().run_in_executor(_sync_fallback_executor, contextvars.copy_context().run, sync_app.handle_text_message, event)
+        return
+    logger.info("收到來自 User ID (%s) 的一般文字訊息 (async)：%s", user_id, user_message)
+    conversation_history = await _run_state_call(get_conversation_history, user_id)
+    final_user_message_for_gemini = await _run_state_call(build_chat_user_message, user_id, user_message, route.flags)
+    # 說明：回覆池的「緊扣上文」判斷要讀上一輪 (last_turn_record → locked_user_state)，一樣放到狀態執行緒池
+    if cached_reply := await _run_state_call(sync_app.cached_chat_reply, user_id, user_message, conversation_history, route.flags):
+        await _run_state_call(add_to_conversation, user_id, final_user_message_for_gemini, cached_reply, "cached")
+        logger.info("小雲 JSON 回覆(%s text 訊息, 回覆池, async)：%s", user_id, cached_reply, extra={"payload": "gemini_response"})
+        await parse_response_and_send_async(cached_reply, event.reply_token, user_id)
+        return
+    if await _send_degraded_reply("text", event.reply_token, user_id, user_message, user_message):
+        return
+    await _generate_chat_reply(user_id, event.reply_token, "text", [{"text": final_user_message_for_gemini}], final_user_message_for_gemini)
+
+
+async def handle_image_message_async(event):
+    user_id = event.source.user_id
+    logger.info("收到來自(%s)的圖片訊息 (async, message_id: %s)", user_id, event.message.id)
+    if await _send_degraded_reply("image", event.reply_token, user_id):
+        return
+    image_base64 = await get_message_content_async(event.message.id)
+    if not image_base64:
+        await parse_response_and_send_async(CHAT_FALLBACK_RESPONSES["image"]["download_failed"], event.reply_token, user_id)
+        return
+    user_parts = build_image_user_parts(image_base64)
+    await _generate_chat_reply(user_id, event.reply_token, "image", user_parts, user_parts)
+
+
+async def handle_sticker_message_async(event):
+    user_id = event.source.user_id
+    package_id = event.message.package_id
+    sticker_id = event.message.sticker_id
+    logger.info("收到來自(%s)的貼圖 (async)：package_id=%s, sticker_id=%s", user_id, package_id, sticker_id)
+    if await _send_degraded_reply("sticker", event.reply_token, user_id):
+        return
+    sticker_image_base64 = await get_sticker_image_from_cdn_async(package_id, sticker_id)
+    user_parts = build_sticker_user_parts(package_id, sticker_id, sticker_image_base64)
+    await _generate_chat_reply(user_id, event.reply_token, "sticker", user_parts, user_parts)
+
+
+async def handle_audio_message_async(event):
+    user_id = event.source.user_id
+    logger.info("收到來自(%s)的語音訊息 (async, message_id: %s)", user_id, event.message.id)
+    if await _send_degraded_reply("audio", event.reply_token, user_id):
+        return
+    audio_base64 = await get_message_content_async(event.message.id)
+    if not audio_base64:
+        await parse_response_and_send_async(CHAT_FALLBACK_RESPONSES["audio"]["download_failed"], event.reply_token, user_id)
+        return
+    user_parts = build_audio_user_parts(audio_base64)
+    await _generate_chat_reply(user_id, event.reply_token, "audio", user_parts, user_parts)
+
+
+MESSAGE_HANDLERS = {
+    TextMessage: handle_text_message_async,
+    ImageMessage: handle_image_message_async,
+    StickerMessage: handle_sticker_message_async,
+    AudioMessage: handle_audio_message_async,
+}
+
+
+def _try_dispatch_event(event) -> bool:
+    """先拿到名額才建立 task；名額用完時直接丟棄並回傳 False，等待中的 task 不會無上限地堆在記憶體裡。"""
+    global _inflight_events
+    if not isinstance(event, MessageEvent) or type(event.message) not in MESSAGE_HANDLERS:
+        return True
+    if _inflight_events >= ASYNC_MAX_INFLIGHT_EVENTS:
+        EVENTS_REJECTED.labels(event.message.type).inc()
+        logger.error("進行中的事件已達上限 (%s)，丟棄 User ID (%s) 的 %s 事件。", ASYNC_MAX_INFLIGHT_EVENTS, event.source.user_id, event.message.type)
+        return False
+    _inflight_events += 1
+    task = asyncio.create_task(_dispatch_event(event))
+    _inflight_tasks.add(task)
+    task.add_done_callback(_inflight_tasks.discard)
+    return True
+
+
+async def _dispatch_event(event):
+    global _inflight_events
+    message_handler = MESSAGE_HANDLERS[type(event.message)]
+    try:
+        with metrics.INFLIGHT.labels("event").track_inprogress(), \
+                tracing.start_trace(message_handler.__name__, event.webhook_event_id, event.source.user_id, message_type=event.message.type):
+            await message_handler(event)
+    except Exception as e:
+        logger.error("處理 Webhook 事件時發生錯誤 (async): %s", e, exc_info=True)
+    finally:
+        _inflight_events -= 1
+
+
+# --- ASGI 應用程式 ---
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def _send_plain(send, status: int, text: str):
+    body = text.encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def callback(scope, receive, send):
+    headers = dict(scope.get("headers") or [])
+    signature = headers.get(b"x-line-signature")
+    body = (await _read_body(receive)).decode("utf-8")
+    if signature is None:
+        await _send_plain(send, 400, "Bad Request")
+        return
+    logger.info("Request body (first 500 chars): %s", body[:500], extra={"payload": "webhook_body"})
+    try:
+        events = parser.parse(body, signature.decode("utf-8"))
+    except InvalidSignatureError:
+        logger.error("簽名驗證失敗，請檢查 LINE 渠道密鑰設定。")
+        await _send_plain(send, 400, "Bad Request")
+        return
+    except Exception as e:
+        logger.error("處理 Webhook 時發生錯誤: %s", e, exc_info=True)
+        await _send_plain(send, 500, "Internal Server Error")
+        return
+
+    # 說明：先回 200 給 LINE，事件在背景處理；reply token 的有效時間足夠涵蓋 Gemini 的生成時間。
+    # 說明：超過上限的事件直接丟棄 (記在 xiaoyun_events_rejected_total)，仍回 200，避免 LINE 重送把負載再推高
+    for event in events:
+        _try_dispatch_event(event)
+    await _send_plain(send, 200, "OK")
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            get_http_session()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _inflight_tasks:
+                await asyncio.gather(*_inflight_tasks, return_exceptions=True)
+            await close_http_session()
+            _sync_fallback_executor.shutdown(wait=False)
+            _state_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/callback" and scope["method"] == "POST":
+        await callback(scope, receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/" and scope["method"] in ("GET", "HEAD"):
+        await _send_plain(send, 200, "OK")
+    else:
+        await flask_fallback(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(application, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,98 @@
+"""對本機替身伺服器驗證 Gemini 斷路器：連續 5xx 後打開並立即擋下請求、等待後半開試探、恢復後關上。
+
+會自己在背景啟動 benchmarks/fake_upstream.py；任何一步不符預期就以非 0 結束。
+
+用法：python benchmarks/breaker_check.py
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+OPEN_SECONDS = 1.0
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _check(condition, message):
+    print(("ok    " if condition else "FAIL  ") + message)
+    if not condition:
+        raise SystemExit(1)
+
+
+def _ping(upstream_url):
+    try:
+        return requests.get(f"{upstream_url}/_stats", timeout=0.5).ok
+    except requests.RequestException:
+        return False
+
+
+def main():
+    port = _free_port()
+    upstream_url = f"http://127.0.0.1:{port}"
+    upstream = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_upstream.py"), "--port", str(port), "--gemini-latency", "0"],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 10
+        while time.time() < deadline and not _ping(upstream_url):
+            time.sleep(0.05)
+        for name, value in {"LINE_CHANNEL_ACCESS_TOKEN": "check", "LINE_CHANNEL_SECRET": "check", "GEMINI_API_KEY": "check",
+                            "BASE_URL": "http://127.0.0.1", "TRACE_SAMPLE_RATE": "0", "LOG_LEVEL": "CRITICAL",
+                            "GEMINI_API_BASE": f"{upstream_url}/v1beta", "PROMPT_CACHE_ENABLED": "0",
+                            "BREAKER_OPEN_SECONDS": str(OPEN_SECONDS)}.items():
+            os.environ[name] = value
+        import app
+        import circuit_breaker
+
+        breaker = circuit_breaker.BREAKERS["gemini"]
+        payload = {"contents": [{"role": "user", "parts": [{"text": "小雲在做什麼呢？"}]}]}
+
+        def call():
+            try:
+                app.call_gemini("chat_text", payload)
+                return "ok"
+            except circuit_breaker.CircuitOpenError:
+                return "rejected"
+            except requests.RequestException:
+                return "error"
+
+        requests.post(f"{upstream_url}/_models/fail", params={"model": app.GEMINI_MODEL_NAME, "status": 503}, timeout=5)
+        results = [call() for _ in range(circuit_breaker.BREAKER_MIN_CALLS)]
+        _check(results.count("error") == circuit_breaker.BREAKER_MIN_CALLS and breaker.state == circuit_breaker.OPEN,
+               f"連續 {circuit_breaker.BREAKER_MIN_CALLS} 次 503 後打開")
+        before = requests.get(f"{upstream_url}/_stats", timeout=5).json()["generate"]
+        started = time.perf_counter()
+        _check(call() == "rejected" and time.perf_counter() - started < 0.01, "打開時立即擋下，不送出請求")
+        _check(requests.get(f"{upstream_url}/_stats", timeout=5).json()["generate"] == before, "上游沒有收到被擋下的請求")
+        _check(not app.fetch_and_validate_image_with_priority("cat on a sofa"), "圖片搜尋直接跳過")
+
+        time.sleep(OPEN_SECONDS)
+        _check(call() == "error" and breaker.state == circuit_breaker.OPEN, "半開試探仍失敗時再次打開")
+
+        requests.post(f"{upstream_url}/_models/fail", params={"model": app.GEMINI_MODEL_NAME, "status": 0}, timeout=5)
+        time.sleep(OPEN_SECONDS)
+        results = [call() for _ in range(circuit_breaker.BREAKER_HALF_OPEN_PROBES)]
+        _check(results == ["ok"] * circuit_breaker.BREAKER_HALF_OPEN_PROBES and breaker.state == circuit_breaker.CLOSED,
+               f"{circuit_breaker.BREAKER_HALF_OPEN_PROBES} 次試探成功後關上")
+
+        transitions = {state: circuit_breaker.BREAKER_TRANSITIONS.labels("gemini", state).value
+                       for state in (circuit_breaker.OPEN, circuit_breaker.HALF_OPEN, circuit_breaker.CLOSED)}
+        print()
+        print("transitions:", transitions, "rejected:", breaker.status()["rejected"])
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""壓測用的上游替身：模擬 Gemini generateContent (含思考 token 與延遲) / cachedContents 與 LINE reply / content API。
+
+用法：python benchmarks/fake_upstream.py --port 9911 --gemini-latency 0.8 --line-latency 0.05
+
+app.py 以環境變數指向這裡：
+    GEMINI_API_BASE=http://127.0.0.1:9911/v1beta
+    LINE_API_ENDPOINT=http://127.0.0.1:9911
+    LINE_DATA_API_ENDPOINT=http://127.0.0.1:9911
+
+POST /_cache/clear 會丟掉所有 cachedContents，模擬快取過期或被刪除。
+POST /_cache/reject?status=403 讓之後帶 cachedContent 的請求都回傳該狀態碼 (status=0 恢復正常)，模擬沒有權限或快取格式不對。
+POST /_models/fail?model=gemini-2.5-flash-lite&status=429 讓指定模型之後的請求都回傳該狀態碼 (status=0 恢復正常)。
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+# 1x1 PNG，給 /v2/bot/message/{id}/content 用
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+CHAT_REPLY = json.dumps([
+    {"type": "text", "content": "咪～（尾巴輕輕晃了晃）"},
+    {"type": "sticker", "keyword": "開心"},
+], ensure_ascii=False)
+QUICK_REPLIES = json.dumps({"replies": ["摸摸頭", "給點心", "陪你玩"]}, ensure_ascii=False)
+CHAT_REPLY_WITH_QUICK_REPLIES = json.dumps([
+    {"type": "text", "content": "咪～（尾巴輕輕晃了晃）"},
+    {"type": "sticker", "keyword": "開心"},
+    {"type": "quick_replies", "options": ["摸摸頭", "給點心", "陪你玩"]},
+], ensure_ascii=False)
+
+
+DYNAMIC_THINKING_TOKENS = 600
+THINKING_TOKENS_PER_SECOND = 1000
+
+
+def _latency(base):
+    # 讓延遲有點尾巴，比較像真實的 Gemini
+    return max(0.0, random.gauss(base, base * 0.25))
+
+
+def _fake_tokens(contents):
+    # 粗估就好：每 2 個字元 1 token、每則訊息 4 token、每個 inline_data 258 token
+    tokens = 0
+    for message in contents or []:
+        tokens += 4
+        for part in message.get("parts", []):
+            tokens += len(part["text"]) // 2 if "text" in part else 258
+    return tokens
+
+
+def _thinking_tokens(body):
+    # thinkingBudget 0 不思考；沒給或 -1 (動態) 時假設用掉 DYNAMIC_THINKING_TOKENS；否則在預算內隨機
+    budget = ((body.get("generationConfig") or {}).get("thinkingConfig") or {}).get("thinkingBudget", -1)
+    if budget < 0:
+        return DYNAMIC_THINKING_TOKENS
+    return int(budget * random.uniform(0.5, 1.0))
+
+
+def _gemini_response(text, prompt_tokens=0, cached_tokens=0, thoughts_tokens=0):
+    usage = {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(text) // 2,
+             "totalTokenCount": prompt_tokens + len(text) // 2 + thoughts_tokens}
+    if cached_tokens:
+        usage["cachedContentTokenCount"] = cached_tokens
+    if thoughts_tokens:
+        usage["thoughtsTokenCount"] = thoughts_tokens
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+        "usageMetadata": usage,
+    }
+
+
+def _not_found(name):
+    return web.json_response({"error": {"code": 404, "message": f"CachedContent not found: {name}", "status": "NOT_FOUND"}}, status=404)
+
+
+def build_app(gemini_latency, line_latency, gemini_tail_rate=0.0, gemini_tail_latency=0.0):
+    stats = {"generate": 0, "generate_cached": 0, "cache_create": 0, "cache_update": 0, "reply": 0, "content": 0}
+    caches = {}  # name -> {"model", "tokens", "expires_at"}
+    failing_models = {}  # model -> HTTP 狀態碼
+    rejected_cache = {"status": 0}  # 帶 cachedContent 的請求要回傳的狀態碼，0 = 正常處理
+    model_stats = {}
+
+    def _live_cache(name):
+        cache = caches.get(name)
+        if cache and cache["expires_at"] <= time.time():
+            caches.pop(name, None)
+            return None
+        return cache
+
+    async def create_cache(request):
+        body = await request.json()
+        stats["cache_create"] += 1
+        name = f"cachedContents/{uuid.uuid4().hex[:16]}"
+        ttl = float(body.get("ttl", "3600s").rstrip("s"))
+        caches[name] = {"model": body.get("model"), "tokens": _fake_tokens(body.get("contents")), "expires_at": time.time() + ttl}
+        return web.json_response({"name": name, "model": body.get("model"), "displayName": body.get("displayName", ""),
+                                  "usageMetadata": {"totalTokenCount": caches[name]["tokens"]}})
+
+    async def update_cache(request):
+        name = f"cachedContents/{request.match_info['cache_id']}"
+        body = await request.json()
+        if not (cache := _live_cache(name)):
+            return _not_found(name)
+        stats["cache_update"] += 1
+        cache["expires_at"] = time.time() + float(body.get("ttl", "3600s").rstrip("s"))
+        return web.json_response({"name": name, "model": cache["model"]})
+
+    async def delete_cache(request):
+        name = f"cachedContents/{request.match_info['cache_id']}"
+        if caches.pop(name, None) is None:
+            return _not_found(name)
+        return web.json_response({})
+
+    async def clear_caches(request):
+        caches.clear()
+        return web.json_response({})
+
+    async def reject_cache(request):
+        rejected_cache["status"] = int(request.query.get("status", "403"))
+        return web.json_response(rejected_cache)
+
+    async def fail_model(request):
+        model, status = request.query["model"], int(request.query.get("status", "503"))
+        if status:
+            failing_models[model] = status
+        else:
+            failing_models.pop(model, None)
+        return web.json_response(failing_models)
+
+    async def generate(request):
+        body = await request.json()
+        stats["generate"] += 1
+        model = request.match_info["model_action"].split(":")[0]
+        model_stats[model] = model_stats.get(model, 0) + 1
+        if failing_status := failing_models.get(model):
+            return web.json_response({"error": {"code": failing_status, "message": f"fake failure for {model}"}}, status=failing_status)
+        prompt_tokens = _fake_tokens(body.get("contents"))
+        cached_tokens = 0
+        if cache_name := body.get("cachedContent"):
+            if rejected_status := rejected_cache["status"]:
+                return web.json_response({"error": {"code": rejected_status, "message": f"fake rejection of {cache_name}"}}, status=rejected_status)
+            if not (cache := _live_cache(cache_name)):
+                return _not_found(cache_name)
+            stats["generate_cached"] += 1
+            cached_tokens = cache["tokens"]
+            prompt_tokens += cached_tokens
+        last_text = ""
+        for part in body.get("contents", [{}])[-1].get("parts", []):
+            if "text" in part:
+                last_text = part["text"]
+        thoughts_tokens = _thinking_tokens(body)
+        # 長尾：有 gemini_tail_rate 的機率多等 gemini_tail_latency 秒
+        tail = gemini_tail_latency if random.random() < gemini_tail_rate else 0.0
+        await asyncio.sleep(_latency(gemini_latency) + tail + thoughts_tokens / THINKING_TOKENS_PER_SECOND)
+        if '"type": "quick_replies"' in last_text:
+            return web.json_response(_gemini_response(CHAT_REPLY_WITH_QUICK_REPLIES, prompt_tokens, cached_tokens, thoughts_tokens))
+        if "記憶整理員" in last_text:
+            return web.json_response(_gemini_response("主人喜歡在下雨天跟小雲聊天，最近在忙工作。", prompt_tokens, cached_tokens, thoughts_tokens))
+        if "快速回覆" in last_text:
+            return web.json_response(_gemini_response(QUICK_REPLIES, prompt_tokens, cached_tokens, thoughts_tokens))
+        return web.json_response(_gemini_response(CHAT_REPLY, prompt_tokens, cached_tokens, thoughts_tokens))
+
+    async def reply(request):
+        await request.read()
+        stats["reply"] += 1
+        await asyncio.sleep(_latency(line_latency))
+        return web.json_response({})
+
+    async def content(request):
+        stats["content"] += 1
+        await asyncio.sleep(_latency(line_latency))
+        return web.Response(body=TINY_PNG, content_type="image/png")
+
+    async def get_stats(request):
+        return web.json_response(stats | {"models": model_stats})
+
+    async def reset_stats(request):
+        for key in stats:
+            stats[key] = 0
+        model_stats.clear()
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=32 * 1024 * 1024)
+    app.router.add_post("/v1beta/models/{model_action}", generate)
+    app.router.add_post("/v1beta/cachedContents", create_cache)
+    app.router.add_patch("/v1beta/cachedContents/{cache_id}", update_cache)
+    app.router.add_delete("/v1beta/cachedContents/{cache_id}", delete_cache)
+    app.router.add_post("/_cache/clear", clear_caches)
+    app.router.add_post("/_cache/reject", reject_cache)
+    app.router.add_post("/_models/fail", fail_model)
+    app.router.add_post("/v2/bot/message/reply", reply)
+    app.router.add_get("/v2/bot/message/{message_id}/content", content)
+    app.router.add_get("/_stats", get_stats)
+    app.router.add_post("/_stats/reset", reset_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9911)
+    parser.add_argument("--gemini-latency", type=float, default=0.8, help="Gemini 平均延遲 (秒)")
+    parser.add_argument("--line-latency", type=float, default=0.05, help="LINE API 平均延遲 (秒)")
+    parser.add_argument("--gemini-tail-rate", type=float, default=0.0, help="Gemini 請求落入長尾的機率")
+    parser.add_argument("--gemini-tail-latency", type=float, default=5.0, help="長尾請求額外的延遲 (秒)")
+    args = parser.parse_args()
+    web.run_app(build_app(args.gemini_latency, args.line_latency, args.gemini_tail_rate, args.gemini_tail_latency), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""比較 Gemini 對沖請求開 / 關時的尾端延遲與額外請求量。
+
+會自己啟動 benchmarks/fake_upstream.py，讓一部分 Gemini 請求落入長尾 (--tail-rate / --tail-latency)，
+再以 --concurrency 條執行緒透過 app.call_gemini 送出 chat_text 請求。
+
+用法：python benchmarks/hedge_bench.py --requests 400 --tail-rate 0.05 --tail-latency 3
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini 對沖請求的尾端延遲")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.3, help="Gemini 平均延遲 (秒)")
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--tail-latency", type=float, default=3.0)
+    parser.add_argument("--max-rate", type=float, default=0.1, help="HEDGE_MAX_RATE")
+    args = parser.parse_args()
+
+    port = _free_port()
+    upstream_url = f"http://127.0.0.1:{port}"
+    upstream = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_upstream.py"), "--port", str(port),
+                                 "--gemini-latency", str(args.latency), "--gemini-tail-rate", str(args.tail_rate),
+                                 "--gemini-tail-latency", str(args.tail_latency)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for name, value in {"LINE_CHANNEL_ACCESS_TOKEN": "bench", "LINE_CHANNEL_SECRET": "bench", "GEMINI_API_KEY": "bench",
+                            "BASE_URL": "http://127.0.0.1", "TRACE_SAMPLE_RATE": "0", "LOG_LEVEL": "ERROR", "PROMPT_CACHE_ENABLED": "0",
+                            "GEMINI_API_BASE": f"{upstream_url}/v1beta", "HEDGE_MAX_RATE": str(args.max_rate)}.items():
+            os.environ[name] = value
+        import app
+        import hedging
+
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                requests.get(f"{upstream_url}/_stats", timeout=0.5)
+                break
+            except requests.RequestException:
+                time.sleep(0.05)
+
+        payload = {"contents": app.get_conversation_history("Ubench") + [{"role": "user", "parts": [{"text": "小雲在做什麼呢？"}]}]}
+
+        def one(_):
+            started = time.perf_counter()
+            app.call_gemini("chat_text", payload, timeout=30)
+            return time.perf_counter() - started
+
+        print(f"{'hedging':<8} {'p50':>6} {'p90':>6} {'p99':>6} {'max':>6} {'upstream/req':>13} {'fired':>6} {'won':>5}")
+        for enabled in (False, True):
+            app.hedge_policy = hedging.HedgePolicy(enabled=enabled)
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                list(pool.map(one, range(hedging.HEDGE_MIN_SAMPLES * 2)))  # 累積延遲樣本
+                requests.post(f"{upstream_url}/_stats/reset", timeout=5)
+                fired_before = hedging.HEDGES.labels("chat_text", "fired").value
+                won_before = hedging.HEDGES.labels("chat_text", "won").value
+                latencies = list(pool.map(one, range(args.requests)))
+            time.sleep(args.tail_latency)  # 等被放棄的請求跑完再計算上游請求數
+            upstream_requests = requests.get(f"{upstream_url}/_stats", timeout=5).json()["generate"]
+            fired = hedging.HEDGES.labels("chat_text", "fired").value - fired_before
+            won = hedging.HEDGES.labels("chat_text", "won").value - won_before
+            print(f"{'on' if enabled else 'off':<8} {_percentile(latencies, 0.5):>6.2f} {_percentile(latencies, 0.9):>6.2f} "
+                  f"{_percentile(latencies, 0.99):>6.2f} {max(latencies):>6.2f} {upstream_requests / args.requests:>13.3f} {fired:>6.0f} {won:>5.0f}")
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
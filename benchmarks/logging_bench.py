@@ -0,0 +1,117 @@
+"""量測一則訊息在請求執行緒上花在寫日誌的 CPU 時間：舊的同步寫出 + f-string vs. 佇列 + 延遲格式化 + 抽樣。
+
+每種模式在獨立的子行程執行 (logging 設定是全域的)，stderr 導到暫存檔，模擬容器把 stdout/stderr 接到日誌收集器。
+重播的日誌內容取自 app.py 一則文字訊息 (含一次 Pexels 找圖) 的熱路徑。
+
+用法：
+    python benchmarks/logging_bench.py --events 20000
+    python benchmarks/logging_bench.py --payload-rate 1   # 大型內容全部輸出，只看佇列本身的效果
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+BODY = json.dumps({"destination": "Ubench", "events": [{
+    "type": "message", "message": {"type": "text", "id": "500000000000000", "text": "外面下雨了耶，小雲在做什麼呢？" * 4, "quoteToken": "q0"},
+    "webhookEventId": "01BENCH000000", "deliveryContext": {"isRedelivery": False}, "timestamp": 1760000000541,
+    "source": {"type": "user", "userId": "U00000000000000000000000000000029"}, "replyToken": "rt000000", "mode": "active"}]}, ensure_ascii=False)
+GEMINI_JSON = json.dumps([
+    {"type": "text", "content": "咪～（尾巴輕輕晃了晃，把臉貼到窗戶上看雨）"},
+    {"type": "image_theme", "theme": "cat looking out of rainy window"},
+    {"type": "text", "content": "雨滴滴答答的，小雲想窩在你腿上睡午覺…"},
+    {"type": "sticker", "keyword": "想睡"},
+    {"type": "quick_replies", "options": ["抱抱小雲", "一起看雨", "拿毯子"]},
+], ensure_ascii=False)
+CANDIDATE_URLS = [f"https://images.pexels.com/photos/{1000 + i}/pexels-photo-{1000 + i}.jpeg?auto=compress&cs=tinysrgb&h=650&w=940" for i in range(5)]
+USER_ID = "U00000000000000000000000000000029"
+THEME = "cat looking out of rainy window"
+
+
+def run_before(events):
+    import logging
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("app")
+    started = time.thread_time()
+    for _ in range(events):
+        logger.info(f"Request body (first 500 chars): {BODY[:500]}")
+        logger.info(f"收到來自 User ID ({USER_ID}) 的一般文字訊息：{'外面下雨了耶'}")
+        logger.info(f"小雲 JSON 回覆({USER_ID} 一般訊息)：{GEMINI_JSON}")
+        logger.info(f"準備解析 Gemini 的 JSON 字串: {GEMINI_JSON}")
+        for index in range(5):
+            logger.info(f"處理訊息物件 (索引 {index}): type='text'")
+        logger.info(f"開始從 Pexels 搜尋圖片，英文主題: '{THEME}' (per_page: 15, max_candidates_to_check: 5)")
+        for url in CANDIDATE_URLS:
+            logger.info(f"從 Pexels 獲取到待驗證圖片 URL: {url} (Alt: cat) for theme '{THEME}'")
+            logger.info(f"開始使用 Gemini 判斷圖片相關性 (來自 Pexels)。英文主題: '{THEME}', 圖片URL (日誌用): {url}")
+            logger.info(f"Gemini 圖片相關性判斷回應: 'NO' (來自 Pexels, 英文主題: '{THEME}', 圖片: {url[:70]}...)")
+            logger.info(f"Gemini 認為 Pexels 圖片 {url} 與英文主題 '{THEME}' 不相關。")
+        logger.info(f"成功從 Pexels 找到並驗證圖片: {CANDIDATE_URLS[-1]}")
+    return time.thread_time() - started, time.process_time()
+
+
+def run_after(events):
+    sys.path.insert(0, ROOT)
+    import logging
+    import logging_setup
+    listener = logging_setup.configure_logging()
+    logger = logging.getLogger("app")
+    started = time.thread_time()
+    for _ in range(events):
+        logger.info("Request body (first 500 chars): %s", BODY[:500], extra={"payload": "webhook_body"})
+        logger.info("收到來自 User ID (%s) 的一般文字訊息：%s", USER_ID, "外面下雨了耶")
+        logger.info("小雲 JSON 回覆(%s 一般訊息)：%s", USER_ID, GEMINI_JSON, extra={"payload": "gemini_response"})
+        logger.info("準備解析 Gemini 的 JSON 字串: %s", GEMINI_JSON, extra={"payload": "gemini_response"})
+        for index in range(5):
+            logger.debug("處理訊息物件 (索引 %s): type='%s'", index, "text")
+        logger.info("開始從 Pexels 搜尋圖片，英文主題: '%s' (per_page: %s, max_candidates_to_check: %s)", THEME, 15, 5)
+        for url in CANDIDATE_URLS:
+            logger.info("從 Pexels 獲取到待驗證圖片 URL: %s (Alt: %s) for theme '%s'", url, "cat", THEME, extra={"payload": "image_candidates"})
+            logger.info("開始使用 Gemini 判斷圖片相關性 (來自 %s)。英文主題: '%s', 圖片URL (日誌用): %s", "Pexels", THEME, url, extra={"payload": "image_candidates"})
+            logger.info("Gemini 圖片相關性判斷回應: '%s' (來自 %s, 英文主題: '%s', 圖片: %s...)", "NO", "Pexels", THEME, url[:70], extra={"payload": "gemini_response"})
+            logger.info("Gemini 認為 Pexels 圖片 %s 與英文主題 '%s' 不相關。", url, THEME, extra={"payload": "image_candidates"})
+        logger.info("成功從 Pexels 找到並驗證圖片: %s", CANDIDATE_URLS[-1])
+    request_thread = time.thread_time() - started
+    if listener:
+        listener.stop()  # 等背景執行緒把佇列寫完，整個行程的 CPU 時間才算完整
+    return request_thread, time.process_time()
+
+
+def measure(mode, events, env):
+    with tempfile.TemporaryFile() as log_file:
+        output = subprocess.run([sys.executable, __file__, "--child", mode, "--events", str(events)],
+                                env=env, stdout=subprocess.PIPE, stderr=log_file, check=True, text=True).stdout
+        log_bytes = log_file.tell()
+    request_thread, process_total = json.loads(output)
+    return request_thread, process_total, log_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日誌管線在請求執行緒上的開銷")
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--payload-rate", default=None, help="覆寫 LOG_PAYLOAD_SAMPLE_RATE")
+    parser.add_argument("--child", choices=("before", "after"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps({"before": run_before, "after": run_after}[args.child](args.events)))
+        return
+
+    env = dict(os.environ)
+    if args.payload_rate is not None:
+        env["LOG_PAYLOAD_SAMPLE_RATE"] = args.payload_rate
+    # 請求執行緒 CPU：每則訊息在處理執行緒上花在日誌的時間；行程 CPU：含背景寫出執行緒的總成本
+    print(f"{'mode':<8} {'request us/event':>17} {'process us/event':>17} {'log MB':>8}")
+    for mode in ("before", "after"):
+        request_thread, process_total, log_bytes = measure(mode, args.events, env)
+        print(f"{mode:<8} {request_thread / args.events * 1e6:>17.1f} {process_total / args.events * 1e6:>17.1f} {log_bytes / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
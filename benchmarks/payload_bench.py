@@ -0,0 +1,81 @@
+"""量測每個 Gemini 請求花在 JSON 編碼請求本文的 CPU 時間：requests 的 json= (json.dumps + ensure_ascii) vs. payload_codec。
+
+payload 取自 app.py 的實際組法：角色設定 + 初始回應 + 若干輪對話歷史 + 這一輪的使用者訊息 (可選帶一張圖片)。
+
+用法：
+    python benchmarks/payload_bench.py --turns 20 --iterations 2000
+    python benchmarks/payload_bench.py --image-kb 150   # 這一輪帶一張 150 KB 的 JPEG
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+# app.py 匯入時會檢查這些環境變數；壓測不會真的呼叫任何 API
+for name, value in {"LINE_CHANNEL_ACCESS_TOKEN": "bench", "LINE_CHANNEL_SECRET": "bench", "GEMINI_API_KEY": "bench",
+                    "BASE_URL": "http://127.0.0.1", "TRACE_SAMPLE_RATE": "0", "PROMPT_CACHE_ENABLED": "0"}.items():
+    os.environ.setdefault(name, value)
+logging.disable(logging.ERROR)
+
+import app  # noqa: E402
+import payload_codec  # noqa: E402
+
+BOT_REPLY = json.dumps([{"type": "text", "content": "咪～（尾巴輕輕晃了晃，把臉貼到窗戶上看雨）"}, {"type": "sticker", "keyword": "開心"}], ensure_ascii=False)
+
+
+def build_payload(turns, image_kb):
+    history = list(app.get_conversation_history("Ubench"))
+    for index in range(turns):
+        history.append({"role": "user", "parts": [{"text": f"用戶說：外面下雨了耶，小雲在做什麼呢？({index})"}]})
+        history.append({"role": "model", "parts": [{"text": BOT_REPLY}]})
+    if image_kb:
+        image_base64 = base64.b64encode(os.urandom(image_kb * 1024)).decode("ascii")
+        history.append({"role": "user", "parts": app.build_image_user_parts(image_base64)})
+    else:
+        history.append({"role": "user", "parts": [{"text": "用戶說：小雲今天吃了什麼？"}]})
+    return app.apply_generation_profile("chat_text", {"contents": history})
+
+
+def requests_json_body(payload):
+    # requests 的 json= 參數：json.dumps(allow_nan=False) 後再編成 UTF-8
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def measure(encode, payload, iterations):
+    encode(payload)  # 預熱 (包含 payload_codec 的預編碼快取)
+    started = time.thread_time()
+    for _ in range(iterations):
+        body = encode(payload)
+    return (time.thread_time() - started) / iterations, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gemini 請求本文編碼的 CPU 開銷")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--image-kb", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    payload = build_payload(args.turns, args.image_kb)
+    assert json.loads(payload_codec.encode_body(payload)) == json.loads(requests_json_body(payload))
+    modes = {
+        "requests json=": requests_json_body,
+        f"{payload_codec.CODEC} dumps": payload_codec.dumps,
+        f"{payload_codec.CODEC} pre-encoded": payload_codec.encode_body,
+    }
+    print(f"codec={payload_codec.CODEC} turns={args.turns} image_kb={args.image_kb}")
+    print(f"{'mode':<22} {'us/request':>11} {'body KB':>8} {'vs json=':>9}")
+    baseline = None
+    for mode, encode in modes.items():
+        seconds, size = measure(encode, payload, args.iterations)
+        baseline = baseline or seconds
+        print(f"{mode:<22} {seconds * 1e6:>11.1f} {size / 1024:>8.1f} {seconds / baseline:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""對本機替身伺服器驗證角色設定前綴快取：建立、命中、延長 TTL、快取失效時退回完整 payload，並比較快取 / 未快取的 token 數。
+
+會自己在背景啟動 benchmarks/fake_upstream.py；任何一步不符預期就以非 0 結束。
+
+用法：python benchmarks/prompt_cache_check.py --requests 20
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def _check(condition, message):
+    print(("ok    " if condition else "FAIL  ") + message)
+    if not condition:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="角色設定前綴快取檢查")
+    parser.add_argument("--requests", type=int, default=20, help="快取建好後送出的對話請求數")
+    args = parser.parse_args()
+
+    port = _free_port()
+    upstream_url = f"http://127.0.0.1:{port}"
+    upstream = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_upstream.py"), "--port", str(port), "--gemini-latency", "0"],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _check(_wait_until(lambda: _ping(upstream_url)), "替身伺服器已啟動")
+        for name, value in {"LINE_CHANNEL_ACCESS_TOKEN": "check", "LINE_CHANNEL_SECRET": "check", "GEMINI_API_KEY": "check",
+                            "BASE_URL": "http://127.0.0.1", "TRACE_SAMPLE_RATE": "0", "LOG_LEVEL": "WARNING",
+                            "GEMINI_API_BASE": f"{upstream_url}/v1beta", "PROMPT_CACHE_ENABLED": "1"}.items():
+            os.environ[name] = value
+        import app
+
+        cache = app.prompt_prefix_cache
+        history = app.get_conversation_history("Ucheck") + [{"role": "user", "parts": [{"text": "小雲在做什麼呢？"}]}]
+        payload = {"contents": history}
+
+        app.call_gemini("chat_text", payload, timeout=10)
+        _check(cache.stats["misses"] == 1 and cache.stats["hits"] == 0, "第一次請求送完整 payload，背景建立快取")
+        _check(_wait_until(lambda: any(e["state"] == "ready" for e in cache.entries.values())), "快取已建立")
+
+        upstream_stats = _stats(upstream_url)
+        for _ in range(args.requests):
+            app.call_gemini("chat_text", payload, timeout=10)
+        after = _stats(upstream_url)
+        _check(after["generate_cached"] - upstream_stats["generate_cached"] == args.requests, f"{args.requests} 次請求都帶 cachedContent")
+        _check(after["cache_create"] == 1, "同一個模型與角色設定只建立一次快取")
+
+        requests.post(f"{upstream_url}/_cache/clear", timeout=5)
+        result = app.call_gemini("chat_text", payload, timeout=10)
+        _check(bool(app._extract_gemini_text(result)) and cache.stats["fallbacks"] == 1, "快取失效時退回完整 payload 並成功回覆")
+        app.call_gemini("chat_text", payload, timeout=10)
+        _check(_wait_until(lambda: _stats(upstream_url)["cache_create"] == 2), "失效後重新建立快取")
+
+        # 把到期時間往前調，下一個請求應觸發 PATCH 延長 TTL
+        _wait_until(lambda: any(e["state"] == "ready" for e in cache.entries.values()))
+        for entry in cache.entries.values():
+            entry["expires_at"] = time.time() + cache.refresh_margin_seconds - 1
+        app.call_gemini("chat_text", payload, timeout=10)
+        _check(_wait_until(lambda: _stats(upstream_url)["cache_update"] == 1), "快到期時延長 TTL")
+
+        status = cache.status()
+        print()
+        print(f"{'hits':>6} {'misses':>6} {'fallbacks':>9} {'cached tokens':>14} {'uncached tokens':>16} {'cached ratio':>12}")
+        print(f"{status['hits']:>6} {status['misses']:>6} {status['fallbacks']:>9} {status['cached_prompt_tokens']:>14} "
+              f"{status['uncached_prompt_tokens']:>16} {status['cached_token_ratio']:>12}")
+        cache.close()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+def _ping(upstream_url):
+    try:
+        return requests.get(f"{upstream_url}/_stats", timeout=0.5).ok
+    except requests.RequestException:
+        return False
+
+
+def _stats(upstream_url):
+    return requests.get(f"{upstream_url}/_stats", timeout=5).json()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""列出每個 Gemini 任務實際送出的角色設定大小 (UTF-8 bytes 與估算 token)，以及各段落的大小。
+
+用法：python benchmarks/prompt_report.py
+"""
+import logging
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+# app.py 匯入時會檢查這些環境變數；報表不會真的呼叫任何 API
+for name, value in {"LINE_CHANNEL_ACCESS_TOKEN": "report", "LINE_CHANNEL_SECRET": "report", "GEMINI_API_KEY": "report",
+                    "BASE_URL": "http://127.0.0.1", "TRACE_SAMPLE_RATE": "0"}.items():
+    os.environ.setdefault(name, value)
+logging.disable(logging.ERROR)
+
+import app  # noqa: E402
+import token_budget  # noqa: E402
+
+
+def tokens(text):
+    return token_budget.ESTIMATOR.estimate_contents([{"parts": [{"text": text}]}]) - token_budget.MESSAGE_OVERHEAD_TOKENS
+
+
+def main():
+    full = app.ROLE_PROMPTS["chat"]
+    full_bytes = len(full.encode("utf-8"))
+    print(f"{'section':<20} {'bytes':>8} {'~tokens':>8}")
+    for name, text in app.ROLE_PROMPT_SECTIONS.items():
+        print(f"{name:<20} {len(text.encode('utf-8')):>8} {tokens(text):>8}")
+
+    print()
+    print(f"{'task':<16} {'bytes':>8} {'~tokens':>8} {'vs chat':>8}  sections")
+    for task, sections in app.ROLE_PROMPT_MANIFESTS.items():
+        prompt = app.ROLE_PROMPTS[task]
+        size = len(prompt.encode("utf-8"))
+        print(f"{task:<16} {size:>8} {tokens(prompt):>8} {size / full_bytes:>7.0%}  {', '.join(sections)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""量測每則文字訊息的路由成本：原本的 if/elif 觸發鏈 + 各關鍵字清單的 any() 掃描 vs. app.TEXT_ROUTER。
+
+訊息組合大致照實際流量：多數是一般聊天 (長短都有)，少數是 Rich Menu 觸發、每日任務與秘密請求。
+兩種做法算出來的意圖與「緊扣上文」用到的判斷必須一致，不一致時以非 0 結束。
+
+用法：
+    python benchmarks/router_bench.py --messages 200000
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+# app.py 匯入時會檢查這些環境變數；壓測不會真的呼叫任何 API
+for name, value in {"LINE_CHANNEL_ACCESS_TOKEN": "bench", "LINE_CHANNEL_SECRET": "bench", "GEMINI_API_KEY": "bench",
+                    "BASE_URL": "http://127.0.0.1", "TRACE_SAMPLE_RATE": "0", "PROMPT_CACHE_ENABLED": "0"}.items():
+    os.environ.setdefault(name, value)
+logging.disable(logging.ERROR)
+
+import app  # noqa: E402
+
+CHAT_MESSAGES = [
+    "早安", "晚安～", "摸摸頭", "嗯...", "嗯？", "然後呢", "哈哈哈", "好可憐", "真的嗎", "你在幹嘛",
+    "小雲今天吃了什麼？", "我買了鮪魚罐頭給你喔", "要不要吃點心", "外面下雨了耶，小雲在做什麼呢？",
+    "今天上班好累，老闆一直叫我加班，回到家只想躺著什麼都不做", "我跟你說喔，今天在路上看到一隻很像你的黑白貓，牠一直盯著我看",
+    "Hello 小雲", "1", "2",
+]
+SECRET_MESSAGES = ["小雲有什麼秘密嗎？", "告訴我你的新發現", "你最近發現了什麼"]
+
+
+def legacy_route(user_message):
+    """原本 handle_text_message 與 build_contextual_reminder 的判斷順序，回傳 (意圖, 標籤)。"""
+    daily_tasks = app.DAILY_TASKS
+    if user_message in daily_tasks:
+        return "daily_task", frozenset()
+    if user_message == app.TRIGGER_TEXT_GET_STATUS:
+        return "status_template", frozenset()
+    elif user_message == app.TRIGGER_TEXT_FEED_XIAOYUN_TEMPLATE:
+        return "feed_template", frozenset()
+    elif user_message == app.TRIGGER_TEXT_SECRET_TEMPLATE:
+        return "secret_template", frozenset()
+    elif user_message == app.TRIGGER_TEXT_INTERACTIVE_SCENARIO:
+        return "interactive_scenario", frozenset()
+    elif user_message == app.RICH_MENU_CMD_REQUEST_SECRET:
+        return "request_secret", frozenset()
+    elif user_message == app.RICH_MENU_CMD_FEED_ME_NOW:
+        return "feed_me_now", frozenset()
+    flags = set()
+    if user_message.strip().isdigit():
+        flags.add("numeric")
+    user_current_message_lower = user_message.lower()
+    if any(reply == user_current_message_lower.strip() for reply in ["嗯...", "嗯？", "喔...", "噢...", "真的嗎", "真的假的", "是喔", "好可憐", "好委屈", "秀秀", "乖乖"]):
+        flags.add("short_empathy")
+    if any(keyword in user_current_message_lower for keyword in ["鮪魚", "飯糰", "午餐", "罐頭", "魚", "肉", "零食", "吃", "飼料", "點心", "餵", "餓不餓", "要不要吃"]):
+        flags.add("food_mention")
+    if len(user_message.strip()) <= 5 and \
+       (user_message.strip().lower() in ["嗯", "嗯嗯", "嗯?", "嗯哼", "？", "?", "喔", "哦", "喔喔", "然後呢", "然後", "再來呢", "再來", "繼續", "還有嗎", "後來呢"] or
+        re.fullmatch(r"哈+", user_message.strip().lower()) or
+        re.fullmatch(r"呵+", user_message.strip().lower())):
+        flags.add("short_ack")
+    secret_topic = any(keyword in user_message for keyword in ["秘密", "發現"])
+    secret_question = ("嗎" in user_message or "?" in user_message or "？" in user_message or
+                       "是什麼" in user_message or "告訴我" in user_message or
+                       "說說" in user_message or "分享" in user_message)
+    intent = "secret_request" if secret_topic and secret_question and user_message != app.TRIGGER_TEXT_SECRET_TEMPLATE else "chat"
+    return intent, frozenset(flags)
+
+
+def router_route(user_message):
+    route = app.TEXT_ROUTER.route(user_message)
+    return route.intent, route.flags
+
+
+def build_corpus(count, seed=7):
+    rng = random.Random(seed)
+    commands = list(app.TEXT_COMMAND_INTENTS) + list(app.DAILY_TASKS)
+    corpus = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.1:
+            corpus.append(rng.choice(commands))
+        elif roll < 0.15:
+            corpus.append(rng.choice(SECRET_MESSAGES))
+        else:
+            corpus.append(rng.choice(CHAT_MESSAGES))
+    return corpus
+
+
+def measure(route, corpus):
+    started = time.perf_counter()
+    for message in corpus:
+        route(message)
+    return (time.perf_counter() - started) / len(corpus)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文字訊息路由的每則成本")
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages)
+    # 說明：secret_topic / secret_question 只是組成 secret_request 意圖的中間標籤，legacy 版沒有，不列入比對
+    def compared(result):
+        intent, flags = result
+        return intent, flags - {"secret_topic", "secret_question"}
+
+    mismatches = [message for message in set(corpus) if compared(legacy_route(message)) != compared(router_route(message))]
+    for message in mismatches:
+        print(f"MISMATCH {message!r}: legacy={legacy_route(message)} router={router_route(message)}")
+    if mismatches:
+        raise SystemExit(1)
+
+    hunger_reply = "咪～（尾巴輕輕晃了晃，把臉貼到窗戶上看雨）今天外面好多小鳥喔，小雲看到肚子都餓了 喵嗚～"
+    results = {
+        "legacy if/elif + any()": measure(legacy_route, corpus),
+        "TEXT_ROUTER.route": measure(router_route, corpus),
+    }
+    bot_legacy = measure(lambda _: any(keyword in hunger_reply for keyword in ["餓", "吃", "聞到好吃的", "肚子餓", "罐罐", "條條", "肉泥"]), corpus[:20000])
+    bot_pattern = measure(lambda _: app.BOT_HUNGER_PATTERN.search(hunger_reply), corpus[:20000])
+
+    print(f"{len(corpus)} messages, {len(set(corpus))} distinct, intents agree")
+    for name, seconds in results.items():
+        print(f"{name:<24} {seconds * 1e6:7.2f} µs/message  {1 / seconds:>12,.0f} messages/s")
+    print(f"{'bot reply hunger scan':<24} legacy {bot_legacy * 1e6:.2f} µs  pattern {bot_pattern * 1e6:.2f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""多個 worker 行程同時讀寫同一個 SQLite 狀態檔：量測每秒能處理幾則訊息 (讀幾次、寫幾列) 與每批寫入的耗時。
+
+每個行程模擬一個 gunicorn worker：一個 SqliteStateStore (背景延遲寫入照常跑) + 幾條請求執行緒。
+每則「訊息」照 app 的實際用法：prepare() + get() 兩次 (路由判斷、組歷史) + 寫入一輪對話；用戶從 --users 位裡隨機挑，
+所以同一位用戶的訊息會落在不同 worker 上 (跨 worker 的重新載入與寫入衝突都會出現)。
+--rates 是要壓的總訊息量 (則/秒，0 = 不限速、看上限)，每個量各跑一輪、用新的資料庫。
+每輪印出實際達到的訊息 / 讀取 / 寫入吞吐、get() 的 p50 / p99 (含 prepare() 與等鎖)、快取命中率、衝突數與寫入批次耗時。
+最後把 DB 裡每位用戶的 version (每寫一輪加一) 加總，跟事先寫入的輪數 + 送出的訊息數比對，確認撞到時沒有丟掉任何一輪。
+
+用法：
+    python benchmarks/state_store_bench.py --workers 4 --threads 8 --seconds 10 --users 20000 --rates 100,1000,5000,0
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import state_store  # noqa: E402
+import token_budget  # noqa: E402
+import turn_metadata  # noqa: E402
+import user_state  # noqa: E402
+import user_state_memory  # noqa: E402
+
+# 說明：衝突時每位用戶會記一行 warning，壓測只看最後的統計
+logging.disable(logging.WARNING)
+
+
+def run_worker(path, args, rate, results):
+    lock = threading.RLock()
+    store = state_store.SqliteStateStore(lock, user_state_memory.PERSONA_HEAD, user_state_memory.MAX_TURNS, path=path,
+                                         flush_ms=args.flush_ms, validate_seconds=args.validate_seconds)
+    store.start()
+    bot_response = json.dumps([{"type": "text", "content": "咪～小雲聽到了"}, {"type": "sticker", "keyword": "開心"}], ensure_ascii=False)
+    started = time.monotonic()
+    deadline = started + args.seconds
+    # 說明：每條執行緒照固定間隔送訊息 (rate = 0 時不等)
+    interval = args.workers * args.threads / rate if rate else 0
+    counts = {"messages": 0, "gets": 0}
+    latencies = []
+    counts_lock = threading.Lock()
+
+    def request_loop(seed):
+        rng = random.Random(seed)
+        messages, thread_latencies = 0, []
+        next_at = started + rng.random() * interval
+        while (now := time.monotonic()) < deadline:
+            if next_at > now:
+                time.sleep(next_at - now)
+            next_at += interval
+            user_id = f"U{rng.randrange(args.users):032d}"
+            user_text = f"用戶說：今天的第 {messages} 件事"
+            record = turn_metadata.build_turn_record([{"text": user_text}], bot_response, "text", token_budget.ESTIMATOR)
+            get_started = time.perf_counter()
+            store.prepare(user_id)
+            with lock:
+                store.get(user_id)
+            thread_latencies.append(time.perf_counter() - get_started)
+            store.prepare(user_id)
+            with lock:
+                if (state := store.get(user_id)) is None:
+                    state = store[user_id] = user_state.UserState(user_state_memory.PERSONA_HEAD)
+                state.push_turn([{"text": user_text}], bot_response, record, user_state_memory.MAX_TURNS)
+            messages += 1
+        with counts_lock:
+            counts["messages"] += messages
+            counts["gets"] += messages * 2
+            latencies.extend(thread_latencies)
+
+    threads = [threading.Thread(target=request_loop, args=(os.getpid() * 100 + index,)) for index in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 說明：最後一批可能還在跟別的 worker 撞，寫到沒有待寫的改動為止
+    while store.status()["pending_writes"]:
+        store.flush()
+    results.put(counts | store.status() | {"latencies": latencies})
+
+
+def run_rate(args, rate):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "user_state.sqlite3")
+        # 說明：先建好資料表並放進所有用戶 (各幾輪對話)，量的是已經在線上跑一陣子的資料庫，而不是全是新用戶
+        seed = state_store.SqliteStateStore(threading.RLock(), user_state_memory.PERSONA_HEAD, user_state_memory.MAX_TURNS, path=path)
+        for index, user_turns in enumerate(user_state_memory.build_turns(args.users, args.seed_turns)):
+            state = seed[f"U{index:032d}"] = user_state.UserState(user_state_memory.PERSONA_HEAD)
+            for user_text, bot_response, record in user_turns:
+                state.push_turn([{"text": user_text}], bot_response, record, user_state_memory.MAX_TURNS)
+        seed.flush()
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_worker, args=(path, args, rate, results)) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        stats = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        with sqlite3.connect(path) as connection:
+            stored_turns = sum(json.loads(zlib.decompress(data))["version"] for data, in connection.execute("SELECT data FROM user_state"))
+    return stats, stored_turns - args.users * args.seed_turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite 狀態儲存的多 worker 讀寫吞吐")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="每個 worker 的請求執行緒數")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rates", default="100,1000,5000,0", help="總訊息量 (則/秒)，逗號分隔；0 = 不限速")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--seed-turns", type=int, default=6, help="事先寫進資料庫的每位用戶對話輪數")
+    parser.add_argument("--flush-ms", type=int, default=state_store.USER_STATE_FLUSH_MS)
+    parser.add_argument("--validate-seconds", type=float, default=state_store.USER_STATE_VALIDATE_SECONDS)
+    args = parser.parse_args()
+
+    print(f"{args.workers} workers x {args.threads} threads, {args.users} users, {args.seconds:.0f}s per rate, "
+          f"flush every {args.flush_ms} ms, validate after {args.validate_seconds}s")
+    for rate in (int(value) for value in args.rates.split(",")):
+        stats, stored_turns = run_rate(args, rate)
+
+        def total(key):
+            return sum(stat[key] for stat in stats)
+
+        seconds = args.seconds
+        latencies = sorted(latency for stat in stats for latency in stat["latencies"])
+        print(f"offered {rate or 'unlimited'} msg/s")
+        print(f"  messages     {total('messages') / seconds:>10,.0f} /s  get() p50 {latencies[len(latencies) // 2] * 1e6:.0f} µs  "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.0f} µs")
+        print(f"  get()        {total('gets') / seconds:>10,.0f} /s  cache hits {total('cache_hits') / total('gets'):.1%}, "
+              f"db reads {total('db_reads') / seconds:,.0f} /s, validations {total('validations') / seconds:,.0f} /s, "
+              f"in lock {total('locked_reads')}")
+        print(f"  rows written {total('writes') / seconds:>10,.0f} /s  in {total('flushes') / seconds:,.0f} flushes/s, "
+              f"conflicts {total('conflicts')} ({total('conflicts') / max(1, total('writes') + total('conflicts')):.2%}), "
+              f"rebased {total('rebased')}, flush failures {total('flush_failed')}")
+        print(f"  turns        sent {total('messages'):,}  stored {stored_turns:,}  lost {total('messages') - stored_turns:,}")
+        print(f"  flush        avg {sum(stat['avg_flush_ms'] or 0 for stat in stats) / len(stats):.2f} ms  "
+              f"max {max(stat['max_flush_ms'] or 0 for stat in stats):.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""量測冷熱分層省下的記憶體與還原耗時：同一批用戶全部留在熱層 vs. 全部轉入冷層 (memory / file 模式)。
+
+用戶資料沿用 user_state_memory.py 的產生方式，但每位用戶的文字各自持有 (冷層會把它們一起壓縮掉)。
+熱層用 tracemalloc 量 UserState 本身；冷層量壓縮後留在記憶體的 bytes (file 模式只剩檔案大小的 int)。
+還原耗時是對抽樣用戶逐一 get() 的時間，file 模式包含讀檔。
+
+用法：
+    python benchmarks/tiered_state_bench.py --users 20000 --turns 6
+"""
+import argparse
+import gc
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import tiered_state  # noqa: E402
+import user_state_memory  # noqa: E402
+
+
+def build_store(data, cold_mode, spill_dir):
+    store = tiered_state.TieredUserStates(threading.RLock(), user_state_memory.PERSONA_HEAD, user_state_memory.MAX_TURNS,
+                                          idle_seconds=0, cold_mode=cold_mode, spill_dir=spill_dir)
+    states = user_state_memory.build_user_states(data, random.Random(1), 0.1, 0.1, {"text": "（小雲記得關於這位主人的事：主人喜歡晚上聊天）"})
+    with store.lock:
+        for user_id, state in states.items():
+            store[user_id] = state
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用戶狀態冷熱分層的記憶體與還原耗時")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--samples", type=int, default=2000)
+    args = parser.parse_args()
+
+    for cold_mode in ("memory", "file"):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            gc.collect()
+            tracemalloc.start()
+            store = build_store(user_state_memory.build_turns(args.users, args.turns), cold_mode, spill_dir)
+            hot_bytes, _ = tracemalloc.get_traced_memory()
+            started = time.perf_counter()
+            store.sweep()
+            sweep_seconds = time.perf_counter() - started
+            gc.collect()
+            cold_bytes, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            latencies = []
+            for user_id in random.Random(2).sample(list(store.cold), min(args.samples, len(store.cold))):
+                started = time.perf_counter()
+                with store.lock:
+                    store.get(user_id)
+                latencies.append(time.perf_counter() - started)
+            latencies.sort()
+            status = store.status()
+            print(f"[{cold_mode}] {args.users} users, {args.turns} turns each")
+            print(f"  all hot   {hot_bytes / args.users:8.0f} bytes/user  ({hot_bytes / 2**20:.1f} MiB traced)")
+            print(f"  all cold  {cold_bytes / args.users:8.0f} bytes/user  ({cold_bytes / 2**20:.1f} MiB traced, "
+                  f"{status['cold_bytes'] / args.users:.0f} compressed bytes/user)  saved {1 - cold_bytes / hot_bytes:.1%}")
+            print(f"  sweep     {sweep_seconds / args.users * 1e6:8.1f} µs/user")
+            print(f"  rehydrate p50 {statistics.median(latencies) * 1e6:.1f} µs  "
+                  f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1e6:.1f} µs  max {latencies[-1] * 1e6:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
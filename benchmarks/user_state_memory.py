@@ -0,0 +1,126 @@
+"""量測每位用戶的狀態佔多少記憶體：原本分散的幾個 dict (對話歷史列表 + 每輪摘要列表 + 秘密索引 set + 互動情境 dict) vs. user_state.UserState。
+
+兩種做法共用同一批文字與 TurnRecord (事先建好、不列入量測)，所以量到的是「容器本身」的開銷：
+歷史裡每則訊息的 dict / parts 列表、每位用戶的開頭兩則、set 與 dict 的雜湊表等。
+另外也量一次組出 Gemini contents 的時間 (原本是 list.copy()，現在每次由環狀緩衝區組出來)。
+
+用法：
+    python benchmarks/user_state_memory.py --users 100000 --turns 6
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import token_budget  # noqa: E402
+import turn_metadata  # noqa: E402
+import user_state  # noqa: E402
+
+ROLE_PROMPT = "你是小雲，一隻害羞、溫和有禮、充滿好奇心的賓士公貓。" * 400
+INITIAL_RESPONSE = '[{"type": "text", "content": "咪...？"}, {"type": "sticker", "keyword": "害羞"}]'
+PERSONA_HEAD = (
+    {"role": "user", "parts": [{"text": ROLE_PROMPT}]},
+    {"role": "model", "parts": [{"text": INITIAL_RESPONSE}]},
+)
+SECRET_COUNT = 24
+MAX_TURNS = 20
+
+
+def build_turns(users, turns):
+    # 說明：每位用戶各自的文字 (內容不同的字串物件) 與 TurnRecord，兩種做法共用
+    data = []
+    for index in range(users):
+        user_turns = []
+        for turn in range(turns):
+            user_text = f"用戶說：今天第 {turn} 件事是關於用戶 {index} 的小故事"
+            bot_response = json.dumps([{"type": "text", "content": f"咪～小雲聽到了 {index}-{turn}"}, {"type": "sticker", "keyword": "開心"}],
+                                      ensure_ascii=False)
+            record = turn_metadata.build_turn_record([{"text": user_text}], bot_response, "text", token_budget.ESTIMATOR)
+            user_turns.append((user_text, bot_response, record))
+        data.append(user_turns)
+    return data
+
+
+def build_legacy(data, rng, note_ratio, scenario_ratio, note_part):
+    conversation_memory, turn_records, shared_secrets, scenario_context = {}, {}, {}, {}
+    for index, user_turns in enumerate(data):
+        user_id = f"U{index:032d}"
+        head_parts = [{"text": ROLE_PROMPT}, note_part] if rng.random() < note_ratio else [{"text": ROLE_PROMPT}]
+        history = [{"role": "user", "parts": head_parts}, {"role": "model", "parts": [{"text": INITIAL_RESPONSE}]}]
+        for user_text, bot_response, _ in user_turns:
+            history += [{"role": "user", "parts": [{"text": user_text}]}, {"role": "model", "parts": [{"text": bot_response}]}]
+        conversation_memory[user_id] = history
+        turn_records[user_id] = [record for _, _, record in user_turns]
+        shared_secrets[user_id] = set(rng.sample(range(SECRET_COUNT), rng.randint(0, 6)))
+        if rng.random() < scenario_ratio:
+            scenario_context[user_id] = {"last_scenario_text": "情境", "last_scenario_sticker": "開心"}
+    return conversation_memory, turn_records, shared_secrets, scenario_context
+
+
+def build_user_states(data, rng, note_ratio, scenario_ratio, note_part):
+    states = {}
+    for index, user_turns in enumerate(data):
+        user_id = f"U{index:032d}"
+        state = user_state.UserState(PERSONA_HEAD)
+        if rng.random() < note_ratio:
+            state.head = ({"role": "user", "parts": [PERSONA_HEAD[0]["parts"][0], note_part]}, PERSONA_HEAD[1])
+        for user_text, bot_response, record in user_turns:
+            state.push_turn([{"text": user_text}], bot_response, record, MAX_TURNS)
+        for secret in rng.sample(range(SECRET_COUNT), rng.randint(0, 6)):
+            state.mark_secret_shared(secret)
+        if rng.random() < scenario_ratio:
+            state.set_scenario("情境", "開心")
+        states[user_id] = state
+    return states
+
+
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    structure = build(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return structure, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description="每位用戶狀態的記憶體開銷")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--note-ratio", type=float, default=0.1)
+    parser.add_argument("--scenario-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    data = build_turns(args.users, args.turns)
+    # 說明：user_id 字串與外層 dict 兩邊各配置一份，都算在結果裡
+    note_part = {"text": "（小雲記得關於這位主人的事：主人喜歡晚上聊天）"}
+    legacy, legacy_bytes = measure(build_legacy, data, random.Random(1), args.note_ratio, args.scenario_ratio, note_part)
+    states, state_bytes = measure(build_user_states, data, random.Random(1), args.note_ratio, args.scenario_ratio, note_part)
+
+    print(f"{args.users} users, {args.turns} turns each (text and TurnRecords shared, not counted)")
+    print(f"legacy dicts  {legacy_bytes / args.users:8.0f} bytes/user  ({legacy_bytes / 2**20:.1f} MiB)")
+    print(f"UserState     {state_bytes / args.users:8.0f} bytes/user  ({state_bytes / 2**20:.1f} MiB)")
+    print(f"saved         {1 - state_bytes / legacy_bytes:8.1%}")
+
+    conversation_memory = legacy[0]
+    sample_ids = list(states)[:10000]
+    started = time.perf_counter()
+    for user_id in sample_ids:
+        conversation_memory[user_id].copy()
+    legacy_read = (time.perf_counter() - started) / len(sample_ids)
+    started = time.perf_counter()
+    for user_id in sample_ids:
+        states[user_id].history()
+    state_read = (time.perf_counter() - started) / len(sample_ids)
+    print(f"history read  legacy .copy() {legacy_read * 1e6:.2f} µs  UserState.history() {state_read * 1e6:.2f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""比較 gunicorn sync / gthread / gevent worker 在同一份錄製 webhook 負載下的表現。
+
+流程：
+1. 啟動 fake_upstream.py 模擬 Gemini 與 LINE API (可設定延遲)。
+2. 依序以三種 worker 啟動 gunicorn (app:app)，環境變數讓 app.py 指向替身伺服器。
+3. 將 recorded_webhooks.jsonl 以固定併發數重播到 /callback (附正確簽章)，
+   記錄每個 webhook 從送出到 200 的時間 (Flask 入口會在回應前完成整個回覆流程)。
+4. 輸出吞吐量、p50/p95/p99、錯誤數，以及 gunicorn worker 平均每個 webhook 花掉的 CPU 時間 (Linux 讀 /proc)。
+
+用法：
+    python benchmarks/worker_bench.py --workers 2 --concurrency 100 --repeat 3
+    python benchmarks/worker_bench.py --modes gevent --gemini-latency 1.5
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+CHANNEL_SECRET = "bench-channel-secret"
+
+
+def load_webhooks(path, repeat):
+    with open(path, encoding="utf-8") as f:
+        bodies = [json.loads(line) for line in f if line.strip()]
+    replayed = []
+    for round_no in range(repeat):
+        for body in bodies:
+            body = json.loads(json.dumps(body))
+            for event in body["events"]:
+                event["replyToken"] = f"{event['replyToken']}-{round_no}"
+            replayed.append(json.dumps(body, ensure_ascii=False).encode("utf-8"))
+    return replayed
+
+
+def sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def wait_for_http(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def replay(base_url, bodies, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+    timeout = aiohttp.ClientTimeout(total=300)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async def send(body):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(f"{base_url}/callback", data=body, headers={
+                        "Content-Type": "application/json",
+                        "X-Line-Signature": sign(body),
+                    }) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            errors += 1
+                            return
+                except Exception:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(body) for body in bodies))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def workers_cpu_seconds(master_pid):
+    """gunicorn master 底下所有 worker 累計的 user+system CPU 秒數；非 Linux 回傳 None。"""
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+            worker_pids = f.read().split()
+        total_ticks = 0
+        for pid in worker_pids:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total_ticks += int(fields[11]) + int(fields[12])  # utime, stime
+        return total_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def start_gunicorn(mode, args, upstream, log_file):
+    state_path = os.path.join(args.log_dir, f"user_state-{mode}.sqlite3")
+    for path in (state_path, state_path + "-wal", state_path + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    env = dict(os.environ)
+    env.update({
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "GEMINI_API_KEY": "bench-key",
+        "BASE_URL": "http://127.0.0.1",
+        "GEMINI_API_BASE": f"{upstream}/v1beta",
+        "LINE_API_ENDPOINT": upstream,
+        "LINE_DATA_API_ENDPOINT": upstream,
+        "PEXELS_API_KEY": "",
+        "UNSPLASH_ACCESS_KEY": "",
+        "PORT": str(args.port),
+        "WEB_CONCURRENCY": str(args.workers),
+        # 說明：多個 worker 要共用用戶狀態才跟正式部署一樣；每種模式各用一個新的 SQLite 檔
+        "USER_STATE_BACKEND": "sqlite",
+        "USER_STATE_SQLITE_PATH": state_path,
+    })
+    cmd = [sys.executable, "-m", "gunicorn", "--log-level", "warning", "--timeout", "300"]
+    if mode == "sync":
+        cmd += ["-k", "sync", "-w", str(args.workers), "-b", f"127.0.0.1:{args.port}"]
+    elif mode == "gthread":
+        env["HTTP_POOL_MAXSIZE"] = str(args.threads)
+        cmd += ["-k", "gthread", "--threads", str(args.threads), "-w", str(args.workers), "-b", f"127.0.0.1:{args.port}"]
+    elif mode == "gevent":
+        env["GEVENT_WORKER_CONNECTIONS"] = str(args.gevent_connections)
+        cmd += ["-c", os.path.join(ROOT, "gunicorn_gevent.conf.py"), "-b", f"127.0.0.1:{args.port}"]
+    else:
+        raise ValueError(f"unknown worker mode: {mode}")
+    cmd.append("app:app")
+    # 說明：app 以 INFO 等級記錄每則訊息，stderr 必須導到檔案，用 PIPE 又不讀會塞滿緩衝區讓 worker 卡住。
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=log_file)
+
+
+def stop(proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gunicorn worker 類型比較")
+    parser.add_argument("--modes", default="sync,gthread,gevent")
+    parser.add_argument("--webhooks", default=os.path.join(HERE, "recorded_webhooks.jsonl"))
+    parser.add_argument("--repeat", type=int, default=1, help="重播錄製負載的次數")
+    parser.add_argument("--concurrency", type=int, default=100, help="同時送出的 webhook 數")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=32, help="gthread 每個 worker 的執行緒數")
+    parser.add_argument("--gevent-connections", type=int, default=500)
+    parser.add_argument("--port", type=int, default=9920)
+    parser.add_argument("--upstream-port", type=int, default=9911)
+    parser.add_argument("--gemini-latency", type=float, default=0.8)
+    parser.add_argument("--line-latency", type=float, default=0.05)
+    parser.add_argument("--log-dir", default=os.path.join(HERE, "logs"), help="gunicorn 輸出的存放位置")
+    args = parser.parse_args()
+
+    bodies = load_webhooks(args.webhooks, args.repeat)
+    os.makedirs(args.log_dir, exist_ok=True)
+    upstream = f"http://127.0.0.1:{args.upstream_port}"
+    fake = subprocess.Popen([
+        sys.executable, os.path.join(HERE, "fake_upstream.py"), "--port", str(args.upstream_port),
+        "--gemini-latency", str(args.gemini_latency), "--line-latency", str(args.line_latency),
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        if not wait_for_http(f"{upstream}/_stats"):
+            raise SystemExit("fake_upstream 無法啟動")
+        for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+            urllib.request.urlopen(urllib.request.Request(f"{upstream}/_stats/reset", method="POST")).read()
+            log_path = os.path.join(args.log_dir, f"gunicorn-{mode}.log")
+            with open(log_path, "wb") as log_file:
+                proc = start_gunicorn(mode, args, upstream, log_file)
+                try:
+                    if not wait_for_http(f"http://127.0.0.1:{args.port}/"):
+                        raise SystemExit(f"gunicorn ({mode}) 無法啟動，請查看 {log_path}")
+                    cpu_before = workers_cpu_seconds(proc.pid)
+                    latencies, errors, elapsed = asyncio.run(replay(f"http://127.0.0.1:{args.port}", bodies, args.concurrency))
+                    cpu_after = workers_cpu_seconds(proc.pid)
+                    upstream_stats = json.loads(urllib.request.urlopen(f"{upstream}/_stats").read())
+                finally:
+                    stop(proc)
+            results.append({
+                "mode": mode,
+                "requests": len(bodies),
+                "errors": errors,
+                "elapsed_s": round(elapsed, 2),
+                "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+                "p50_ms": round(percentile(latencies, 50) * 1000),
+                "p95_ms": round(percentile(latencies, 95) * 1000),
+                "p99_ms": round(percentile(latencies, 99) * 1000),
+                "mean_ms": round(statistics.mean(latencies) * 1000) if latencies else None,
+                "cpu_ms_per_req": round((cpu_after - cpu_before) * 1000 / len(bodies), 2) if cpu_before is not None and cpu_after is not None else None,
+                "line_replies": upstream_stats["reply"],
+                "gemini_calls": upstream_stats["generate"],
+            })
+            print(json.dumps(results[-1], ensure_ascii=False), flush=True)
+    finally:
+        stop(fake)
+
+    print()
+    print(f"{'mode':<8} {'req':>5} {'err':>4} {'rps':>7} {'p50':>7} {'p95':>7} {'p99':>7} {'replies':>8} {'cpu/req':>9}")
+    for r in results:
+        print(f"{r['mode']:<8} {r['requests']:>5} {r['errors']:>4} {r['throughput_rps']:>7} "
+              f"{r['p50_ms']:>6}ms {r['p95_ms']:>6}ms {r['p99_ms']:>6}ms {r['line_replies']:>8} {r['cpu_ms_per_req']!s:>7}ms")
+
+
+if __name__ == "__main__":
+    main()
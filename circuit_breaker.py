@@ -0,0 +1,181 @@
+"""外部依賴 (Gemini、Pexels、Unsplash、貼圖 CDN) 的斷路器：依賴出問題時直接跳過，不必每次都等到逾時。
+
+- 每個依賴保留最近 BREAKER_WINDOW 次呼叫的 (失敗與否, 是否過慢)；至少 BREAKER_MIN_CALLS 次後，
+  失敗率 ≥ BREAKER_FAILURE_RATE 或過慢比例 ≥ BREAKER_SLOW_RATE 就打開 (open)。
+- 失敗：逾時、連線錯誤、5xx 與 429；其他 4xx (例如圖片 404) 是請求本身的問題，不列入計算。
+- 打開 BREAKER_OPEN_SECONDS 秒後進入半開 (half_open)，只放 BREAKER_HALF_OPEN_PROBES 個試探請求；
+  全部成功就關上 (closed)，任何一個失敗就再打開。
+- 被擋下的呼叫拋出 CircuitOpenError (requests 的 ConnectionError 子類別，沿用既有的錯誤處理)；
+  要整段跳過的呼叫端 (例如圖片搜尋) 先用 available() 檢查。
+"""
+import collections
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "2"))
+
+# 依賴: 超過幾秒算過慢
+SLOW_CALL_SECONDS = {
+    "gemini": 20.0,
+    "pexels": 5.0,
+    "unsplash": 5.0,
+    "sticker_cdn": 3.0,
+}
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_STATE = metrics.REGISTRY.gauge(
+    "xiaoyun_circuit_breaker_state", "斷路器狀態 (0 = closed, 1 = half_open, 2 = open)", ("dependency",))
+BREAKER_TRANSITIONS = metrics.REGISTRY.counter(
+    "xiaoyun_circuit_breaker_transitions_total", "斷路器狀態轉換次數，依轉換後的狀態區分", ("dependency", "state"))
+BREAKER_REJECTIONS = metrics.REGISTRY.counter(
+    "xiaoyun_circuit_breaker_rejections_total", "斷路器打開時直接擋下的呼叫次數", ("dependency",))
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    def __init__(self, dependency):
+        super().__init__(f"circuit breaker for {dependency} is open")
+        self.dependency = dependency
+
+
+def is_failure(exc):
+    """逾時、連線錯誤、5xx、429 算依賴失敗；其他 4xx 是請求本身的問題，回傳 False。"""
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None) or getattr(exc, "status", None)
+    if isinstance(status, int) and status < 500 and status != 429:
+        return False
+    return True
+
+
+class CircuitBreaker:
+    def __init__(self, name, slow_call_seconds, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, slow_rate=BREAKER_SLOW_RATE, open_seconds=BREAKER_OPEN_SECONDS,
+                 half_open_probes=BREAKER_HALF_OPEN_PROBES, clock=time.monotonic):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        # 說明：打開時間與呼叫耗時都用這個時鐘量 (測試可以換成手動前進的時鐘)
+        self.clock = clock
+        self.state = CLOSED
+        self._calls = collections.deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probes_started = 0
+        self._probes_succeeded = 0
+        self._lock = threading.Lock()
+        BREAKER_STATE.labels(name).set(0)
+
+    def _transition(self, state):
+        # 說明：呼叫端已持有 self._lock
+        self.state = state
+        if state == OPEN:
+            self._opened_at = self.clock()
+        elif state == HALF_OPEN:
+            self._probes_started = self._probes_succeeded = 0
+        else:
+            self._calls.clear()
+        BREAKER_STATE.labels(self.name).set(_STATE_VALUES[state])
+        BREAKER_TRANSITIONS.labels(self.name, state).inc()
+        logger.warning("斷路器 %s 轉為 %s。", self.name, state)
+
+    def available(self):
+        """不佔用試探名額，只回報現在是否值得呼叫這個依賴 (打開且還沒到半開時間時回傳 False)。"""
+        return self.state != OPEN or self.clock() - self._opened_at >= self.open_seconds
+
+    def acquire(self):
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self._opened_at < self.open_seconds:
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes_started >= self.half_open_probes:
+                    return False
+                self._probes_started += 1
+            return True
+
+    def record(self, ok, seconds):
+        """ok 為 None 時只歸還半開的試探名額，不列入失敗率。"""
+        slow = seconds >= self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if ok is None:
+                    self._probes_started -= 1
+                elif not ok or slow:
+                    self._transition(OPEN)
+                else:
+                    self._probes_succeeded += 1
+                    if self._probes_succeeded >= self.half_open_probes:
+                        self._transition(CLOSED)
+                return
+            if ok is None or self.state != CLOSED:
+                return
+            self._calls.append((not ok, slow))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._calls if failed)
+            slow_calls = sum(1 for _, is_slow in self._calls if is_slow)
+            if failures >= self.failure_rate * len(self._calls) or slow_calls >= self.slow_rate * len(self._calls):
+                self._transition(OPEN)
+
+    @contextmanager
+    def track(self):
+        """with BREAKERS["pexels"].track(): ... ；打開時拋出 CircuitOpenError，否則依結果記錄一次呼叫。"""
+        if not self.acquire():
+            BREAKER_REJECTIONS.labels(self.name).inc()
+            raise CircuitOpenError(self.name)
+        started = self.clock()
+        try:
+            yield
+        except Exception as e:
+            self.record(False if is_failure(e) else None, self.clock() - started)
+            raise
+        except BaseException:
+            # 說明：被取消 (例如對沖輸掉的那份) 不代表依賴有問題
+            self.record(None, 0.0)
+            raise
+        self.record(True, self.clock() - started)
+
+    def status(self):
+        with self._lock:
+            calls = list(self._calls)
+            state = self.state
+            open_remaining = max(0.0, self.open_seconds - (self.clock() - self._opened_at)) if state == OPEN else 0.0
+        return {
+            "state": state,
+            "recent_calls": len(calls),
+            "failure_rate": round(sum(1 for failed, _ in calls if failed) / len(calls), 3) if calls else None,
+            "slow_rate": round(sum(1 for _, slow in calls if slow) / len(calls), 3) if calls else None,
+            "slow_call_seconds": self.slow_call_seconds,
+            "open_remaining_seconds": round(open_remaining, 1),
+            "rejected": BREAKER_REJECTIONS.labels(self.name).value,
+        }
+
+
+BREAKERS = {name: CircuitBreaker(name, seconds) for name, seconds in SLOW_CALL_SECONDS.items()}
+
+
+def available(*names):
+    return all(BREAKERS[name].available() for name in names)
+
+
+def status():
+    return {name: breaker.status() for name, breaker in BREAKERS.items()}
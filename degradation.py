@@ -0,0 +1,153 @@
+"""過載降級：Gemini 塞車、太慢或斷路器打開時，聊天訊息直接用 data/degraded_responses.json 裡預先寫好的小雲回覆。
+
+- 進入條件 (任一)：Gemini 斷路器打開、進行中的 Gemini 請求數 ≥ DEGRADE_MAX_GEMINI_INFLIGHT、
+  最近 DEGRADE_LATENCY_WINDOW_SECONDS 秒內聊天請求耗時的 p90 ≥ DEGRADE_LATENCY_SLO_SECONDS。
+- 進入後至少維持 DEGRADE_HOLD_SECONDS 秒；期間仍放 DEGRADE_PROBE_RATE 比例的訊息走 Gemini，延遲樣本才會更新。
+- 回覆依關鍵字意圖分類挑選 (每個意圖有多組回覆，隨機挑一組)；圖片 / 貼圖 / 語音依訊息種類挑。
+- 降級回覆不呼叫 Gemini (快速回覆選項也是預先寫好的)。DEGRADED_HISTORY=skip (預設) 時不寫入對話歷史，
+  =record 時以 message_type "degraded" 寫入；每次送出都記在 xiaoyun_degraded_responses_total 與日誌。
+"""
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import circuit_breaker
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEGRADE_ENABLED = os.getenv("DEGRADE_ENABLED", "1") == "1"
+DEGRADE_MAX_GEMINI_INFLIGHT = int(os.getenv("DEGRADE_MAX_GEMINI_INFLIGHT", "48"))
+DEGRADE_LATENCY_SLO_SECONDS = float(os.getenv("DEGRADE_LATENCY_SLO_SECONDS", "12"))
+DEGRADE_LATENCY_WINDOW_SECONDS = float(os.getenv("DEGRADE_LATENCY_WINDOW_SECONDS", "60"))
+DEGRADE_MIN_SAMPLES = int(os.getenv("DEGRADE_MIN_SAMPLES", "10"))
+DEGRADE_HOLD_SECONDS = float(os.getenv("DEGRADE_HOLD_SECONDS", "30"))
+DEGRADE_PROBE_RATE = float(os.getenv("DEGRADE_PROBE_RATE", "0.05"))
+DEGRADED_HISTORY = os.getenv("DEGRADED_HISTORY", "skip")
+SLO_TASKS = frozenset({"chat_text", "chat_image", "chat_sticker", "chat_audio"})
+
+DEGRADED_MODE = metrics.REGISTRY.gauge("xiaoyun_degraded_mode", "是否處於過載降級模式 (0 / 1)")
+DEGRADED_TRANSITIONS = metrics.REGISTRY.counter(
+    "xiaoyun_degraded_mode_transitions_total", "進入 / 離開降級模式的次數，依原因區分", ("reason",))
+DEGRADED_RESPONSES = metrics.REGISTRY.counter(
+    "xiaoyun_degraded_responses_total", "降級模式下送出的預先寫好的回覆，依訊息種類與意圖區分", ("kind", "intent"))
+
+
+class DegradationController:
+    def __init__(self, gemini_inflight, enabled=DEGRADE_ENABLED, max_inflight=DEGRADE_MAX_GEMINI_INFLIGHT,
+                 latency_slo=DEGRADE_LATENCY_SLO_SECONDS, window_seconds=DEGRADE_LATENCY_WINDOW_SECONDS,
+                 min_samples=DEGRADE_MIN_SAMPLES, hold_seconds=DEGRADE_HOLD_SECONDS, probe_rate=DEGRADE_PROBE_RATE):
+        self.gemini_inflight = gemini_inflight
+        self.enabled = enabled
+        self.max_inflight = max_inflight
+        self.latency_slo = latency_slo
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.hold_seconds = hold_seconds
+        self.probe_rate = probe_rate
+        self.reason = None
+        self._degraded_until = 0.0
+        self._samples = collections.deque()
+        self._lock = threading.Lock()
+
+    def observe(self, task, seconds):
+        """記錄一次面向用戶的 Gemini 呼叫耗時 (失敗的也算，用戶一樣等了這麼久)。"""
+        if task in SLO_TASKS:
+            with self._lock:
+                self._samples.append((time.monotonic(), seconds))
+
+    def latency_p90(self):
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            while self._samples and self._samples[0][0] < cutoff:
+                self._samples.popleft()
+            latencies = sorted(seconds for _, seconds in self._samples)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+
+    def overload_reason(self):
+        """目前的過載訊號；沒有過載時回傳 None。"""
+        if not circuit_breaker.available("gemini"):
+            return "breaker_open"
+        if self.gemini_inflight() >= self.max_inflight:
+            return "queue_depth"
+        if (p90 := self.latency_p90()) is not None and p90 >= self.latency_slo:
+            return "latency_slo"
+        return None
+
+    def should_degrade(self):
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        reason = self.overload_reason()
+        with self._lock:
+            if reason:
+                if self.reason is None:
+                    DEGRADED_TRANSITIONS.labels(reason).inc()
+                    logger.warning("進入過載降級模式 (%s)，聊天訊息改用預先寫好的回覆。", reason)
+                self.reason = reason
+                self._degraded_until = now + self.hold_seconds
+            elif self.reason is not None and now >= self._degraded_until:
+                DEGRADED_TRANSITIONS.labels("recovered").inc()
+                logger.warning("離開過載降級模式 (原因: %s)。", self.reason)
+                self.reason = None
+            degraded = self.reason is not None
+        DEGRADED_MODE.labels().set(1 if degraded else 0)
+        # 說明：斷路器打開時本來就送不出去，不必放試探訊息
+        return degraded and (reason == "breaker_open" or random.random() >= self.probe_rate)
+
+    def status(self):
+        p90 = self.latency_p90()
+        return {"enabled": self.enabled, "degraded": self.reason is not None, "reason": self.reason,
+                "gemini_inflight": self.gemini_inflight(), "max_gemini_inflight": self.max_inflight,
+                "chat_latency_p90_seconds": round(p90, 3) if p90 is not None else None,
+                "latency_slo_seconds": self.latency_slo, "history": DEGRADED_HISTORY}
+
+
+class DegradedResponseLibrary:
+    def __init__(self, intents, kinds):
+        # 說明：intents 依檔案順序比對，分數相同時排前面的優先；沒有任何關鍵字命中時用 "default"
+        self.intents = intents
+        self.kinds = kinds
+
+    def classify(self, text):
+        text = (text or "").lower()
+        best_intent, best_score = "default", 0
+        for intent, entry in self.intents.items():
+            score = sum(1 for keyword in entry["keywords"] if keyword in text)
+            if score > best_score:
+                best_intent, best_score = intent, score
+        return best_intent
+
+    def pick(self, kind, text=""):
+        """回傳 (意圖, 回覆 JSON 字串, 快速回覆選項)。"""
+        if kind == "text":
+            intent = self.classify(text)
+            responses = self.intents[intent]["responses"]
+        else:
+            intent = kind
+            responses = self.kinds[kind]["responses"]
+        response_json, quick_replies = random.choice(responses)
+        DEGRADED_RESPONSES.labels(kind, intent).inc()
+        return intent, response_json, quick_replies
+
+
+def load_degraded_responses(path):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    def encode(entries):
+        return [(json.dumps(entry["response"], ensure_ascii=False), [option[:20] for option in entry.get("quick_replies", [])])
+                for entry in entries]
+
+    intents = {intent: {"keywords": [keyword.lower() for keyword in entry.get("keywords", [])], "responses": encode(entry["responses"])}
+               for intent, entry in data["intents"].items()}
+    kinds = {kind: {"responses": encode(entry["responses"])} for kind, entry in data.get("kinds", {}).items()}
+    if "default" not in intents:
+        raise KeyError("degraded responses need a 'default' intent")
+    return DegradedResponseLibrary(intents, kinds)
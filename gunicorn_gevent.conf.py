@@ -0,0 +1,45 @@
+# gunicorn -k gevent 部署設定
+# 使用方式：gunicorn -c gunicorn_gevent.conf.py app:app
+#
+# 說明：gevent worker 在載入 app 之前會 monkey-patch socket/ssl/threading，
+# 讓 requests (Gemini、Pexels、Unsplash、LINE SDK) 的阻塞呼叫全部變成協作式 I/O，
+# 一個 worker process 就能同時等待數百個外部回應。
+# 注意：不可開啟 preload_app，否則 app 會在 monkey-patch 之前被匯入，連線池與鎖都會是原生 (阻塞) 版本。
+import glob
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "gevent"
+# 說明：用戶狀態 (對話歷史、情境、秘密) 預設存在行程內，多個 worker 時同一位用戶的訊息會隨機落到不同的 worker、
+# 各看到一份不完整的狀態；這個設定檔預設改用所有 worker 共用的 SQLite 後端 (state_store.SqliteStateStore)。
+os.environ.setdefault("USER_STATE_BACKEND", "sqlite")
+workers = int(os.getenv("WEB_CONCURRENCY", max(2, multiprocessing.cpu_count()) if os.environ["USER_STATE_BACKEND"] == "sqlite" else 1))
+# 每個 worker 同時處理的 greenlet 上限
+worker_connections = int(os.getenv("GEVENT_WORKER_CONNECTIONS", "500"))
+preload_app = False
+
+# Gemini 的圖片/語音回應最長會等到 45 秒，再加上後續找圖與快速回覆
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# 說明：連線池大小要跟得上同時在跑的 greenlet 數量，否則超出的連線用完即丟、每次重新握手。
+os.environ.setdefault("HTTP_POOL_MAXSIZE", str(worker_connections))
+# 說明：多個 worker 各自記錄指標，/metrics 會把這個目錄下所有 worker 的快照加總後輸出。
+os.environ.setdefault("METRICS_MULTIPROC_DIR", os.path.join("/tmp", f"xiaoyun_metrics_{os.getpid()}"))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", None)
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def on_starting(server):
+    # 說明：在這裡檢查才涵蓋命令列的 -w；行程內的用戶狀態配多個 worker 會讓同一位用戶的對話散在各 worker，直接拒絕啟動
+    if server.cfg.workers > 1 and os.environ["USER_STATE_BACKEND"] != "sqlite":
+        raise RuntimeError(f"USER_STATE_BACKEND={os.environ['USER_STATE_BACKEND']} 的用戶狀態是各 worker 自己的，"
+                           f"不能開 {server.cfg.workers} 個 worker；改用 USER_STATE_BACKEND=sqlite 或 WEB_CONCURRENCY=1")
+    # 清掉上一輪留下的快照；不在 master 匯入 metrics，避免它的鎖在 monkey-patch 之前就被建立
+    metrics_dir = os.environ["METRICS_MULTIPROC_DIR"]
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "metrics_*.json*")):
+        os.remove(path)
@@ -0,0 +1,162 @@
+"""面向用戶的 Gemini 請求加上對沖 (hedging)：主請求超過該任務的延遲門檻還沒回來，就再送一份，先成功的勝出。
+
+- 門檻：該任務最近 HEDGE_WINDOW 次成功請求耗時的 HEDGE_QUANTILE 分位數 (預設 p90)，不低於 HEDGE_MIN_DELAY_SECONDS；
+  樣本不足 HEDGE_MIN_SAMPLES 時不對沖。
+- 對沖率上限：每個可對沖的請求累積 HEDGE_MAX_RATE 個額度 (最多 HEDGE_BURST 個)，每次對沖用掉 1 個，
+  所以長期來看對沖次數不超過請求數的 HEDGE_MAX_RATE，配額用量有上限。
+- 同步版在 executor 執行兩份請求，輸的那份會跑完但結果丟棄；非同步版直接取消輸的那份。
+- 主請求在門檻前就失敗時照原樣拋出 (對沖只處理慢，不處理錯)；兩份都失敗時拋出主請求的例外。
+"""
+import asyncio
+import collections
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_TASKS = tuple(task.strip() for task in os.getenv(
+    "HEDGE_TASKS", "chat_text,chat_image,chat_sticker,chat_audio,feed_now,scenario_follow_up").split(",") if task.strip())
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.9"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "1.0"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.05"))
+HEDGE_BURST = float(os.getenv("HEDGE_BURST", "3"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", "64"))
+
+HEDGES = metrics.REGISTRY.counter(
+    "xiaoyun_gemini_hedges_total", "Gemini 對沖請求，依任務與結果 (fired / won / lost / rate_capped) 區分", ("task", "outcome"))
+HEDGE_DELAY = metrics.REGISTRY.gauge(
+    "xiaoyun_gemini_hedge_delay_seconds", "目前的對沖門檻 (該任務成功請求耗時的分位數)", ("task",))
+
+
+class HedgePolicy:
+    def __init__(self, tasks=HEDGE_TASKS, enabled=HEDGE_ENABLED, quantile=HEDGE_QUANTILE, min_samples=HEDGE_MIN_SAMPLES,
+                 min_delay=HEDGE_MIN_DELAY_SECONDS, max_rate=HEDGE_MAX_RATE, burst=HEDGE_BURST, window=HEDGE_WINDOW):
+        self.tasks = frozenset(tasks)
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self.burst = burst
+        self._latencies = collections.defaultdict(lambda: metrics.LatencyWindow(window))
+        self._credits = burst
+        self._lock = threading.Lock()
+
+    def observe(self, task, seconds):
+        """記錄一次成功請求的耗時 (只算單一份請求自己的耗時)。"""
+        self._latencies[task].add(seconds)
+
+    def delay_for(self, task):
+        """回傳這次請求的對沖門檻 (秒)，不對沖時回傳 None；可對沖的請求會累積對沖額度。"""
+        if not self.enabled or task not in self.tasks:
+            return None
+        window = self._latencies.get(task)
+        if window is None or len(window) < self.min_samples:
+            return None
+        delay = max(self.min_delay, window.quantile(self.quantile))
+        with self._lock:
+            self._credits = min(self.burst, self._credits + self.max_rate)
+        HEDGE_DELAY.labels(task).set(delay)
+        return delay
+
+    def try_acquire(self, task):
+        with self._lock:
+            if self._credits >= 1:
+                self._credits -= 1
+                return True
+        HEDGES.labels(task, "rate_capped").inc()
+        return False
+
+    def status(self):
+        thresholds = {
+            task: round(window.quantile(self.quantile), 3)
+            for task, window in list(self._latencies.items()) if len(window) >= self.min_samples
+        }
+        return {"enabled": self.enabled, "tasks": sorted(self.tasks), "max_rate": self.max_rate,
+                "credits": round(self._credits, 2), "thresholds_seconds": thresholds}
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="gemini-hedge")
+        return _executor
+
+
+def _timed(policy, task, attempt, timeout):
+    started = time.perf_counter()
+    result = attempt(timeout)
+    policy.observe(task, time.perf_counter() - started)
+    return result
+
+
+def run_hedged(policy, task, attempt, timeout):
+    """attempt(timeout) 送出一份請求並回傳結果；依 policy 決定要不要在門檻後多送一份。"""
+    delay = policy.delay_for(task)
+    if delay is None or delay >= timeout:
+        return _timed(policy, task, attempt, timeout)
+    executor = _get_executor()
+    started = time.perf_counter()
+    primary = executor.submit(contextvars.copy_context().run, _timed, policy, task, attempt, timeout)
+    done, _ = wait([primary], timeout=delay)
+    if done or not policy.try_acquire(task):
+        return primary.result()
+    HEDGES.labels(task, "fired").inc()
+    remaining = max(0.1, timeout - (time.perf_counter() - started))
+    hedge = executor.submit(contextvars.copy_context().run, _timed, policy, task, attempt, remaining)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                HEDGES.labels(task, "won" if future is hedge else "lost").inc()
+                return future.result()
+    return primary.result()
+
+
+async def _timed_async(policy, task, attempt, timeout):
+    started = time.perf_counter()
+    result = await attempt(timeout)
+    policy.observe(task, time.perf_counter() - started)
+    return result
+
+
+async def run_hedged_async(policy, task, attempt, timeout):
+    """非同步版 run_hedged；attempt(timeout) 是 coroutine function，輸的那份會被取消。"""
+    delay = policy.delay_for(task)
+    if delay is None or delay >= timeout:
+        return await _timed_async(policy, task, attempt, timeout)
+    started = time.perf_counter()
+    primary = asyncio.ensure_future(_timed_async(policy, task, attempt, timeout))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not policy.try_acquire(task):
+        return await primary
+    HEDGES.labels(task, "fired").inc()
+    remaining = max(0.1, timeout - (time.perf_counter() - started))
+    hedge = asyncio.ensure_future(_timed_async(policy, task, attempt, remaining))
+    pending = {primary, hedge}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task_future in done:
+                if task_future.exception() is None:
+                    HEDGES.labels(task, "won" if task_future is hedge else "lost").inc()
+                    return task_future.result()
+        return primary.result()
+    finally:
+        for task_future in pending:
+            task_future.cancel()
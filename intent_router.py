@@ -0,0 +1,84 @@
+"""文字訊息的意圖路由：啟動時建好一次，每則訊息只查一次表、掃一次字串。
+
+- 完全相符的觸發 (每日任務、Rich Menu 文字、內部指令) 用 dict 查表，O(1)。
+- 關鍵字類的判斷 (秘密請求、食物話題…) 全部建成一個 Aho-Corasick 自動機 (KeywordMatcher)，
+  掃過訊息一次就知道命中了哪些標籤，不必對每個關鍵字清單各跑一次 any(... in ...)。
+- 固定句型 (哈哈哈、純數字) 用預先編譯好的正規表示式。
+- route() 回傳 Route(intent, payload, flags)：flags 是這則訊息命中的標籤，給後面的「緊扣上文」提示沿用，不必再掃一次。
+"""
+import collections
+import re
+
+Route = collections.namedtuple("Route", ("intent", "payload", "flags"))
+_NO_FLAGS = frozenset()
+
+
+class KeywordMatcher:
+    def __init__(self, keywords_by_label):
+        # 說明：先建 trie，再用 BFS 補上失敗連結；每個狀態直接展開成完整的轉移表 (DFA)，比對時一個字元只查一次 dict
+        goto, outputs = [{}], [set()]
+        for label, keywords in keywords_by_label.items():
+            for keyword in keywords:
+                state = 0
+                for ch in keyword:
+                    if (next_state := goto[state].get(ch)) is None:
+                        next_state = goto[state][ch] = len(goto)
+                        goto.append({})
+                        outputs.append(set())
+                    state = next_state
+                outputs[state].add(label)
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = dict(goto[0])
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            outputs[state] |= outputs[fail[state]]
+            delta[state] = dict(delta[fail[state]])
+            for ch, next_state in goto[state].items():
+                fail[next_state] = delta[fail[state]].get(ch, 0)
+                delta[state][ch] = next_state
+                queue.append(next_state)
+        self._delta = delta
+        self._outputs = [frozenset(labels) for labels in outputs]
+
+    def labels(self, text):
+        """回傳 text 裡命中的標籤集合。"""
+        delta, outputs = self._delta, self._outputs
+        state, found = 0, set()
+        for ch in text:
+            state = delta[state].get(ch, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return found
+
+
+class IntentRouter:
+    def __init__(self, exact, keyword_flags=None, exact_flags=None, pattern_flags=None, keyword_intents=()):
+        """exact: {訊息: (意圖, payload)}，完全相符 (不轉小寫、不去空白)。
+        keyword_flags: {標籤: 關鍵字}，在轉小寫的訊息裡出現就算命中。
+        exact_flags: {標籤: 訊息}、pattern_flags: {標籤: 正規表示式}，比對去掉前後空白並轉小寫的訊息 (fullmatch)。
+        keyword_intents: [(意圖, 需要同時命中的標籤)]，依序檢查；都不符時意圖為 "chat"。"""
+        self.exact = dict(exact)
+        self.matcher = KeywordMatcher(keyword_flags or {})
+        self.exact_flags = {}
+        for label, messages in (exact_flags or {}).items():
+            for message in messages:
+                self.exact_flags.setdefault(message.strip().lower(), set()).add(label)
+        self.pattern_flags = [(label, re.compile(pattern)) for label, pattern in (pattern_flags or {}).items()]
+        self.keyword_intents = [(intent, frozenset(labels)) for intent, labels in keyword_intents]
+
+    def route(self, message):
+        if (hit := self.exact.get(message)) is not None:
+            return Route(hit[0], hit[1], _NO_FLAGS)
+        lowered = message.lower()
+        stripped = lowered.strip()
+        flags = self.matcher.labels(lowered)
+        flags |= self.exact_flags.get(stripped, _NO_FLAGS)
+        for label, pattern in self.pattern_flags:
+            if pattern.fullmatch(stripped):
+                flags.add(label)
+        for intent, labels in self.keyword_intents:
+            if labels <= flags:
+                return Route(intent, None, frozenset(flags))
+        return Route("chat", None, frozenset(flags))
@@ -0,0 +1,103 @@
+"""非阻塞的日誌管線：請求執行緒只把 LogRecord 放進佇列，格式化與寫出都在背景執行緒完成。
+
+- configure_logging() 取代 logging.basicConfig()：root logger 只掛一個 QueueHandler，
+  由 QueueListener 在背景執行緒交給真正的 StreamHandler。
+- 大型內容 (webhook body、Gemini 原始 JSON、候選圖片 URL) 以 extra={"payload": "<類別>"} 標記，
+  依類別抽樣，沒抽中的在進佇列前就丟掉。
+- 訊息請一律用 %-style 參數 (logger.info("...: %s", value))，沒輸出的紀錄不會被格式化。
+
+環境變數：
+    LOG_LEVEL                  預設 INFO
+    LOG_QUEUE_ENABLED          0 時改回同步寫出 (比較用)
+    LOG_PAYLOAD_SAMPLE_RATE    所有大型內容的預設抽樣率，預設 0.05
+    LOG_PAYLOAD_SAMPLE_RATES   個別類別覆寫，例如 "webhook_body=0.2,image_candidates=0"
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "1") == "1"
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.05"))
+LOG_FORMAT = "%(levelname)s:%(name)s:%(message)s"
+
+# 說明：大型內容的類別；沒列在這裡的類別也可以用，抽樣率取預設值。
+PAYLOAD_CATEGORIES = (
+    "webhook_body",      # /callback 收到的原始 body
+    "gemini_response",   # Gemini 回傳的原始 JSON / 文字
+    "image_candidates",  # Pexels / Unsplash 候選圖片 URL 與逐張驗證結果
+)
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in (spec or "").split(","):
+        if "=" not in item:
+            continue
+        category, _, rate = item.partition("=")
+        try:
+            rates[category.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class PayloadSampler(logging.Filter):
+    """只對帶有 payload 類別的紀錄抽樣，其餘紀錄一律放行。"""
+
+    def __init__(self, default_rate, rates=None):
+        super().__init__()
+        self.default_rate = default_rate
+        self.rates = dict(rates or {})
+
+    def filter(self, record):
+        category = getattr(record, "payload", None)
+        if category is None:
+            return True
+        rate = self.rates.get(category, self.default_rate)
+        return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """標準 QueueHandler 會在呼叫端執行緒先把訊息格式化；這裡原封不動交給背景執行緒處理。
+    代價是 args 會晚一點才被讀取，所以不要傳之後還會被原地修改的物件。"""
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def configure_logging(level=None):
+    """設定 root logger；重複呼叫不會重複掛 handler。回傳 QueueListener (同步模式時為 None)。"""
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level or LOG_LEVEL)
+    if getattr(root, "_xiaoyun_configured", False):
+        return _listener
+
+    # 說明：格式只用到 levelname / name / message；關掉 LogRecord 額外收集的呼叫端位置、執行緒與行程資訊 (logging 文件的 Optimization 一節)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    output = logging.StreamHandler()
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    sampler = PayloadSampler(LOG_PAYLOAD_SAMPLE_RATE, parse_sample_rates(os.getenv("LOG_PAYLOAD_SAMPLE_RATES")))
+    if LOG_QUEUE_ENABLED:
+        # 說明：用 queue.Queue 而不是 SimpleQueue；前者建立在 threading 上，gevent monkey-patch 後背景等待才不會卡住整個 hub。
+        entry = DeferredQueueHandler(queue.Queue())
+        _listener = logging.handlers.QueueListener(entry.queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+    else:
+        entry = output
+    entry.addFilter(sampler)
+    root.addHandler(entry)
+    root._xiaoyun_configured = True
+    return _listener
@@ -0,0 +1,461 @@
+"""行程內的指標登錄 (counter / gauge / histogram)，以 Prometheus 文字格式輸出。
+
+- 每個指標子項各自持有一把鎖，臨界區只做幾次加法；histogram 的 bucket 位置在鎖外先算好。
+- 多個 gunicorn worker：設定 METRICS_MULTIPROC_DIR 後，每個 worker 定期把快照寫到
+  `<dir>/metrics_<worker_id>.json` (worker_id = pid + 隨機字串，pid 被重用也不會蓋掉別人的檔)，
+  /metrics 讀取所有快照加總後輸出。gauge 只計入還活著的 worker。
+  已結束的 worker (pid 不在了，或同一個 pid 有更新的 worker 檔) 在 /metrics 時由 compact_snapshots()
+  把 counter / histogram 併進 `<dir>/metrics_archive.json` 後刪檔：數值不倒退，目錄也不會隨 worker 重啟一直變大。
+- observe_stage() 同時會開一個同名的追蹤 span (見 tracing.py)，事件沒被抽樣時不會有額外開銷。
+- LatencyWindow 是給程式內部查分位數用的滑動視窗 (histogram 只有 bucket，算不出精確的 p90 / p99)。
+"""
+import bisect
+import collections
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_FLUSH_INTERVAL_SECONDS = float(os.getenv("METRICS_FLUSH_INTERVAL_SECONDS", "5"))
+
+ARCHIVE_FILE_NAME = "metrics_archive.json"
+
+
+def _new_worker_id():
+    return f"{os.getpid()}_{uuid.uuid4().hex[:8]}"
+
+
+WORKER_ID = _new_worker_id()
+
+
+def _reset_worker_id():
+    global WORKER_ID
+    WORKER_ID = _new_worker_id()
+
+
+# 說明：preload 後 fork 出來的 worker 也要有自己的 id
+os.register_at_fork(after_in_child=_reset_worker_id)
+
+# 涵蓋簽章驗證 (毫秒以下) 到 Gemini 多模態回應 (45 秒逾時)
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0)
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount=1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+    @contextmanager
+    def track_inprogress(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum", "_lock")
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # 最後一格是 +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *label_values):
+        key = tuple(str(value) for value in label_values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.label_names):
+                raise ValueError(f"{self.name} 需要標籤 {self.label_names}，收到 {key}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self):
+        return [[list(key), child.value] for key, child in list(self._children.items())]
+
+    def snapshot(self):
+        return {"type": self.type_name, "help": self.help, "labels": list(self.label_names), "samples": self._samples()}
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.upper_bounds = tuple(sorted(float(bound) for bound in buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def _samples(self):
+        return [[list(key), {"counts": list(child.counts), "sum": child.sum}] for key, child in list(self._children.items())]
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.upper_bounds)
+        return snapshot
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = metric_class(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram, name, help_text, label_names, buckets=buckets)
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    # --- 多 worker 快照 ---
+
+    def write_snapshot(self, directory=None):
+        directory = directory or METRICS_MULTIPROC_DIR
+        if not directory:
+            return
+        path = os.path.join(directory, f"metrics_{WORKER_ID}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "worker_id": WORKER_ID, "written_at": time.time(), "metrics": self.snapshot()}, f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """回傳要輸出的快照：單一行程時就是自己，多 worker 時為所有 worker 快照的加總。"""
+        if not METRICS_MULTIPROC_DIR:
+            return self.snapshot()
+        try:
+            self.write_snapshot()
+            compact_snapshots(METRICS_MULTIPROC_DIR)
+        except OSError as e:
+            logger.warning("寫入指標快照失敗: %s", e)
+        return merge_snapshots([snapshot for _, snapshot in _read_snapshots(METRICS_MULTIPROC_DIR)])
+
+    def render(self):
+        return render_text(self.collect())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_snapshots(directory):
+    """回傳 [(路徑, 快照)]，含 archive。"""
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, "metrics_*.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                snapshots.append((path, json.load(f)))
+        except (OSError, ValueError):
+            continue  # 另一個 worker 正在換檔
+    return snapshots
+
+
+def _dead_worker_ids(worker_snapshots):
+    """pid 已不在，或同一個 pid 有更新的 worker 快照 (pid 被重用) 的 worker_id。"""
+    newest_by_pid = {}
+    for snapshot in worker_snapshots:
+        if snapshot.get("archive"):
+            continue
+        newest = newest_by_pid.get(snapshot["pid"])
+        if newest is None or snapshot["written_at"] > newest["written_at"]:
+            newest_by_pid[snapshot["pid"]] = snapshot
+    return {snapshot["worker_id"] for snapshot in worker_snapshots
+            if not snapshot.get("archive") and
+            (newest_by_pid[snapshot["pid"]] is not snapshot or not _pid_alive(snapshot["pid"]))}
+
+
+def compact_snapshots(directory):
+    """把已結束的 worker 的 counter / histogram 併進 archive 後刪掉它們的快照檔；多個 worker 同時呼叫時以檔案鎖排隊。"""
+    with open(os.path.join(directory, "archive.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        snapshots = _read_snapshots(directory)
+        dead = _dead_worker_ids([snapshot for _, snapshot in snapshots])
+        if not dead:
+            return
+        archive_path = os.path.join(directory, ARCHIVE_FILE_NAME)
+        archive = next((snapshot for _, snapshot in snapshots if snapshot.get("archive")),
+                       {"archive": True, "folded": [], "metrics": {}})
+        # 說明：folded 記下已併入、檔案可能還沒刪掉的 worker，併完、刪檔前若中斷，下次不會重複計入；
+        # 檔案已經不在的 id 用不到了，趁這次改寫時清掉
+        folded = set(archive["folded"])
+        existing = {snapshot.get("worker_id") for _, snapshot in snapshots}
+        to_fold = [(path, snapshot) for path, snapshot in snapshots
+                   if snapshot.get("worker_id") in dead and snapshot["worker_id"] not in folded]
+        if to_fold:
+            archive = {"archive": True, "written_at": time.time(), "folded": sorted((folded & existing) | dead),
+                       "metrics": merge_snapshots([archive] + [snapshot for _, snapshot in to_fold])}
+            tmp_path = f"{archive_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(archive, f)
+            os.replace(tmp_path, archive_path)
+        for path, snapshot in snapshots:
+            if snapshot.get("worker_id") in dead:
+                os.remove(path)
+
+
+def merge_snapshots(worker_snapshots):
+    merged = {}
+    dead = _dead_worker_ids(worker_snapshots)
+    for worker_snapshot in worker_snapshots:
+        alive = not worker_snapshot.get("archive") and worker_snapshot["worker_id"] not in dead
+        for name, metric in worker_snapshot.get("metrics", {}).items():
+            if metric["type"] == "gauge" and not alive:
+                continue
+            target = merged.setdefault(name, {key: value for key, value in metric.items() if key != "samples"} | {"samples": {}})
+            for label_values, value in metric["samples"]:
+                key = tuple(label_values)
+                if metric["type"] == "histogram":
+                    current = target["samples"].setdefault(key, {"counts": [0] * len(value["counts"]), "sum": 0.0})
+                    current["counts"] = [a + b for a, b in zip(current["counts"], value["counts"])]
+                    current["sum"] += value["sum"]
+                else:
+                    target["samples"][key] = target["samples"].get(key, 0.0) + value
+    for metric in merged.values():
+        metric["samples"] = [[list(key), value] for key, value in metric["samples"].items()]
+    return merged
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = [f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def render_text(snapshot):
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        label_names = metric["labels"]
+        for label_values, value in sorted(metric["samples"], key=lambda sample: sample[0]):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                for upper_bound, count in zip(list(metric["buckets"]) + [float("inf")], value["counts"]):
+                    cumulative += count
+                    le = f'le="{_format_number(upper_bound)}"'
+                    lines.append(f"{name}_bucket{_format_labels(label_names, label_values, le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(label_names, label_values)} {_format_number(value['sum'])}")
+                lines.append(f"{name}_count{_format_labels(label_names, label_values)} {cumulative}")
+            else:
+                lines.append(f"{name}{_format_labels(label_names, label_values)} {_format_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+_snapshot_writer_started = False
+
+
+def start_snapshot_writer(interval=None):
+    """多 worker 模式下啟動背景執行緒定期寫快照；單一行程時不做事。"""
+    global _snapshot_writer_started
+    if not METRICS_MULTIPROC_DIR or _snapshot_writer_started:
+        return
+    _snapshot_writer_started = True
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+    interval = interval or METRICS_FLUSH_INTERVAL_SECONDS
+
+    def _loop():
+        while True:
+            time.sleep(interval)
+            try:
+                REGISTRY.write_snapshot()
+            except OSError as e:
+                logger.warning("寫入指標快照失敗: %s", e)
+
+    threading.Thread(target=_loop, name="metrics-snapshot-writer", daemon=True).start()
+
+
+class LatencyWindow:
+    """最近 maxlen 筆耗時的滑動視窗，隨時可查分位數 (對沖門檻、自適應逾時用)；本行程內，不進 /metrics。"""
+
+    def __init__(self, maxlen):
+        self._samples = collections.deque(maxlen=maxlen)
+        self._sorted = []
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            if len(self._samples) == self._samples.maxlen:
+                del self._sorted[bisect.bisect_left(self._sorted, self._samples[0])]
+            self._samples.append(seconds)
+            bisect.insort(self._sorted, seconds)
+
+    def quantile(self, fraction):
+        with self._lock:
+            if not self._sorted:
+                return None
+            return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * fraction))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+REGISTRY = MetricsRegistry()
+
+# --- 小雲使用的指標 ---
+STAGE_DURATION = REGISTRY.histogram(
+    "xiaoyun_stage_duration_seconds", "各處理階段耗時 (簽章驗證、LINE 內容下載、圖片搜尋與驗證、快速回覆、回覆訊息)", ("stage",))
+STAGE_ERRORS = REGISTRY.counter(
+    "xiaoyun_stage_errors_total", "各處理階段拋出例外的次數", ("stage",))
+GEMINI_REQUEST_DURATION = REGISTRY.histogram(
+    "xiaoyun_gemini_request_duration_seconds", "Gemini generateContent 請求耗時，依任務類型區分", ("task",))
+GEMINI_REQUESTS = REGISTRY.counter(
+    "xiaoyun_gemini_requests_total", "Gemini 請求次數，依任務類型與結果 (HTTP 狀態碼 / timeout / error) 區分", ("task", "status"))
+GEMINI_TOKENS = REGISTRY.counter(
+    "xiaoyun_gemini_tokens_total", "Gemini usageMetadata 回報的 token 數", ("task", "kind"))
+CACHE_REQUESTS = REGISTRY.counter(
+    "xiaoyun_cache_requests_total", "快取查詢次數，依快取名稱與 hit / miss 區分", ("cache", "result"))
+GEMINI_PROFILE_DURATION = REGISTRY.histogram(
+    "xiaoyun_gemini_profile_duration_seconds", "成功的 Gemini 請求耗時，依任務與生成設定 (思考預算、回覆上限、溫度) 區分", ("task", "profile"))
+GEMINI_PROFILE_TOKENS = REGISTRY.histogram(
+    "xiaoyun_gemini_profile_output_tokens", "每次回應的輸出 token 數 (candidates / thoughts)，依任務與生成設定區分", ("task", "profile", "kind"),
+    buckets=(0, 10, 25, 50, 100, 200, 400, 600, 800, 1200, 1600, 2400, 4096))
+GEMINI_FINISH_REASONS = REGISTRY.counter(
+    "xiaoyun_gemini_finish_reasons_total", "Gemini 回應的 finishReason (MAX_TOKENS 代表回覆上限太緊)", ("task", "reason"))
+INFLIGHT = REGISTRY.gauge(
+    "xiaoyun_inflight", "目前進行中的請求數 (webhook、事件處理、Gemini 呼叫)", ("kind",))
+
+_USAGE_METADATA_FIELDS = {
+    "promptTokenCount": "prompt",
+    "candidatesTokenCount": "candidates",
+    "thoughtsTokenCount": "thoughts",
+    "cachedContentTokenCount": "cached",
+}
+
+
+@contextmanager
+def observe_stage(stage):
+    started = time.perf_counter()
+    try:
+        with tracing.span(stage):
+            yield
+    except BaseException:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_DURATION.labels(stage).observe(time.perf_counter() - started)
+
+
+def record_gemini_usage(task, result):
+    usage = (result or {}).get("usageMetadata") or {}
+    for field, kind in _USAGE_METADATA_FIELDS.items():
+        if count := usage.get(field):
+            GEMINI_TOKENS.labels(task, kind).inc(count)
+
+
+def record_generation_profile(task, profile, seconds, result):
+    usage = (result or {}).get("usageMetadata") or {}
+    GEMINI_PROFILE_DURATION.labels(task, profile).observe(seconds)
+    GEMINI_PROFILE_TOKENS.labels(task, profile, "candidates").observe(usage.get("candidatesTokenCount") or 0)
+    GEMINI_PROFILE_TOKENS.labels(task, profile, "thoughts").observe(usage.get("thoughtsTokenCount") or 0)
+    for candidate in (result or {}).get("candidates") or []:
+        GEMINI_FINISH_REASONS.labels(task, candidate.get("finishReason") or "UNSPECIFIED").inc()
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
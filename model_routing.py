@@ -0,0 +1,93 @@
+"""依任務選 Gemini 模型：輔助任務走較輕、較快的模型，出錯或被限流時退回主模型。
+
+- routes 是 任務 -> 模型；沒列出的任務用主模型。
+- candidates(task) 回傳依序要嘗試的模型；輕量模型冷卻中 (剛收到 429，或連續失敗 COOLDOWN_AFTER_FAILURES 次) 就直接用主模型。
+- 每個模型保留最近 STATS_WINDOW 次呼叫的 (成功與否, 耗時)，status() 回報錯誤率與延遲分位數，用來調整路由。
+"""
+import collections
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STATS_WINDOW = 200
+COOLDOWN_AFTER_FAILURES = 3
+COOLDOWN_SECONDS = 60.0
+
+MODEL_REQUEST_DURATION = metrics.REGISTRY.histogram(
+    "xiaoyun_gemini_model_request_duration_seconds", "Gemini 請求耗時，依模型區分", ("model",))
+MODEL_REQUESTS = metrics.REGISTRY.counter(
+    "xiaoyun_gemini_model_requests_total", "Gemini 請求次數，依模型與結果 (HTTP 狀態碼 / timeout / error) 區分", ("model", "status"))
+MODEL_FALLBACKS = metrics.REGISTRY.counter(
+    "xiaoyun_gemini_model_fallbacks_total", "輕量模型失敗或冷卻中而改用主模型的次數", ("task", "reason"))
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))], 3)
+
+
+class ModelRouter:
+    def __init__(self, default_model, routes=None):
+        self.default_model = default_model
+        self.routes = dict(routes or {})
+        self._lock = threading.Lock()
+        self._window = collections.defaultdict(lambda: collections.deque(maxlen=STATS_WINDOW))
+        self._consecutive_failures = collections.Counter()
+        self._cooldown_until = {}
+
+    def model_for(self, task):
+        return self.routes.get(task, self.default_model)
+
+    def candidates(self, task):
+        """依序要嘗試的模型：路由到的模型 (不在冷卻中時) 與主模型。"""
+        model = self.model_for(task)
+        if model == self.default_model:
+            return [model]
+        if time.monotonic() < self._cooldown_until.get(model, 0.0):
+            MODEL_FALLBACKS.labels(task, "cooldown").inc()
+            return [self.default_model]
+        return [model, self.default_model]
+
+    def record(self, model, status, seconds):
+        """記錄一次呼叫結果；status 是 HTTP 狀態碼字串、"timeout" 或 "error"。"""
+        ok = status == "200"
+        MODEL_REQUEST_DURATION.labels(model).observe(seconds)
+        MODEL_REQUESTS.labels(model, status).inc()
+        with self._lock:
+            self._window[model].append((ok, seconds))
+            if ok:
+                self._consecutive_failures[model] = 0
+                return
+            self._consecutive_failures[model] += 1
+            if model == self.default_model:
+                return
+            if status == "429" or self._consecutive_failures[model] >= COOLDOWN_AFTER_FAILURES:
+                self._cooldown_until[model] = time.monotonic() + COOLDOWN_SECONDS
+                self._consecutive_failures[model] = 0
+                logger.warning("模型 %s 最近失敗 (%s)，%s 秒內輔助任務改用 %s。", model, status, COOLDOWN_SECONDS, self.default_model)
+
+    def record_fallback(self, task, reason):
+        MODEL_FALLBACKS.labels(task, reason).inc()
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            windows = {model: list(window) for model, window in self._window.items()}
+            cooldowns = {model: until - now for model, until in self._cooldown_until.items() if until > now}
+        models = {}
+        for model in {self.default_model, *self.routes.values(), *windows}:
+            samples = windows.get(model, [])
+            latencies = sorted(seconds for ok, seconds in samples if ok)
+            models[model] = {
+                "recent_requests": len(samples),
+                "error_rate": round(sum(1 for ok, _ in samples if not ok) / len(samples), 3) if samples else None,
+                "p50_seconds": _percentile(latencies, 0.5),
+                "p95_seconds": _percentile(latencies, 0.95),
+                "cooldown_remaining_seconds": round(cooldowns[model], 1) if model in cooldowns else 0,
+            }
+        return {"default_model": self.default_model, "routes": dict(self.routes), "models": models}
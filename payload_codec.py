@@ -0,0 +1,70 @@
+"""Gemini 請求本文的 JSON 編碼：長文字片段 (角色設定等) 只編碼一次，之後直接拼接預先編好的 bytes。
+
+- 有安裝 orjson 就用 orjson (比標準庫快數倍，輸出 UTF-8、不做 \\uXXXX 跳脫)；沒有則退回標準庫的 json.dumps
+  (保留 \\uXXXX 跳脫：本文較大，但標準庫 C 實作的 ASCII 輸出比 ensure_ascii=False 快)。
+- encode_body() 把 contents 開頭含長文字 (>= PREENCODE_MIN_CHARS) 的訊息以預先編好的 bytes 輸出，
+  其後的訊息 (對話歷史、這一輪的文字或 inline_data) 與其餘欄位 (generationConfig、cachedContent…) 照常編碼後拼接。
+- 輸出與 dumps(payload) 是同一份 JSON (只差欄位順序 contents 一定在最前面)。
+"""
+import functools
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson 是選用的加速套件
+    orjson = None
+
+PREENCODE_MIN_CHARS = int(os.getenv("PAYLOAD_PREENCODE_MIN_CHARS", "2048"))
+CODEC = "orjson" if orjson else "json"
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+if orjson:
+    dumps = orjson.dumps
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode("ascii")
+
+    loads = json.loads
+
+
+@functools.lru_cache(maxsize=128)
+def _encoded_message(role, texts):
+    return dumps({"role": role, "parts": [{"text": text} for text in texts]})
+
+
+def _prefix_message_bytes(message):
+    # 說明：只有含長文字的純文字訊息 (開頭的角色設定，或角色設定 + 記憶筆記) 才走快取；
+    # key 是 (role, 各 part 的字串)，歷史裡的角色設定每次都是同一個字串物件，雜湊值已快取、比對只需檢查 identity。
+    parts = message.get("parts")
+    if not parts or len(message) != 2 or "role" not in message:
+        return None
+    texts = []
+    for part in parts:
+        if len(part) != 1 or not isinstance(text := part.get("text"), str):
+            return None
+        texts.append(text)
+    if max(map(len, texts)) < PREENCODE_MIN_CHARS:
+        return None
+    return _encoded_message(message["role"], tuple(texts))
+
+
+def encode_body(payload):
+    """把 generateContent / cachedContents 的請求本文編成 bytes。
+
+    開頭含長文字的訊息用快取好的 bytes，其後的訊息與其他欄位各以一次 dumps 編碼後拼接；
+    逐則訊息分別呼叫 dumps 的額外開銷比重新編碼還貴，所以只把開頭切出來。"""
+    contents = payload.get("contents")
+    if not contents or (head := _prefix_message_bytes(contents[0])) is None:
+        return dumps(payload)
+    chunks = [b'{"contents":[', head]
+    index = 1
+    while index < len(contents) and (encoded := _prefix_message_bytes(contents[index])) is not None:
+        chunks += [b",", encoded]
+        index += 1
+    if index < len(contents):
+        chunks += [b",", dumps(contents[index:])[1:-1]]
+    rest = {key: value for key, value in payload.items() if key != "contents"}
+    chunks.append(b"]," + dumps(rest)[1:] if rest else b"]}")
+    return b"".join(chunks)
@@ -0,0 +1,193 @@
+"""Gemini cachedContents：把角色設定前綴 (角色設定 + 初始回應) 註冊成伺服器端快取，請求只送各用戶的後綴。
+
+- 前綴以 (模型, 角色設定文字, 初始回應文字) 為 key；只有第一則是已知的角色設定 (見 ROLE_PROMPTS) 才會快取，
+  所以每個模型、每種任務的角色設定版本各註冊一次。
+- 建立與延長 TTL 都在背景執行緒做；快取還沒好 (或建立失敗在冷卻中) 時照送完整 payload。
+- 快取快到期時 (剩不到 refresh_margin 秒) 由下一個用到它的請求觸發 PATCH 延長；沒人用的快取就讓它自然過期。
+- 呼叫端若收到 INVALID_CACHE_STATUSES (快取被刪、過期、沒權限)，呼叫 invalidate() 後改送完整 payload 重試。
+- 記憶筆記等接在角色設定後面的額外 part 每個用戶不同，會移到後綴第一則 user 訊息的開頭。
+"""
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+INVALID_CACHE_STATUSES = (400, 403, 404)
+CREATE_RETRY_SECONDS = 300
+
+PROMPT_CACHE_EVENTS = metrics.REGISTRY.counter(
+    "xiaoyun_prompt_cache_events_total", "角色設定前綴快取事件 (created / refreshed / create_failed / fallback)", ("event",))
+
+
+class PromptCache:
+    def __init__(self, session, api_base, api_key, prefix_texts, ttl_seconds=3600, refresh_margin_seconds=300,
+                 min_tokens=1024, estimate_tokens=None, enabled=True):
+        self.session = session
+        self.api_base = api_base
+        self.api_key = api_key
+        self.prefix_texts = set(prefix_texts)
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.min_tokens = min_tokens
+        self.estimate_tokens = estimate_tokens
+        self.enabled = enabled
+        # (model, 角色設定, 初始回應) -> {"state": creating / ready / failed, "name", "expires_at", "tokens", "refreshing", "retry_at"}
+        self.entries = {}
+        self.stats = {"hits": 0, "misses": 0, "fallbacks": 0, "cached_prompt_tokens": 0, "uncached_prompt_tokens": 0}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prompt-cache")
+        atexit.register(self.close)
+
+    # --- 請求路徑 ---
+
+    def _split(self, payload):
+        contents = payload.get("contents") or []
+        if len(contents) < 3 or payload.get("cachedContent") or payload.get("systemInstruction"):
+            return None
+        head, first_model = contents[0], contents[1]
+        head_parts = head.get("parts") or []
+        if head.get("role") != "user" or first_model.get("role") != "model" or not head_parts:
+            return None
+        role_prompt = head_parts[0].get("text")
+        model_parts = first_model.get("parts") or []
+        if role_prompt not in self.prefix_texts or len(model_parts) != 1 or "text" not in model_parts[0]:
+            return None
+        prefix = [{"role": "user", "parts": [{"text": role_prompt}]}, first_model]
+        suffix = list(contents[2:])
+        if extra_parts := head_parts[1:]:
+            if suffix[0].get("role") == "user":
+                suffix[0] = {"role": "user", "parts": list(extra_parts) + list(suffix[0].get("parts") or [])}
+            else:
+                suffix.insert(0, {"role": "user", "parts": list(extra_parts)})
+        return (role_prompt, model_parts[0]["text"]), prefix, suffix
+
+    def prepare(self, model, payload):
+        """回傳 (要送出的 payload, 用到的 cachedContent 名稱或 None)。"""
+        if not self.enabled:
+            return payload, None
+        split = self._split(payload)
+        if split is None:
+            return payload, None
+        prefix_key, prefix, suffix = split
+        key = (model,) + prefix_key
+        now = time.time()
+        submit = None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry["state"] == "failed" and now >= entry["retry_at"]) or \
+                    (entry["state"] == "ready" and now >= entry["expires_at"] - 5):
+                self.entries[key] = {"state": "creating"}
+                submit = (self._create, key, prefix)
+                entry = None
+            elif entry["state"] == "ready" and not entry["refreshing"] and now >= entry["expires_at"] - self.refresh_margin_seconds:
+                entry["refreshing"] = True
+                submit = (self._refresh, key, entry["name"])
+            if entry is not None and entry["state"] == "ready":
+                self.stats["hits"] += 1
+                name = entry["name"]
+            else:
+                self.stats["misses"] += 1
+                name = None
+        if submit:
+            self._executor.submit(*submit)
+        metrics.record_cache_lookup("prompt_prefix", name is not None)
+        if name is None:
+            return payload, None
+        return {**payload, "contents": suffix, "cachedContent": name}, name
+
+    def invalidate(self, name):
+        """伺服器不認得這個快取了：標記成需要重建，下一次用到時再建立。"""
+        with self._lock:
+            self.stats["fallbacks"] += 1
+            for entry in self.entries.values():
+                if entry.get("name") == name:
+                    entry.update(state="failed", retry_at=0.0, refreshing=False)
+        PROMPT_CACHE_EVENTS.labels("fallback").inc()
+        logger.warning("cachedContent %s 已失效，改送完整的 payload。", name)
+
+    def record_usage(self, result):
+        usage = (result or {}).get("usageMetadata") or {}
+        prompt_tokens = usage.get("promptTokenCount") or 0
+        cached_tokens = usage.get("cachedContentTokenCount") or 0
+        with self._lock:
+            self.stats["cached_prompt_tokens"] += cached_tokens
+            self.stats["uncached_prompt_tokens"] += max(0, prompt_tokens - cached_tokens)
+
+    # --- 背景工作 ---
+
+    def _url(self, path):
+        return f"{self.api_base}/{path}?key={self.api_key}"
+
+    def _create(self, key, prefix):
+        model, role_prompt, _ = key
+        if self.estimate_tokens and self.estimate_tokens(prefix) < self.min_tokens:
+            with self._lock:
+                self.entries[key] = {"state": "failed", "retry_at": float("inf")}
+            return
+        body = {
+            "model": f"models/{model}",
+            "displayName": f"xiaoyun-persona-{hashlib.sha256(role_prompt.encode('utf-8')).hexdigest()[:12]}",
+            "contents": prefix,
+            "ttl": f"{self.ttl_seconds}s",
+        }
+        try:
+            response = self.session.post(self._url("cachedContents"), json=body, timeout=30)
+            response.raise_for_status()
+            created = response.json()
+        except Exception as e:
+            logger.warning("建立角色設定快取失敗 (%s)，%s 秒後再試: %s", model, CREATE_RETRY_SECONDS, e)
+            PROMPT_CACHE_EVENTS.labels("create_failed").inc()
+            with self._lock:
+                self.entries[key] = {"state": "failed", "retry_at": time.time() + CREATE_RETRY_SECONDS}
+            return
+        tokens = (created.get("usageMetadata") or {}).get("totalTokenCount")
+        with self._lock:
+            self.entries[key] = {"state": "ready", "name": created["name"], "expires_at": time.time() + self.ttl_seconds,
+                                 "tokens": tokens, "refreshing": False}
+        PROMPT_CACHE_EVENTS.labels("created").inc()
+        logger.info("已建立角色設定快取 %s (%s, %s tokens)", created["name"], model, tokens)
+
+    def _refresh(self, key, name):
+        try:
+            response = self.session.patch(self._url(name) + "&updateMask=ttl", json={"ttl": f"{self.ttl_seconds}s"}, timeout=15)
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning("延長角色設定快取 %s 的 TTL 失敗，之後會重新建立: %s", name, e)
+            with self._lock:
+                if (entry := self.entries.get(key)) and entry.get("name") == name:
+                    entry.update(state="failed", retry_at=0.0, refreshing=False)
+            return
+        with self._lock:
+            if (entry := self.entries.get(key)) and entry.get("name") == name:
+                entry.update(expires_at=time.time() + self.ttl_seconds, refreshing=False)
+        PROMPT_CACHE_EVENTS.labels("refreshed").inc()
+
+    def close(self):
+        """行程結束時刪掉自己建立的快取，不用等 TTL 到期才停止計費。"""
+        with self._lock:
+            names = [entry["name"] for entry in self.entries.values() if entry.get("state") == "ready"]
+            self.entries.clear()
+        for name in names:
+            try:
+                self.session.delete(self._url(name), timeout=3)
+            except Exception:
+                pass
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = [
+                {"model": key[0], "state": entry["state"], "name": entry.get("name"), "tokens": entry.get("tokens"),
+                 "expires_in_seconds": round(entry["expires_at"] - now) if "expires_at" in entry else None}
+                for key, entry in self.entries.items()
+            ]
+        total = stats["cached_prompt_tokens"] + stats["uncached_prompt_tokens"]
+        stats["cached_token_ratio"] = round(stats["cached_prompt_tokens"] / total, 3) if total else None
+        return stats
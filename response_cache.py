@@ -0,0 +1,168 @@
+"""常見短訊息 (早安、晚安、摸摸…) 的回覆池快取：同一個 key 保留幾則不同的回覆，重複的招呼直接從池子裡挑，不必每次都帶完整歷史呼叫 Gemini。
+
+- key = (正規化後的訊息, 台灣時段, 粗略的對話脈絡指紋)；只有列在 cacheable_messages 的訊息才會快取 (預設關閉，RESPONSE_CACHE_ENABLED=1 開啟)。
+- 池子裡的回覆是背景用通用的角色設定 (不含任何用戶的歷史或記憶筆記) 生成的，所以可以給所有用戶共用。
+- 池子至少有 RESPONSE_CACHE_MIN_VARIANTS 則未過期的回覆才算命中，並避免連續給同一位用戶同一則；
+  未命中時照常即時生成，同時在背景補池子。命中時若挑到的回覆超過 RESPONSE_CACHE_REFRESH_SECONDS，背景生成一則新的換掉最舊的。
+- 背景生成受每分鐘額度限制；命中率、補池次數與送出回覆的新鮮度 (生成後經過的秒數) 都有統計。
+"""
+import collections
+import logging
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_POOL_SIZE = int(os.getenv("RESPONSE_CACHE_POOL_SIZE", "4"))
+RESPONSE_CACHE_MIN_VARIANTS = int(os.getenv("RESPONSE_CACHE_MIN_VARIANTS", "2"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_REFRESH_SECONDS = int(os.getenv("RESPONSE_CACHE_REFRESH_SECONDS", "900"))
+RESPONSE_CACHE_MAX_WORKERS = int(os.getenv("RESPONSE_CACHE_MAX_WORKERS", "2"))
+RESPONSE_CACHE_MAX_TRACKED_USERS = 10000  # 記住每位用戶上一次拿到哪一則，用來避免連續重複
+
+DEFAULT_CACHEABLE_MESSAGES = (
+    "早安", "午安", "晚安", "早", "安安", "哈囉", "你好", "嗨", "hi", "hello", "我回來了", "回來了",
+    "摸摸", "摸摸頭", "抱抱", "秀秀", "乖乖", "好可愛", "可愛", "想你", "愛你", "晚安小雲", "早安小雲", "小雲",
+    "嗯...", "嗯?", "喔...", "噢...", "真的嗎", "真的假的", "是喔", "好可憐", "好委屈",
+)
+
+SERVED_AGE = metrics.REGISTRY.histogram(
+    "xiaoyun_response_cache_served_age_seconds", "從回覆池送出的回覆生成後經過的秒數",
+    buckets=(30, 60, 120, 300, 600, 900, 1800, 3600))
+POOL_FILLS = metrics.REGISTRY.counter(
+    "xiaoyun_response_cache_fills_total", "回覆池背景生成次數，依結果 (added / duplicate / failed / skipped_budget) 區分", ("outcome",))
+
+_TRAILING_NOISE = re.compile(r"[\s!~。…]+$")
+
+
+def normalize_message(text):
+    """全形轉半形、轉小寫、去掉空白與結尾的驚嘆號 / 波浪號 (問號保留，「嗯?」和「嗯」意思不同)。"""
+    normalized = unicodedata.normalize("NFKC", text or "").strip().lower()
+    normalized = _TRAILING_NOISE.sub("", normalized) or normalized
+    return re.sub(r"\s+", "", normalized)
+
+
+class ResponseCache:
+    def __init__(self, generate, budget, cacheable_messages=DEFAULT_CACHEABLE_MESSAGES, enabled=RESPONSE_CACHE_ENABLED,
+                 pool_size=RESPONSE_CACHE_POOL_SIZE, min_variants=RESPONSE_CACHE_MIN_VARIANTS,
+                 ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, refresh_seconds=RESPONSE_CACHE_REFRESH_SECONDS):
+        # 說明：generate(message, period, fingerprint) 在背景執行緒呼叫，回傳回覆 JSON 字串或 None
+        self.generate = generate
+        self.budget = budget
+        self.cacheable_messages = frozenset(normalize_message(message) for message in cacheable_messages)
+        self.enabled = enabled
+        self.pool_size = pool_size
+        self.min_variants = min_variants
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        # key -> [{"response", "created_at"}]
+        self.pools = {}
+        self.stats = {"hits": 0, "misses": 0, "fills": 0, "refreshes": 0, "failed": 0, "skipped_budget": 0}
+        self._last_served = collections.OrderedDict()
+        self._filling = set()
+        self._served_age_total = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=RESPONSE_CACHE_MAX_WORKERS, thread_name_prefix="response-cache")
+
+    def key(self, message, period, fingerprint):
+        """可快取時回傳 key，否則回傳 None。"""
+        if not self.enabled:
+            return None
+        normalized = normalize_message(message)
+        if normalized not in self.cacheable_messages:
+            return None
+        return normalized, period, fingerprint
+
+    def get(self, user_id, key):
+        """從池子挑一則回覆；未命中時回傳 None，並在背景補池子。"""
+        now = time.time()
+        with self._lock:
+            pool = [entry for entry in self.pools.get(key, []) if now - entry["created_at"] < self.ttl_seconds]
+            self.pools[key] = pool
+            last = self._last_served.get(user_id)
+            choices = [entry for entry in pool if entry["response"] != last]
+            if len(pool) < self.min_variants or not choices:
+                self.stats["misses"] += 1
+                entry = None
+            else:
+                self.stats["hits"] += 1
+                entry = random.choice(choices)
+                age = now - entry["created_at"]
+                self._served_age_total += age
+                self._last_served[user_id] = entry["response"]
+                self._last_served.move_to_end(user_id)
+                while len(self._last_served) > RESPONSE_CACHE_MAX_TRACKED_USERS:
+                    self._last_served.popitem(last=False)
+        metrics.record_cache_lookup("response_cache", entry is not None)
+        if entry is None:
+            self._schedule(key)
+            return None
+        SERVED_AGE.labels().observe(age)
+        if age >= self.refresh_seconds or len(pool) < self.pool_size:
+            self._schedule(key)
+        return entry["response"]
+
+    def _schedule(self, key):
+        with self._lock:
+            if key in self._filling:
+                return
+            if not self.budget.try_acquire():
+                self.stats["skipped_budget"] += 1
+                POOL_FILLS.labels("skipped_budget").inc()
+                return
+            self._filling.add(key)
+        self._executor.submit(self._fill, key)
+
+    def _fill(self, key):
+        try:
+            response = self.generate(*key)
+        except Exception as e:
+            logger.warning("回覆池背景生成失敗 (%s): %s", key, e)
+            response = None
+        now = time.time()
+        with self._lock:
+            self._filling.discard(key)
+            if not response:
+                self.stats["failed"] += 1
+                POOL_FILLS.labels("failed").inc()
+                return
+            pool = [entry for entry in self.pools.get(key, []) if now - entry["created_at"] < self.ttl_seconds]
+            if any(entry["response"] == response for entry in pool):
+                POOL_FILLS.labels("duplicate").inc()
+                return
+            if len(pool) >= self.pool_size:
+                pool.remove(min(pool, key=lambda entry: entry["created_at"]))
+                self.stats["refreshes"] += 1
+            else:
+                self.stats["fills"] += 1
+            pool.append({"response": response, "created_at": now})
+            self.pools[key] = pool
+            needs_more = len(pool) < self.pool_size
+        POOL_FILLS.labels("added").inc()
+        # 說明：第一次補池子時連續生成到 pool_size 則 (仍受額度限制)，之後才開始命中
+        if needs_more:
+            self._schedule(key)
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            stats = dict(self.stats)
+            ages = [now - entry["created_at"] for pool in self.pools.values() for entry in pool]
+            stats["keys"] = sum(1 for pool in self.pools.values() if pool)
+            stats["filling"] = len(self._filling)
+            served_age_total = self._served_age_total
+        answered = stats["hits"] + stats["misses"]
+        stats["enabled"] = self.enabled
+        stats["entries"] = len(ages)
+        stats["hit_rate"] = round(stats["hits"] / answered, 3) if answered else None
+        stats["avg_served_age_seconds"] = round(served_age_total / stats["hits"], 1) if stats["hits"] else None
+        stats["oldest_entry_age_seconds"] = round(max(ages), 1) if ages else None
+        return stats
@@ -0,0 +1,473 @@
+"""用戶狀態 (user_id -> UserState) 的儲存介面與 SQLite 後端。
+
+- StateStore：app.user_states 的介面，跟 dict 一樣 (get / [] / pop / items / len / in)，呼叫端持有建立時傳入的鎖。
+  prepare() 在拿鎖之前呼叫，把慢的讀取先做掉；start() 啟動背景工作、flush() 把還沒寫出去的變更寫出去、status() 給 /memory_status。
+  USER_STATE_BACKEND=memory (預設) 用 tiered_state.TieredUserStates (行程內，閒置用戶壓縮成冷資料)；=sqlite 用 SqliteStateStore。
+- SqliteStateStore：所有 gunicorn worker 共用同一個 SQLite 檔 (WAL 模式，讀不擋寫)，重啟後記憶也還在。
+  - 讀取穿透快取：get() 先看行程內快取，沒有才讀 DB；快取超過 USER_STATE_VALIDATE_SECONDS 沒驗證時，
+    先只查 generation，別的 worker 寫過才重新載入。
+    有還沒寫出去的改動也一樣要驗證：別的 worker 寫過就改用對方的版本、重做這邊的改動 (見下)，不在舊副本上繼續疊。
+  - 延遲批次寫入：快取裡的 UserState 會記下每一筆改動 (UserState.journal)；背景執行緒每 USER_STATE_FLUSH_MS
+    把有改動的用戶序列化，內容沒變的跳過，其餘在同一個交易裡寫出去。序列化 (JSON + zlib) 與寫檔都在鎖外。
+  - 每位用戶一列，以 generation 做樂觀鎖：寫入時只在 generation 跟讀到的一樣才成功 (compare-and-set)。
+    撞到 (別的 worker 先寫過) 時讀回對方的版本、在上面重做這邊還沒寫出去的改動再寫 (最多 USER_STATE_CONFLICT_RETRIES 次，
+    之後留給下一批)，用戶的對話輪、秘密、情境不會因為撞到而丟掉 (status 的 conflicts / rebased)。
+    新的一列從隨機的 generation 開始，清掉又重建的用戶不會被舊快取的 generation 誤認 (ABA)。
+  - 讀 DB (快取未命中或驗證) 在 prepare() 裡、全域鎖外做，同一位用戶用分段鎖避免重複讀；
+    app 先 prepare() 再拿 user_state_lock (見 app.locked_user_state)，鎖內的 get() 只看快取。
+    沒先 prepare() 的 get() 仍會在鎖內讀 (status 的 locked_reads)。
+- 只有 UserState 存進 DB (含記憶筆記與還沒摺進筆記的對話輪)；正在進行中的背景工作等暫時狀態仍是各 worker 自己的。
+"""
+import abc
+import atexit
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+import metrics
+import user_state
+
+try:
+    import gevent
+    import gevent.monkey
+except ImportError:  # pragma: no cover - 只有 gevent worker 需要
+    gevent = None
+
+logger = logging.getLogger(__name__)
+
+USER_STATE_BACKEND = os.getenv("USER_STATE_BACKEND", "memory")
+# 說明：不放暫存目錄，重啟 (或系統清 /tmp) 後記憶才會還在；多台機器時要指到共用的持久磁碟
+USER_STATE_SQLITE_PATH = os.getenv("USER_STATE_SQLITE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "xiaoyun_user_state.sqlite3"))
+USER_STATE_FLUSH_MS = int(os.getenv("USER_STATE_FLUSH_MS", "50"))
+USER_STATE_VALIDATE_SECONDS = float(os.getenv("USER_STATE_VALIDATE_SECONDS", "1"))
+USER_STATE_CACHE_IDLE_SECONDS = int(os.getenv("USER_STATE_CACHE_IDLE_SECONDS", "600"))
+USER_STATE_COMPRESS_LEVEL = int(os.getenv("USER_STATE_COMPRESS_LEVEL", "6"))
+USER_STATE_CONFLICT_RETRIES = int(os.getenv("USER_STATE_CONFLICT_RETRIES", "3"))
+USER_STATE_LOAD_LOCKS = 64  # prepare() 依 user_id 分段的鎖數
+USER_STATE_SNAPSHOT_CHUNK = 256  # 背景寫入每拿一次鎖最多序列化幾位用戶
+
+STORE_OPS = metrics.REGISTRY.counter(
+    "xiaoyun_user_state_store_ops_total", "SQLite 狀態儲存的操作 (cache_hit / db_read / reload / rebase / write / skipped_unchanged / delete / conflict)",
+    ("op",))
+FLUSH_SECONDS = metrics.REGISTRY.histogram(
+    "xiaoyun_user_state_flush_seconds", "一批延遲寫入 (序列化 + 交易) 的耗時",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+
+
+def _off_hub(func, *args):
+    """gevent worker 下 sqlite3 的 C 呼叫會卡住整個 hub，丟到 gevent 的原生執行緒池跑；其他情況直接呼叫。"""
+    if gevent is not None and gevent.monkey.is_module_patched("threading"):
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+def encode_state(data):
+    """UserState.to_dict() 的結果 -> 未壓縮的 JSON bytes。to_dict() 要在鎖內呼叫，這裡可以在鎖外做。"""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def decode_state(raw, shared_head, capacity):
+    """未壓縮的 JSON bytes -> UserState。"""
+    return user_state.UserState.from_dict(json.loads(raw), shared_head, capacity)
+
+
+class StateStore(abc.ABC):
+    """user_id -> UserState 的儲存介面；方法都假設呼叫端持有 self.lock。少實作任何一個抽象方法，建立時就會失敗。"""
+
+    @abc.abstractmethod
+    def get(self, user_id, default=None):
+        ...
+
+    @abc.abstractmethod
+    def __setitem__(self, user_id, state):
+        ...
+
+    @abc.abstractmethod
+    def pop(self, user_id, default=None):
+        ...
+
+    @abc.abstractmethod
+    def items(self):
+        """目前在行程內的用戶 (不保證包含全部)。"""
+
+    @abc.abstractmethod
+    def __len__(self):
+        ...
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def prepare(self, user_id):
+        """呼叫端拿 self.lock 之前先呼叫：把這位用戶可能要做的慢動作 (例如讀 DB) 先在鎖外做完。預設不做事。"""
+
+    def start(self):
+        """啟動背景工作 (冷熱分層掃描、延遲寫入)。"""
+
+    def flush(self):
+        """把還沒寫出去的變更寫出去。"""
+
+    @abc.abstractmethod
+    def status(self):
+        ...
+
+
+class _CacheEntry:
+    __slots__ = ("state", "generation", "validated_at", "accessed_at", "digest", "flushing")
+
+    def __init__(self, state, generation, now, digest=None):
+        if state.journal is None:
+            state.journal = []
+        self.state = state
+        self.generation = generation  # 0 = DB 裡還沒有這一列
+        self.validated_at = now
+        self.accessed_at = now
+        self.digest = digest  # 上次寫出 (或讀入) 時未壓縮 JSON 的 crc32，內容沒變就不寫
+        self.flushing = False  # 正在某一批寫入裡；寫完之前不重新載入，免得把自己剛寫的改動再重做一次
+
+    @property
+    def dirty(self):
+        return bool(self.state.journal) or not self.generation
+
+
+class SqliteStateStore(StateStore):
+    def __init__(self, lock, shared_head, capacity, path=USER_STATE_SQLITE_PATH, flush_ms=USER_STATE_FLUSH_MS,
+                 validate_seconds=USER_STATE_VALIDATE_SECONDS, cache_idle_seconds=USER_STATE_CACHE_IDLE_SECONDS,
+                 compress_level=USER_STATE_COMPRESS_LEVEL, conflict_retries=USER_STATE_CONFLICT_RETRIES):
+        self.lock = lock
+        self.shared_head = shared_head
+        self.capacity = capacity
+        self.path = path
+        self.flush_ms = flush_ms
+        self.validate_seconds = validate_seconds
+        self.cache_idle_seconds = cache_idle_seconds
+        self.compress_level = compress_level
+        self.conflict_retries = conflict_retries
+        self.cache = {}
+        # 說明：/clear_memory 清掉、還沒寫出去的刪除；期間 get() 不能再從 DB 讀到舊的那一列
+        self.pending_deletes = set()
+        # 說明：user_id -> 查過 DB 確定沒有這一列的時間；新用戶 prepare() 之後，鎖內的 get() 不必再查一次
+        self.absent = {}
+        self.stats = {"cache_hits": 0, "db_reads": 0, "validations": 0, "reloads": 0, "writes": 0,
+                      "skipped_unchanged": 0, "deletes": 0, "conflicts": 0, "rebased": 0, "flushes": 0, "flush_failed": 0,
+                      "locked_reads": 0}
+        self._flush_total = 0.0
+        self._flush_max = 0.0
+        # 說明：讀取用每條執行緒自己的連線 (prepare() 在鎖外、多條執行緒同時讀)，背景寫入用 writer
+        self._local = threading.local()
+        self._load_locks = [threading.Lock() for _ in range(USER_STATE_LOAD_LOCKS)]
+        self._writer = self._connect()
+        self._flush_lock = threading.Lock()
+        self._started = False
+        self._writer.executescript(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            " user_id TEXT PRIMARY KEY, generation INTEGER NOT NULL, data BLOB NOT NULL, updated_at REAL NOT NULL"
+            ") WITHOUT ROWID")
+        self._stored_users = _off_hub(self._count_rows, self._writer)
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # 說明：WAL 下 NORMAL 只在 checkpoint 時 fsync；斷電最多丟最後幾批寫入，不會損毀資料庫
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _reader(self):
+        if (connection := getattr(self._local, "reader", None)) is None:
+            connection = self._local.reader = self._connect()
+        return connection
+
+    def _count_rows(self, connection=None):
+        return (connection or self._reader()).execute("SELECT COUNT(*) FROM user_state").fetchone()[0]
+
+    def prepare(self, user_id):
+        """在 self.lock 外把這位用戶讀進快取 (或驗證快取)，之後鎖內的 get() 直接命中、不碰 DB。呼叫端不可持有 self.lock。
+        同一位用戶同時只有一條執行緒在讀 (依 user_id 分段的鎖)，不同用戶可以同時讀。"""
+        with self._load_locks[hash(user_id) % len(self._load_locks)]:
+            # 說明：這裡只看快取的一個項目，不拿全域鎖；看錯了頂多多讀一次，放回快取時 (鎖內) 會再確認
+            entry = self.cache.get(user_id)
+            if self._needs_read(user_id, entry, time.monotonic()):
+                self._refresh(user_id, entry)
+
+    # --- dict 介面 (呼叫端持有 self.lock) ---
+
+    def get(self, user_id, default=None):
+        now = time.monotonic()
+        entry = self.cache.get(user_id)
+        if self._needs_read(user_id, entry, now):
+            # 說明：呼叫端沒先 prepare() (或剛好過了驗證時間)，只好在鎖內讀 DB；status 的 locked_reads 應該接近 0
+            self.stats["locked_reads"] += 1
+            self._refresh(user_id, entry)
+            entry = self.cache.get(user_id)
+        elif entry is not None:
+            self.stats["cache_hits"] += 1
+            STORE_OPS.labels("cache_hit").inc()
+        if entry is None:
+            return default
+        entry.accessed_at = now
+        return entry.state
+
+    def _needs_read(self, user_id, entry, now):
+        if user_id in self.pending_deletes:
+            return False
+        if entry is None and now - self.absent.get(user_id, -self.validate_seconds) < self.validate_seconds:
+            return False
+        # 說明：還沒寫出去的改動也要定期驗證；別的 worker 寫過就先在對方的版本上重做，不在舊的副本上越疊越多
+        return entry is None or (not entry.flushing and now - entry.validated_at >= self.validate_seconds)
+
+    def _read_row(self, user_id, known_generation, connection=None):
+        """讀這位用戶的列：回傳 None (沒有這一列)、(generation,) (跟 known_generation 一樣，不必重讀內容)
+        或 (generation, UserState, digest)。要經過 _off_hub() 呼叫。"""
+        connection = connection or self._reader()
+        if known_generation is not None:
+            row = connection.execute("SELECT generation FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None or row[0] == known_generation:
+                return row
+        row = connection.execute("SELECT generation, data FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        try:
+            raw = zlib.decompress(row[1])
+            return row[0], decode_state(raw, self.shared_head, self.capacity), zlib.crc32(raw)
+        except (ValueError, KeyError, TypeError, zlib.error) as e:
+            # 說明：讀不出來的列當成新用戶，沿用它的 generation，下次寫入直接蓋掉
+            logger.error("讀取 User ID (%s) 的狀態失敗，改用新的狀態: %s", user_id, e)
+            return row[0], user_state.UserState(self.shared_head), None
+
+    def _refresh(self, user_id, entry):
+        """讀 DB (載入或驗證 entry)，再在鎖內把結果放進快取。"""
+        known_generation = entry.generation if entry is not None else None
+        row = _off_hub(self._read_row, user_id, known_generation)
+        with self.lock:
+            self._apply_row(user_id, entry, known_generation, row, time.monotonic())
+
+    def _apply_row(self, user_id, entry, known_generation, row, now):
+        # 說明：讀 DB 期間快取已經變了 (別的執行緒載入、寫出或清掉這位用戶)，以快取為準，這次讀到的不用
+        if (user_id in self.pending_deletes or self.cache.get(user_id) is not entry
+                or entry is not None and (entry.flushing or entry.generation != known_generation)):
+            return
+        if entry is None:
+            self.stats["db_reads"] += 1
+            STORE_OPS.labels("db_read").inc()
+            if row is None:
+                self.absent[user_id] = now
+            else:
+                self.cache[user_id] = _CacheEntry(row[1], row[0], now, digest=row[2])
+            return
+        self.stats["validations"] += 1
+        if row is None and entry.generation:
+            # 說明：別的 worker 清掉了這位用戶；這邊還有沒寫出去的改動就接到新的狀態上，否則直接丟掉快取
+            if not entry.state.journal:
+                del self.cache[user_id]
+                self.absent[user_id] = now
+                return
+            self._rebase(user_id, entry, 0, user_state.UserState(self.shared_head), None)
+        elif row is not None and len(row) == 3:
+            self._rebase(user_id, entry, *row)
+        entry.validated_at = now
+
+    def _rebase(self, user_id, entry, generation, theirs, digest):
+        """改用 DB 裡 (別的 worker 寫的) 版本，再重做這邊還沒寫出去的改動；呼叫端持有 self.lock。"""
+        journal = entry.state.journal
+        if journal and theirs.epoch != entry.state.epoch:
+            # 說明：對方的版本在期間被 /clear_memory 清掉過，這邊的記憶筆記操作不再適用；對話輪、秘密、情境照樣重做
+            journal[:] = [(name, args) for name, args in journal if name not in user_state.NOTE_OPS]
+        theirs.replay(journal)
+        theirs.journal = journal
+        entry.state, entry.generation, entry.digest = theirs, generation, digest
+        self.stats["reloads"] += 1
+        STORE_OPS.labels("reload").inc()
+        if journal:
+            self.stats["rebased"] += 1
+            STORE_OPS.labels("rebase").inc()
+            logger.info("User ID (%s) 的狀態被別的 worker 更新過，在新版本上重做 %s 筆還沒寫出去的改動。", user_id, len(journal))
+
+    def __setitem__(self, user_id, state):
+        if user_id in self.cache:
+            # 說明：直接換掉整份狀態等同先刪再建，不跟 DB 裡的舊版本合併
+            self.pending_deletes.add(user_id)
+        self.absent.pop(user_id, None)
+        self.cache[user_id] = _CacheEntry(state, 0, time.monotonic())
+
+    def pop(self, user_id, default=None):
+        entry = self.cache.pop(user_id, None)
+        self.pending_deletes.add(user_id)
+        return entry.state if entry is not None else default
+
+    def items(self):
+        """只列這個 worker 快取裡的用戶。"""
+        return [(user_id, entry.state) for user_id, entry in self.cache.items()]
+
+    def __len__(self):
+        """DB 裡的用戶數 (背景執行緒定期更新，不在鎖內查 DB；還沒寫出去的新用戶不算)。"""
+        return self._stored_users
+
+    # --- 延遲寫入 ---
+
+    def flush(self):
+        """把有改動的用戶寫進 DB，回傳實際寫入的列數。
+        跟別的 worker 撞到的用戶會重新載入、重做改動後再寫 (最多 conflict_retries 次)；還是撞到就留給下一批，改動不會丟。"""
+        with self._flush_lock:
+            written = 0
+            for _ in range(self.conflict_retries + 1):
+                batch_written, conflicts = self._flush_once()
+                written += batch_written
+                if not conflicts:
+                    break
+            else:
+                logger.warning("%s 位用戶的狀態連續 %s 次跟別的 worker 撞到，留到下一批再寫。", conflicts, self.conflict_retries + 1)
+            return written
+
+    def _flush_once(self):
+        """寫一批，回傳 (寫入的列數, 撞到的用戶數)。"""
+        started = time.perf_counter()
+        with self.lock:
+            dirty = [(user_id, entry) for user_id, entry in self.cache.items() if entry.dirty]
+            for _, entry in dirty:
+                entry.flushing = True
+            deletes, self.pending_deletes = self.pending_deletes, set()
+        if not dirty and not deletes:
+            return 0, 0
+        # 說明：to_dict() 要在鎖內做，但分批拿鎖，不讓一大批用戶的序列化長時間擋住請求
+        batch = []
+        for index in range(0, len(dirty), USER_STATE_SNAPSHOT_CHUNK):
+            with self.lock:
+                batch += [(user_id, entry, entry.generation, len(entry.state.journal), entry.state.to_dict(self.shared_head))
+                          for user_id, entry in dirty[index:index + USER_STATE_SNAPSHOT_CHUNK]]
+        writes, unchanged = [], []
+        for user_id, entry, generation, logged, data in batch:
+            raw = encode_state(data)
+            if (digest := zlib.crc32(raw)) == entry.digest and generation:
+                # 說明：改動互相抵銷 (例如設了情境又取走)，內容跟 DB 裡的一樣
+                unchanged.append((entry, logged))
+            else:
+                writes.append((user_id, entry, generation, logged, digest, zlib.compress(raw, self.compress_level)))
+        try:
+            written, conflicts = _off_hub(self._write_batch, deletes, writes)
+        except sqlite3.Error as e:
+            logger.error("寫入用戶狀態到 SQLite 失敗，下一批重試: %s", e)
+            self.stats["flush_failed"] += 1
+            with self.lock:
+                self.pending_deletes |= deletes
+                for _, entry, _, _, _ in batch:
+                    entry.flushing = False
+            return 0, 0
+        # 說明：撞到的用戶在鎖外讀回對方的版本，鎖內再重做這邊的改動 (下一輪 _flush_once 寫出去)
+        reloaded = [(user_id, entry, _off_hub(self._read_row, user_id, None, self._writer)) for user_id, entry in conflicts]
+        with self.lock:
+            for entry, logged, generation, digest in written:
+                entry.flushing = False
+                entry.generation, entry.digest = generation, digest
+                del entry.state.journal[:logged]
+            for entry, logged in unchanged:
+                entry.flushing = False
+                del entry.state.journal[:logged]
+            for user_id, entry, row in reloaded:
+                entry.flushing = False
+                if self.cache.get(user_id) is not entry:
+                    continue
+                if row is None:
+                    # 說明：寫入前這一列已被別的 worker 刪掉 (清掉記憶)，改動接到新的狀態上
+                    self._rebase(user_id, entry, 0, user_state.UserState(self.shared_head), None)
+                else:
+                    self._rebase(user_id, entry, *row)
+                entry.validated_at = time.monotonic()
+            self.stats["writes"] += len(written)
+            self.stats["skipped_unchanged"] += len(unchanged)
+            self.stats["deletes"] += len(deletes)
+            self.stats["conflicts"] += len(conflicts)
+            self.stats["flushes"] += 1
+        STORE_OPS.labels("write").inc(len(written))
+        STORE_OPS.labels("skipped_unchanged").inc(len(unchanged))
+        STORE_OPS.labels("delete").inc(len(deletes))
+        STORE_OPS.labels("conflict").inc(len(conflicts))
+        elapsed = time.perf_counter() - started
+        self._flush_total += elapsed
+        self._flush_max = max(self._flush_max, elapsed)
+        FLUSH_SECONDS.labels().observe(elapsed)
+        return len(written), len(conflicts)
+
+    def _write_batch(self, deletes, writes):
+        """在一個交易裡刪除與寫入，回傳 (寫成功的, 撞到的)；失敗時 rollback 並拋出 sqlite3.Error。"""
+        written, conflicts = [], []
+        now = time.time()
+        try:
+            self._writer.execute("BEGIN IMMEDIATE")
+            self._writer.executemany("DELETE FROM user_state WHERE user_id = ?", [(user_id,) for user_id in deletes])
+            for user_id, entry, generation, logged, digest, blob in writes:
+                if generation == 0:
+                    # 說明：新的一列從隨機的 generation 開始，被清掉又重建的用戶不會剛好撞上別的 worker 舊快取的 generation
+                    new_generation = random.getrandbits(62) + 1
+                    cursor = self._writer.execute(
+                        "INSERT INTO user_state (user_id, generation, data, updated_at) VALUES (?, ?, ?, ?) ON CONFLICT(user_id) DO NOTHING",
+                        (user_id, new_generation, blob, now))
+                else:
+                    new_generation = generation + 1
+                    cursor = self._writer.execute(
+                        "UPDATE user_state SET generation = ?, data = ?, updated_at = ? WHERE user_id = ? AND generation = ?",
+                        (new_generation, blob, now, user_id, generation))
+                if cursor.rowcount == 1:
+                    written.append((entry, logged, new_generation, digest))
+                else:
+                    conflicts.append((user_id, entry))
+            self._writer.execute("COMMIT")
+        except sqlite3.Error:
+            if self._writer.in_transaction:
+                self._writer.execute("ROLLBACK")
+            raise
+        return written, conflicts
+
+    def evict_idle(self, now=None):
+        """從快取移除閒置超過 cache_idle_seconds 且已寫出的用戶 (DB 裡還有)。"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            idle = [user_id for user_id, entry in self.cache.items()
+                    if not entry.dirty and not entry.flushing and now - entry.accessed_at >= self.cache_idle_seconds]
+            for user_id in idle:
+                del self.cache[user_id]
+            self.absent = {user_id: checked_at for user_id, checked_at in self.absent.items() if now - checked_at < self.validate_seconds}
+        return len(idle)
+
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        atexit.register(self.flush)
+
+        def _loop():
+            last_evict = time.monotonic()
+            while True:
+                time.sleep(self.flush_ms / 1000)
+                try:
+                    self.flush()
+                    if time.monotonic() - last_evict >= 60:
+                        self.evict_idle()
+                        self._stored_users = _off_hub(self._count_rows, self._writer)
+                        last_evict = time.monotonic()
+                except Exception as e:
+                    logger.error("用戶狀態背景寫入失敗: %s", e, exc_info=True)
+
+        threading.Thread(target=_loop, name="user-state-writer", daemon=True).start()
+
+    def status(self):
+        self._stored_users = stored = _off_hub(self._count_rows)
+        with self.lock:
+            stats = dict(self.stats)
+            cached = len(self.cache)
+            pending = sum(1 for entry in self.cache.values() if entry.dirty) + len(self.pending_deletes)
+        flushes = stats["flushes"]
+        return stats | {
+            "backend": "sqlite",
+            "path": self.path,
+            "cached_users": cached,
+            "stored_users": stored,
+            "pending_writes": pending,
+            "flush_ms": self.flush_ms,
+            "avg_flush_ms": round(self._flush_total / flushes * 1000, 3) if flushes else None,
+            "max_flush_ms": round(self._flush_max * 1000, 3) if flushes else None,
+        }
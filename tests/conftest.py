@@ -0,0 +1,16 @@
+"""測試共用設定：讓 tests/ 可以直接匯入專案根目錄與 benchmarks/ 底下的模組。
+
+app.py 匯入時會檢查 LINE / Gemini 的環境變數；測試不會真的呼叫外部 API，這裡先給假值。
+"""
+import logging
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, ROOT)
+
+for name, value in {"LINE_CHANNEL_ACCESS_TOKEN": "test", "LINE_CHANNEL_SECRET": "test", "GEMINI_API_KEY": "test",
+                    "BASE_URL": "http://127.0.0.1", "TRACE_SAMPLE_RATE": "0", "LOG_LEVEL": "WARNING"}.items():
+    os.environ.setdefault(name, value)
+logging.disable(logging.WARNING)
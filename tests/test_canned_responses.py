@@ -0,0 +1,37 @@
+"""預先寫好的回覆 (每日任務、小秘密)：送出時不找圖、不呼叫 Gemini；資料檔裡出現 image_theme 就拒絕載入。"""
+import json
+
+import pytest
+
+import app
+
+
+def _forbidden(*args, **kwargs):
+    raise AssertionError("預設回覆不應該對外呼叫")
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    replies = []
+    monkeypatch.setattr(app, "fetch_and_validate_image_with_priority", _forbidden)
+    monkeypatch.setattr(app, "call_gemini", _forbidden)
+    monkeypatch.setattr(app.line_bot_api, "reply_message", lambda reply_token, messages: replies.append(messages))
+    return replies
+
+
+@pytest.mark.parametrize("response_json", list(app.DAILY_TASKS.values()) + app.CAT_SECRETS_AND_DISCOVERIES)
+def test_canned_response_makes_no_outbound_calls(sent, response_json):
+    app.send_canned_response(response_json, "reply-token", "Ucanned")
+    [messages] = sent
+    assert messages[-1].quick_reply is not None
+    for obj in json.loads(response_json):
+        if obj["type"] == "image_key":
+            assert any(getattr(message, "original_content_url", None) == app.EXAMPLE_IMAGE_URLS[obj["key"]] for message in messages)
+
+
+@pytest.mark.parametrize("image", [{"type": "image_theme", "theme": "quiet corner"}, {"type": "image_key", "key": "no_such_key"}])
+def test_loader_rejects_images_that_need_a_search(tmp_path, image):
+    path = tmp_path / "canned_responses.json"
+    path.write_text(json.dumps({"cat_secrets": [{"response": [{"type": "text", "content": "咪"}, image]}]}), encoding="utf-8")
+    with pytest.raises(ValueError):
+        app.load_canned_responses(str(path))
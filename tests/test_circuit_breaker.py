@@ -0,0 +1,170 @@
+"""斷路器的狀態轉換 (closed → open → half_open → closed / open) 與打開時的 available() / CircuitOpenError，用手動前進的時鐘。"""
+import asyncio
+
+import pytest
+import requests
+
+import circuit_breaker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(request, clock):
+    return circuit_breaker.CircuitBreaker(f"test_{request.node.name}", slow_call_seconds=5.0, window=10, min_calls=4,
+                                          failure_rate=0.5, slow_rate=0.8, open_seconds=30.0, half_open_probes=2, clock=clock)
+
+
+def call(breaker, clock, error=None, seconds=0.1):
+    with breaker.track():
+        clock.advance(seconds)
+        if error is not None:
+            raise error
+
+
+def fail(breaker, clock):
+    with pytest.raises(requests.exceptions.ConnectionError):
+        call(breaker, clock, requests.exceptions.ConnectionError("boom"))
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status}", response=response)
+
+
+def open_breaker(breaker, clock):
+    for _ in range(breaker.min_calls):
+        fail(breaker, clock)
+    assert breaker.state == circuit_breaker.OPEN
+
+
+def test_stays_closed_until_min_calls(breaker, clock):
+    for _ in range(breaker.min_calls - 1):
+        fail(breaker, clock)
+    assert breaker.state == circuit_breaker.CLOSED
+    assert breaker.available()
+
+
+def test_opens_on_failure_rate(breaker, clock):
+    call(breaker, clock)
+    call(breaker, clock)
+    fail(breaker, clock)
+    assert breaker.state == circuit_breaker.CLOSED
+    fail(breaker, clock)
+    assert breaker.state == circuit_breaker.OPEN
+    assert breaker.status()["failure_rate"] == 0.5
+
+
+def test_opens_on_slow_calls(breaker, clock):
+    for _ in range(breaker.min_calls):
+        call(breaker, clock, seconds=6.0)
+    assert breaker.state == circuit_breaker.OPEN
+
+
+@pytest.mark.parametrize("status, counted", [(404, False), (400, False), (429, True), (503, True)])
+def test_only_dependency_errors_count(breaker, clock, status, counted):
+    for _ in range(breaker.min_calls):
+        with pytest.raises(requests.exceptions.HTTPError):
+            call(breaker, clock, http_error(status))
+    assert (breaker.state == circuit_breaker.OPEN) is counted
+
+
+def test_open_breaker_rejects_without_running_the_call(breaker, clock):
+    open_breaker(breaker, clock)
+    assert not breaker.available()
+    rejected = circuit_breaker.BREAKER_REJECTIONS.labels(breaker.name).value
+    ran = []
+    with pytest.raises(circuit_breaker.CircuitOpenError) as excinfo:
+        with breaker.track():
+            ran.append(True)
+    assert not ran
+    assert excinfo.value.dependency == breaker.name
+    # 說明：沿用既有的 requests 錯誤處理
+    assert isinstance(excinfo.value, requests.exceptions.ConnectionError)
+    assert circuit_breaker.BREAKER_REJECTIONS.labels(breaker.name).value == rejected + 1
+    assert breaker.status()["open_remaining_seconds"] == 30.0
+
+
+def test_half_open_after_open_seconds(breaker, clock):
+    open_breaker(breaker, clock)
+    clock.advance(29.9)
+    assert not breaker.available()
+    with pytest.raises(circuit_breaker.CircuitOpenError):
+        call(breaker, clock)
+    clock.advance(0.1)
+    # 說明：available() 只回報，不佔用試探名額、也不轉換狀態
+    assert breaker.available()
+    assert breaker.state == circuit_breaker.OPEN
+    assert breaker.acquire()
+    assert breaker.state == circuit_breaker.HALF_OPEN
+    assert breaker.acquire()
+    assert not breaker.acquire()
+
+
+def test_half_open_closes_after_successful_probes(breaker, clock):
+    open_breaker(breaker, clock)
+    clock.advance(30)
+    call(breaker, clock)
+    assert breaker.state == circuit_breaker.HALF_OPEN
+    call(breaker, clock)
+    assert breaker.state == circuit_breaker.CLOSED
+    assert breaker.status()["recent_calls"] == 0
+    # 說明：關上後重新累積，一次失敗不會馬上又打開
+    fail(breaker, clock)
+    assert breaker.state == circuit_breaker.CLOSED
+
+
+@pytest.mark.parametrize("probe", [
+    lambda breaker, clock: fail(breaker, clock),
+    lambda breaker, clock: call(breaker, clock, seconds=6.0),
+])
+def test_failed_or_slow_probe_reopens(breaker, clock, probe):
+    open_breaker(breaker, clock)
+    clock.advance(30)
+    call(breaker, clock)
+    probe(breaker, clock)
+    assert breaker.state == circuit_breaker.OPEN
+    # 說明：重新打開時從現在起算 open_seconds
+    assert not breaker.available()
+    clock.advance(29)
+    assert not breaker.available()
+    clock.advance(1)
+    assert breaker.available()
+
+
+def test_cancelled_probe_returns_its_slot(breaker, clock):
+    open_breaker(breaker, clock)
+    clock.advance(30)
+    with pytest.raises(asyncio.CancelledError):
+        call(breaker, clock, asyncio.CancelledError())
+    with pytest.raises(requests.exceptions.HTTPError):
+        call(breaker, clock, http_error(404))
+    assert breaker.state == circuit_breaker.HALF_OPEN
+    call(breaker, clock)
+    call(breaker, clock)
+    assert breaker.state == circuit_breaker.CLOSED
+
+
+def test_module_available_checks_every_named_breaker(breaker, clock, monkeypatch):
+    healthy = circuit_breaker.CircuitBreaker("test_healthy", 5.0, clock=clock)
+    monkeypatch.setitem(circuit_breaker.BREAKERS, "test_healthy", healthy)
+    monkeypatch.setitem(circuit_breaker.BREAKERS, "test_broken", breaker)
+    assert circuit_breaker.available("test_healthy", "test_broken")
+    open_breaker(breaker, clock)
+    assert circuit_breaker.available("test_healthy")
+    assert not circuit_breaker.available("test_healthy", "test_broken")
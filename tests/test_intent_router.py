@@ -0,0 +1,55 @@
+"""意圖路由：KeywordMatcher 與逐一 any(... in ...) 的結果一致，app.TEXT_ROUTER 與原本的 if/elif 觸發鏈一致。"""
+import random
+
+import pytest
+
+import app
+import intent_router
+import router_bench
+
+# 說明：互相重疊、互為前後綴的關鍵字，失敗連結與輸出合併寫錯時最容易漏掉
+OVERLAPPING_KEYWORDS = {
+    "he": ["he"], "she": ["she", "sh"], "his": ["his"], "hers": ["hers", "ers"],
+    "food": ["魚", "鮪魚", "鮪魚罐頭", "罐頭"], "eat": ["吃", "要不要吃", "吃飯"],
+}
+
+
+def _naive_labels(keywords_by_label, text):
+    return {label for label, keywords in keywords_by_label.items() if any(keyword in text for keyword in keywords)}
+
+
+@pytest.mark.parametrize("text", ["", "ushers", "hishershe", "s", "我買了鮪魚罐頭給你", "要不要吃魚", "吃吃吃飯", "鮪罐頭魚"])
+def test_keyword_matcher_overlapping_keywords(text):
+    matcher = intent_router.KeywordMatcher(OVERLAPPING_KEYWORDS)
+    assert matcher.labels(text) == _naive_labels(OVERLAPPING_KEYWORDS, text)
+
+
+def test_keyword_matcher_matches_any_scan_on_random_text():
+    rng = random.Random(46)
+    alphabet = "abcde魚吃罐"
+    for _ in range(200):
+        keywords_by_label = {f"label{index}": ["".join(rng.choices(alphabet, k=rng.randint(1, 4))) for _ in range(rng.randint(1, 3))]
+                             for index in range(rng.randint(1, 6))}
+        matcher = intent_router.KeywordMatcher(keywords_by_label)
+        for _ in range(20):
+            text = "".join(rng.choices(alphabet, k=rng.randint(0, 30)))
+            assert matcher.labels(text) == _naive_labels(keywords_by_label, text), (keywords_by_label, text)
+
+
+def _compared(result):
+    # 說明：secret_topic / secret_question 只是組成 secret_request 意圖的中間標籤，原本的觸發鏈沒有
+    intent, flags = result
+    return intent, flags - {"secret_topic", "secret_question"}
+
+
+EDGE_MESSAGES = [
+    "", " ", "嗯", " 嗯嗯 ", "哈", "哈哈哈哈哈哈", "呵呵", "哈呵", " 123 ", "12a", "？", "然後呢？",
+    "真的嗎", " 真的嗎 ", "真的嗎？", "秘密", "秘密嗎", "你的秘密是什麼", "我發現了一件事", "說說你的發現",
+    "HELLO 小雲", "要不要吃？", "餓不餓", "小雲有什麼秘密嗎?",
+]
+
+
+@pytest.mark.parametrize("message", sorted(set(router_bench.build_corpus(2000)) | set(EDGE_MESSAGES)
+                                           | {command + suffix for command in app.TEXT_COMMAND_INTENTS for suffix in ("", " ")}))
+def test_text_router_matches_legacy_chain(message):
+    assert _compared(router_bench.router_route(message)) == _compared(router_bench.legacy_route(message))
@@ -0,0 +1,78 @@
+"""encode_body() 的輸出跟 dumps(payload) 逐位元組相同 (contents 在最前面時)，orjson 與標準庫兩種編碼都要成立。"""
+import json
+
+import pytest
+
+import app
+import payload_codec
+
+ROLE_PROMPT = app.ROLE_PROMPTS["chat"]
+SHORT_PROMPT = app.ROLE_PROMPTS["quick_replies"][:100]
+MEMORY_NOTE = {"text": "（小雲記得關於這位主人的事：主人喜歡晚上聊天，最近在忙工作）"}
+FIRST_REPLY = {"role": "model", "parts": [{"text": json.dumps([{"type": "text", "content": "咪～"}], ensure_ascii=False)}]}
+IMAGE = {"inline_data": {"mime_type": "image/png", "data": "iVBORw0KGgoAAAANSUhEUgAAAAEAAAAB"}}
+
+
+def _turn(text):
+    return [{"role": "user", "parts": [{"text": text}]}, {"role": "model", "parts": [{"text": f"咪～ {text} \"quoted\" \\ \n"}]}]
+
+
+PAYLOADS = {
+    "role prompt + history": {"contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}]}, FIRST_REPLY] + _turn("早安") + _turn("摸摸頭")},
+    "memory note part": {"contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}, MEMORY_NOTE]}, FIRST_REPLY] + _turn("晚安")},
+    "generation config": {"contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}]}, FIRST_REPLY] + _turn("hi"),
+                          "generationConfig": {"temperature": 0.8, "maxOutputTokens": 512, "thinkingConfig": {"thinkingBudget": 0}}},
+    "inline image": {"contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}]}, FIRST_REPLY,
+                                  {"role": "user", "parts": [IMAGE, {"text": "你看這張照片"}]}]},
+    "long prefix only": {"contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}]}]},
+    "two long messages": {"contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}]},
+                                       {"role": "model", "parts": [{"text": ROLE_PROMPT[::-1]}]}] + _turn("嗯")},
+    "short prompt": {"contents": [{"role": "user", "parts": [{"text": SHORT_PROMPT}]}] + _turn("喵")},
+    "long text after image": {"contents": [{"role": "user", "parts": [IMAGE]}, {"role": "user", "parts": [{"text": ROLE_PROMPT}]}]},
+    "extra message key": {"contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}], "extra": 1}] + _turn("喵")},
+    "cached suffix": {"contents": _turn("喵喵"), "cachedContent": "cachedContents/abc123"},
+    "empty contents": {"contents": [], "generationConfig": {"temperature": 0.8}},
+    "cache create body": {"model": "models/gemini-2.5-flash", "displayName": "xiaoyun-persona-1",
+                          "contents": [{"role": "user", "parts": [{"text": ROLE_PROMPT}]}, FIRST_REPLY], "ttl": "3600s"},
+}
+
+
+def _contents_first(payload):
+    return {"contents": payload["contents"]} | payload
+
+
+@pytest.fixture(params=["orjson", "json"])
+def codec(request, monkeypatch):
+    if request.param == "orjson":
+        if payload_codec.orjson is None:
+            pytest.skip("orjson 沒有安裝")
+        monkeypatch.setattr(payload_codec, "dumps", payload_codec.orjson.dumps)
+    else:
+        monkeypatch.setattr(payload_codec, "dumps", lambda obj: json.dumps(obj, separators=(",", ":")).encode("ascii"))
+    # 說明：預先編好的 bytes 是用當時的 dumps 產生的，換編碼器前後都要清掉
+    payload_codec._encoded_message.cache_clear()
+    yield request.param
+    payload_codec._encoded_message.cache_clear()
+
+
+def test_role_prompt_is_long_enough_to_preencode():
+    assert len(ROLE_PROMPT) >= payload_codec.PREENCODE_MIN_CHARS > len(SHORT_PROMPT)
+
+
+@pytest.mark.parametrize("name", PAYLOADS)
+def test_encode_body_matches_dumps(codec, name):
+    payload = _contents_first(PAYLOADS[name])
+    # 說明：第二次會走已快取的前綴 bytes
+    assert payload_codec.encode_body(payload) == payload_codec.dumps(payload)
+    assert payload_codec.encode_body(payload) == payload_codec.dumps(payload)
+    assert json.loads(payload_codec.encode_body(payload)) == payload
+
+
+def test_encode_body_is_same_json_when_contents_not_first(codec):
+    payload = {"generationConfig": {"temperature": 0.8}, "contents": PAYLOADS["role prompt + history"]["contents"]}
+    assert json.loads(payload_codec.encode_body(payload)) == payload
+
+
+def test_encode_body_with_generation_profile(codec):
+    payload = app.apply_generation_profile("chat_text", PAYLOADS["memory note part"])
+    assert json.loads(payload_codec.encode_body(payload)) == json.loads(payload_codec.dumps(payload))
@@ -0,0 +1,141 @@
+"""角色設定前綴快取對 benchmarks/fake_upstream.py 的行為：建立、快到期時延長、快取被拒時退回完整 payload、token 統計。"""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+import app
+import prompt_cache
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+@pytest.fixture(scope="module")
+def upstream_url():
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS, "fake_upstream.py"), "--port", str(port), "--gemini-latency", "0"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def ping():
+        try:
+            return requests.get(f"{url}/_stats", timeout=0.5).ok
+        except requests.RequestException:
+            return False
+
+    try:
+        assert _wait_until(ping, timeout=10), "替身伺服器沒有啟動"
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@pytest.fixture
+def cache(upstream_url, monkeypatch):
+    requests.post(f"{upstream_url}/_cache/clear", timeout=5)
+    requests.post(f"{upstream_url}/_cache/reject", params={"status": 0}, timeout=5)
+    requests.post(f"{upstream_url}/_stats/reset", timeout=5)
+    prefix_cache = prompt_cache.PromptCache(
+        app.http_session, f"{upstream_url}/v1beta", app.GEMINI_API_KEY, app.ROLE_PROMPTS.values(),
+        ttl_seconds=app.PROMPT_CACHE_TTL_SECONDS, refresh_margin_seconds=app.PROMPT_CACHE_REFRESH_MARGIN_SECONDS,
+        min_tokens=app.PROMPT_CACHE_MIN_TOKENS, estimate_tokens=app.token_budget.ESTIMATOR.estimate_contents)
+    monkeypatch.setattr(app, "GEMINI_API_BASE", f"{upstream_url}/v1beta")
+    monkeypatch.setattr(app, "prompt_prefix_cache", prefix_cache)
+    yield prefix_cache
+    prefix_cache.close()
+
+
+@pytest.fixture
+def payload():
+    history = app.get_conversation_history("Uprompt-cache-test")
+    return {"contents": history + [{"role": "user", "parts": [{"text": "小雲在做什麼呢？"}]}]}
+
+
+def _stats(upstream_url):
+    return requests.get(f"{upstream_url}/_stats", timeout=5).json()
+
+
+def _ready_entry(cache):
+    assert _wait_until(lambda: any(entry["state"] == "ready" for entry in cache.entries.values())), "快取沒有建立"
+    return next(entry for entry in cache.entries.values() if entry["state"] == "ready")
+
+
+def test_creates_cache_once_and_sends_suffix(cache, payload, upstream_url):
+    app.call_gemini("chat_text", payload, timeout=10)
+    assert cache.stats["misses"] == 1 and cache.stats["hits"] == 0
+    _ready_entry(cache)
+
+    for _ in range(5):
+        app.call_gemini("chat_text", payload, timeout=10)
+    stats = _stats(upstream_url)
+    assert stats["cache_create"] == 1
+    assert stats["generate_cached"] == 5
+    assert cache.stats["hits"] == 5
+
+
+def test_refreshes_ttl_near_expiry(cache, payload, upstream_url):
+    app.call_gemini("chat_text", payload, timeout=10)
+    entry = _ready_entry(cache)
+    entry["expires_at"] = time.time() + cache.refresh_margin_seconds - 1
+
+    app.call_gemini("chat_text", payload, timeout=10)
+    assert _wait_until(lambda: _stats(upstream_url)["cache_update"] == 1)
+    assert _wait_until(lambda: not entry["refreshing"])
+    assert entry["expires_at"] > time.time() + cache.ttl_seconds - 60
+    # 說明：延長的是同一份快取，不是另外建立一份
+    assert _stats(upstream_url)["cache_create"] == 1
+
+
+@pytest.mark.parametrize("status", prompt_cache.INVALID_CACHE_STATUSES)
+def test_falls_back_to_full_payload_when_cache_rejected(cache, payload, upstream_url, status):
+    app.call_gemini("chat_text", payload, timeout=10)
+    entry = _ready_entry(cache)
+    requests.post(f"{upstream_url}/_cache/reject", params={"status": status}, timeout=5)
+
+    result = app.call_gemini("chat_text", payload, timeout=10)
+    assert app._extract_gemini_text(result)
+    assert "cachedContentTokenCount" not in result["usageMetadata"]
+    assert cache.stats["fallbacks"] == 1
+    assert entry["state"] == "failed"
+
+    # 說明：下一個請求會在背景重新建立快取
+    requests.post(f"{upstream_url}/_cache/reject", params={"status": 0}, timeout=5)
+    app.call_gemini("chat_text", payload, timeout=10)
+    assert _wait_until(lambda: _stats(upstream_url)["cache_create"] == 2)
+
+
+def test_counts_cached_and_uncached_prompt_tokens(cache, payload):
+    uncached = app.call_gemini("chat_text", payload, timeout=10)
+    assert cache.stats["cached_prompt_tokens"] == 0
+    assert cache.stats["uncached_prompt_tokens"] == uncached["usageMetadata"]["promptTokenCount"]
+    entry = _ready_entry(cache)
+
+    before = dict(cache.stats)
+    cached = app.call_gemini("chat_text", payload, timeout=10)
+    usage = cached["usageMetadata"]
+    assert usage["cachedContentTokenCount"] == entry["tokens"]
+    assert cache.stats["cached_prompt_tokens"] - before["cached_prompt_tokens"] == entry["tokens"]
+    assert cache.stats["uncached_prompt_tokens"] - before["uncached_prompt_tokens"] == usage["promptTokenCount"] - entry["tokens"]
+    # 說明：後綴一樣，所以快取前後送出的 prompt token 總數相同，只是大部分改由快取提供
+    assert usage["promptTokenCount"] == uncached["usageMetadata"]["promptTokenCount"]
+    assert cache.status()["cached_token_ratio"] > 0
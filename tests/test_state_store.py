@@ -0,0 +1,141 @@
+"""SqliteStateStore 的 compare-and-set 寫入：兩個 store 模擬兩個 worker 共用同一個 SQLite 檔，撞到時重新載入、重做改動，不丟任何一輪。"""
+import threading
+
+import pytest
+
+import state_store
+import token_budget
+import turn_metadata
+import user_state
+
+HEAD = ({"role": "user", "parts": [{"text": "persona"}]}, {"role": "model", "parts": [{"text": "hi"}]})
+CAPACITY = 200
+
+
+@pytest.fixture
+def make_store(tmp_path):
+    path = str(tmp_path / "user_state.sqlite3")
+
+    def make(validate_seconds=0):
+        return state_store.SqliteStateStore(threading.RLock(), HEAD, CAPACITY, path=path, validate_seconds=validate_seconds)
+
+    return make
+
+
+def push(store, user_id, text):
+    store.prepare(user_id)
+    with store.lock:
+        if (state := store.get(user_id)) is None:
+            state = store[user_id] = user_state.UserState(HEAD)
+        record = turn_metadata.build_turn_record([{"text": text}], "[]", "text", token_budget.ESTIMATOR)
+        state.push_turn([{"text": text}], "[]", record, CAPACITY)
+
+
+def load(store, user_id):
+    store.prepare(user_id)
+    with store.lock:
+        return store.get(user_id)
+
+
+def texts(state):
+    return [user_parts[0]["text"] for user_parts, *_ in state.turns()]
+
+
+def test_state_survives_a_new_store(make_store):
+    first = make_store()
+    push(first, "U", "hello")
+    push(first, "U", "again")
+    assert first.flush() == 1
+    state = load(make_store(), "U")
+    assert texts(state) == ["hello", "again"]
+    assert state.version == 2
+
+
+def test_stale_copy_is_rebased_instead_of_dropped(make_store):
+    a, b = make_store(), make_store()
+    push(a, "U", "a1")
+    a.flush()
+    push(b, "U", "b1")
+    # 說明：b 不再驗證快取，等於拿著舊副本繼續寫
+    b.validate_seconds = 999
+    push(a, "U", "a2")
+    a.flush()
+    push(b, "U", "b2")
+    with b.lock:
+        b.get("U").mark_secret_shared(3)
+        b.get("U").set_scenario("scenario", "sticker")
+
+    assert b.flush() == 1
+    assert b.stats["conflicts"] == 1 and b.stats["rebased"] == 1
+    state = load(make_store(), "U")
+    assert texts(state) == ["a1", "a2", "b1", "b2"]
+    assert state.version == 4
+    assert state.secrets_mask == 1 << 3
+    assert state.scenario_text == "scenario"
+
+
+def test_new_user_created_on_two_workers_is_merged(make_store):
+    a, b = make_store(), make_store()
+    push(a, "N", "a")
+    push(b, "N", "b")
+    a.flush()
+    b.flush()
+    assert texts(load(make_store(), "N")) == ["a", "b"]
+
+
+def test_clear_on_other_worker_drops_memory_note_but_keeps_turns(make_store):
+    a, b = make_store(), make_store()
+    push(a, "U", "before")
+    a.flush()
+    load(b, "U")
+    b.validate_seconds = 999
+    with b.lock:
+        b.get("U").set_memory_note("old note", 1, HEAD)
+    push(b, "U", "b turn")
+    with a.lock:
+        a.pop("U")
+        a["U"] = user_state.UserState(HEAD)
+    push(a, "U", "after clear")
+    a.flush()
+    b.flush()
+
+    state = load(make_store(), "U")
+    assert texts(state) == ["after clear", "b turn"]
+    assert state.memory_note is None
+
+
+def test_pop_deletes_row(make_store):
+    a = make_store()
+    push(a, "U", "hello")
+    a.flush()
+    with a.lock:
+        a.pop("U")
+    a.flush()
+    assert load(make_store(), "U") is None
+
+
+def test_concurrent_workers_lose_no_turns(make_store):
+    stores = [make_store(validate_seconds=0.01) for _ in range(3)]
+    users = [f"U{index}" for index in range(5)]
+    per_thread = 60
+
+    def worker(store, seed):
+        for index in range(per_thread):
+            push(store, users[(seed + index) % len(users)], f"{seed}-{index}")
+            if index % 7 == 0:
+                store.flush()
+
+    threads = [threading.Thread(target=worker, args=(store, seed)) for seed, store in enumerate(stores * 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for store in stores:
+        while store.status()["pending_writes"]:
+            store.flush()
+
+    reader = make_store()
+    stored = [load(reader, user_id) for user_id in users]
+    assert sum(state.version for state in stored) == per_thread * len(threads)
+    assert sorted(text for state in stored for text in texts(state)) == sorted(
+        f"{seed}-{index}" for seed in range(len(threads)) for index in range(per_thread))
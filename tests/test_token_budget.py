@@ -0,0 +1,113 @@
+"""token 估算與校正，以及 add_to_conversation 依 token 預算修剪對話 (丟掉的輪交給記憶筆記)。"""
+import json
+
+import pytest
+
+import app
+import token_budget
+
+
+@pytest.fixture
+def estimator(monkeypatch):
+    # 說明：全域的 ESTIMATOR 會被其他測試的 usageMetadata 校正過，這裡換一個新的
+    fresh = token_budget.TokenEstimator(alpha=0.5)
+    monkeypatch.setattr(token_budget, "ESTIMATOR", fresh)
+    return fresh
+
+
+def text_message(text, role="user"):
+    return {"role": role, "parts": [{"text": text}]}
+
+
+def test_estimate_counts_cjk_ascii_and_media(estimator):
+    overhead = token_budget.MESSAGE_OVERHEAD_TOKENS
+    assert estimator.estimate_contents([text_message("小雲你好" + "abcdefgh")]) == 4 + 2 + overhead
+    image = {"role": "user", "parts": [{"inline_data": {"mime_type": "image/png", "data": "AAAA"}}]}
+    assert estimator.estimate_contents([image]) == token_budget.IMAGE_TOKENS + overhead
+    # 說明：base64 長度 × 3/4 是位元組數，8000 bytes 約 1 秒
+    audio = {"role": "user", "parts": [{"inline_data": {"mime_type": "audio/m4a", "data": "A" * 32000}}]}
+    assert estimator.estimate_contents([audio]) == 3 * token_budget.AUDIO_TOKENS_PER_SECOND + overhead
+
+
+def test_observe_calibrates_text_factor_from_usage_metadata(estimator):
+    payload = {"contents": [text_message("咪" * 96)]}
+    assert estimator.estimate_payload(payload) == 100
+    assert estimator.observe("chat_text", payload, {"usageMetadata": {"promptTokenCount": 150}}) == (100, 150)
+    # 說明：觀察到的係數 1.5，alpha 0.5 的指數移動平均走一半
+    assert estimator.text_factor == pytest.approx(1.25)
+    assert estimator.samples == 1
+    assert estimator.estimate_payload(payload) == 125
+    estimator.observe("chat_text", payload, {"usageMetadata": {"promptTokenCount": 150}})
+    assert estimator.text_factor == pytest.approx(1.375)
+
+
+def test_observe_clamps_outliers(estimator):
+    payload = {"contents": [text_message("咪" * 96)]}
+    estimator.observe("chat_text", payload, {"usageMetadata": {"promptTokenCount": 10000}})
+    assert estimator.text_factor == pytest.approx(1.0 + 0.5 * (3.0 - 1.0))
+
+
+def test_observe_ignores_media_and_missing_usage(estimator):
+    image = {"contents": [{"role": "user", "parts": [{"inline_data": {"mime_type": "image/png", "data": "AAAA"}}, {"text": "看"}]}]}
+    assert estimator.observe("chat_image", image, {"usageMetadata": {"promptTokenCount": 900}}) is not None
+    assert estimator.observe("chat_text", {"contents": [text_message("咪")]}, {}) is None
+    assert estimator.observe("chat_text", {"contents": [text_message("咪")]}, None) is None
+    assert (estimator.text_factor, estimator.samples) == (1.0, 0)
+
+
+@pytest.mark.parametrize("budget, max_turns, kept", [(100, None, 4), (60, None, 3), (59, None, 2), (49, None, 1), (10, None, 1), (100, 3, 3)])
+def test_turns_within_budget_keeps_the_newest(budget, max_turns, kept):
+    assert token_budget.turns_within_budget(20, [10, 10, 10, 20], budget, max_turns) == kept
+    assert token_budget.turns_within_budget(20, [], budget, max_turns) == 0
+
+
+def test_trim_history_keeps_head_and_whole_turns(estimator):
+    head = [text_message("角色設定" * 10), text_message("好", "model")]
+    turns = [text_message(f"第{index}輪" + "咪" * 16, role) for index in range(4) for role in ("user", "model")]
+    turn_tokens = estimator.estimate_contents(turns[:2])
+    trimmed = token_budget.trim_history(head + turns, estimator.estimate_contents(head) + 2 * turn_tokens, estimator=estimator)
+    assert trimmed == head + turns[4:]
+
+
+@pytest.fixture
+def conversation(estimator, monkeypatch):
+    queued = []
+    monkeypatch.setattr(app, "queue_memory_note_update", lambda user_id, records: queued.append((user_id, records)))
+    user_id = "Utoken-budget-test"
+    yield user_id, queued
+    with app.user_state_lock:
+        app.user_states.pop(user_id, None)
+
+
+def add_turn(user_id, index, size=40):
+    bot_response = json.dumps([{"type": "text", "content": "喵" * size}], ensure_ascii=False)
+    app.add_to_conversation(user_id, f"第{index}件事" + "咪" * size, bot_response)
+
+
+def test_add_to_conversation_drops_oldest_turns_over_budget(conversation, estimator, monkeypatch):
+    user_id, queued = conversation
+    add_turn(user_id, 0)
+    with app.locked_user_state(user_id) as state:
+        head_tokens = estimator.estimate_contents(state.head)
+        turn_tokens = state.last_record().tokens
+    monkeypatch.setattr(app, "CONVERSATION_TOKEN_BUDGET", head_tokens + 3 * turn_tokens)
+    for index in range(1, 5):
+        add_turn(user_id, index)
+
+    with app.locked_user_state(user_id) as state:
+        assert [record.user_text[:4] for record in state.records()] == ["第2件事", "第3件事", "第4件事"]
+        assert len(state.history()) == 2 + 3 * 2
+    # 說明：每次寫入都會呼叫一次；超出預算被丟掉的輪 (由舊到新) 交給記憶筆記
+    assert [[record.user_text[:4] for record in records] for _, records in queued] == [[], [], [], ["第0件事"], ["第1件事"]]
+    assert all(queued_user == user_id for queued_user, _ in queued)
+
+
+def test_add_to_conversation_always_keeps_the_newest_turn(conversation, estimator, monkeypatch):
+    user_id, queued = conversation
+    add_turn(user_id, 0)
+    add_turn(user_id, 1)
+    monkeypatch.setattr(app, "CONVERSATION_TOKEN_BUDGET", 1)
+    add_turn(user_id, 2, size=400)
+    with app.locked_user_state(user_id) as state:
+        assert [record.user_text[:4] for record in state.records()] == ["第2件事"]
+    assert [record.user_text[:4] for record in queued[-1][1]] == ["第0件事", "第1件事"]
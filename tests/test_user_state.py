@@ -0,0 +1,154 @@
+"""UserState：環狀緩衝區、drop_oldest、序列化來回與 journal 的 replay (SQLite 後端撞到時靠它重做改動)。"""
+import functools
+
+import pytest
+
+import state_store
+import token_budget
+import turn_metadata
+import user_state
+
+SHARED_HEAD = ({"role": "user", "parts": [{"text": "persona"}]}, {"role": "model", "parts": [{"text": "hi"}]})
+
+
+@functools.lru_cache(maxsize=None)
+def record(text):
+    # 說明：同一段文字回傳同一個 TurnRecord (created_at 也相同)，序列化後比對 as_dict() 才會一致
+    return turn_metadata.build_turn_record([{"text": text}], f"reply {text}", "text", token_budget.ESTIMATOR)
+
+
+def push(state, text, capacity=3):
+    return state.push_turn([{"text": text}], f"reply {text}", record(text), capacity)
+
+
+def dicts(records):
+    return [record.as_dict() for record in records or ()]
+
+
+def texts(turns):
+    return [user_parts[0]["text"] for user_parts, _, _ in turns]
+
+
+def round_trip(state, capacity=3):
+    raw = state_store.encode_state(state.to_dict(SHARED_HEAD))
+    return state_store.decode_state(raw, SHARED_HEAD, capacity)
+
+
+def test_push_turn_wraps_and_returns_the_evicted_turn():
+    state = user_state.UserState(SHARED_HEAD)
+    assert [push(state, text) for text in ("t0", "t1", "t2")] == [None, None, None]
+    evicted = push(state, "t3")
+    assert evicted == ([{"text": "t0"}], "reply t0", record("t0"))
+    assert evicted[2] is record("t0")
+    assert texts([push(state, "t4")]) == ["t1"]
+    assert texts(state.turns()) == ["t2", "t3", "t4"]
+    assert state.turn_count == 3 and state.version == 5
+    assert state.last_record() is record("t4")
+    assert [message["role"] for message in state.history()] == ["user", "model"] * 4
+    assert state.history()[-2] == {"role": "user", "parts": [{"text": "t4"}]}
+
+
+def test_push_turn_keeps_multi_part_messages():
+    state = user_state.UserState(SHARED_HEAD)
+    parts = [{"inline_data": {"mime_type": "image/png", "data": "AAAA"}}, {"text": "看這個"}]
+    state.push_turn(parts, "咪", record("image"), 3)
+    assert state.turns()[0][0] == parts
+
+
+def test_drop_oldest_after_wraparound():
+    state = user_state.UserState(SHARED_HEAD)
+    for text in ("t0", "t1", "t2", "t3", "t4"):
+        push(state, text)
+    assert texts(state.drop_oldest(2)) == ["t2", "t3"]
+    assert texts(state.turns()) == ["t4"]
+    push(state, "t5")
+    push(state, "t6")
+    assert texts(state.turns()) == ["t4", "t5", "t6"]
+    assert texts([push(state, "t7")]) == ["t4"]
+    assert texts(state.drop_oldest(10)) == ["t5", "t6", "t7"]
+    assert state.turns() == [] and state.last_record() is None
+    assert state.drop_oldest(1) == []
+
+
+def test_round_trip_keeps_the_shared_head():
+    state = user_state.UserState(SHARED_HEAD)
+    for text in ("t0", "t1", "t2", "t3"):
+        push(state, text)
+    state.mark_secret_shared(2)
+    state.set_scenario("scenario", "sticker")
+    restored = round_trip(state)
+    assert restored.head is SHARED_HEAD
+    assert texts(restored.turns()) == ["t1", "t2", "t3"]
+    assert dicts(restored.records()) == dicts(state.records())
+    assert (restored.epoch, restored.version, restored.secrets_mask) == (state.epoch, state.version, 1 << 2)
+    assert (restored.scenario_text, restored.scenario_sticker) == ("scenario", "sticker")
+    assert restored.memory_note is None and restored.pending_memory is None
+
+
+def test_round_trip_with_memory_note_and_pending_turns():
+    state = user_state.UserState(SHARED_HEAD)
+    push(state, "t0")
+    state.set_memory_note("主人喜歡晚上聊天", 4, SHARED_HEAD)
+    state.add_pending_memory([record("old0"), record("old1")], 10)
+    restored = round_trip(state)
+    assert restored.memory_note == "主人喜歡晚上聊天"
+    assert restored.note_meta == state.note_meta
+    assert restored.head[1] is SHARED_HEAD[1]
+    assert restored.head[0]["parts"][0] == SHARED_HEAD[0]["parts"][0]
+    assert dicts(restored.pending_memory) == dicts([record("old0"), record("old1")])
+    assert restored.to_dict(SHARED_HEAD) == state.to_dict(SHARED_HEAD)
+
+
+def test_add_pending_memory_keeps_the_newest():
+    state = user_state.UserState(SHARED_HEAD)
+    assert state.add_pending_memory([record("a"), record("b")], 3) == (2, 0)
+    assert state.add_pending_memory([record("c"), record("d")], 3) == (3, 1)
+    assert state.take_pending_memory() == [record("b"), record("c"), record("d")]
+    assert state.pending_memory is None
+
+
+def test_replay_reproduces_every_logged_change():
+    base = user_state.UserState(SHARED_HEAD)
+    push(base, "t0")
+    base.add_pending_memory([record("old0")], 10)
+    ours = round_trip(base)
+    theirs = round_trip(base)
+    ours.journal = []
+    for text in ("t1", "t2", "t3"):
+        push(ours, text)
+    ours.drop_oldest(1)
+    ours.mark_secret_shared(1)
+    ours.set_scenario("scenario", "sticker")
+    ours.take_scenario()
+    ours.set_scenario("next", None)
+    assert dicts(ours.take_pending_memory()) == dicts([record("old0")])
+    ours.set_memory_note("note", 1, SHARED_HEAD)
+    ours.add_pending_memory([record("old1")], 10)
+    ours.reset_secrets()
+    ours.mark_secret_shared(3)
+
+    theirs.replay(ours.journal)
+    assert {**theirs.to_dict(SHARED_HEAD), "note_meta": None} == {**ours.to_dict(SHARED_HEAD), "note_meta": None}
+    assert theirs.note_meta[1] == 1
+
+
+def test_replay_remove_pending_only_removes_taken_records():
+    base = user_state.UserState(SHARED_HEAD)
+    base.add_pending_memory([record("old0"), record("old1")], 10)
+    ours, theirs = round_trip(base), round_trip(base)
+    ours.journal = []
+    taken = ours.take_pending_memory()
+    assert ours.journal == [("_remove_pending", (taken,))]
+    # 說明：對方在期間又多累積了一輪，重做「取走」時只拿掉當初取走的那兩輪
+    theirs.add_pending_memory([record("new")], 10)
+    theirs.replay(ours.journal)
+    assert len(theirs.pending_memory) == 1 and theirs.pending_memory[0] is record("new")
+
+
+@pytest.mark.parametrize("action", [lambda state: state.drop_oldest(0), lambda state: state.take_scenario(),
+                                    lambda state: state.take_pending_memory()])
+def test_no_op_changes_are_not_logged(action):
+    state = user_state.UserState(SHARED_HEAD)
+    state.journal = []
+    action(state)
+    assert state.journal == []
@@ -0,0 +1,256 @@
+"""用戶狀態的冷熱分層：一段時間沒傳訊息的用戶，把 UserState 序列化並壓縮成冷資料，下次傳訊息時再透明地還原。
+
+- 熱層：user_id -> UserState，跟原本的 dict 一樣；每次 get() 都會更新最後存取時間。
+- 冷層：閒置超過 USER_STATE_IDLE_SECONDS 的用戶由背景執行緒轉成 JSON + zlib。
+  USER_STATE_COLD_MODE=memory 時壓縮後的 bytes 留在記憶體；=file 時寫到 USER_STATE_SPILL_DIR/<pid>/ 底下，記憶體只留檔案大小。
+- 序列化用 JSON 而不是 pickle；沒有記憶筆記的用戶只記一個 None，還原時接回共用的 PERSONA_HEAD。
+- 實作 state_store.StateStore (USER_STATE_BACKEND=memory，預設)：介面跟 dict 一樣，呼叫端需持有建立時傳入的鎖 (app.user_state_lock)。
+  sweep() 的序列化每拿一次鎖最多做 USER_STATE_SNAPSHOT_CHUNK 位，壓縮與寫檔在鎖外做；還原 (解壓、file 模式讀一個小檔) 發生在 get() 裡、鎖內。
+- status() 回報兩層的用戶數、位元組數 (熱層是抽樣估算) 與還原耗時；也有對應的 /metrics 指標。
+"""
+import hashlib
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import metrics
+import state_store
+
+logger = logging.getLogger(__name__)
+
+USER_STATE_TIERING_ENABLED = os.getenv("USER_STATE_TIERING_ENABLED", "1") == "1"
+USER_STATE_IDLE_SECONDS = int(os.getenv("USER_STATE_IDLE_SECONDS", "1800"))
+USER_STATE_SWEEP_SECONDS = int(os.getenv("USER_STATE_SWEEP_SECONDS", "60"))
+USER_STATE_COLD_MODE = os.getenv("USER_STATE_COLD_MODE", "memory")
+USER_STATE_SPILL_DIR = os.getenv("USER_STATE_SPILL_DIR", os.path.join(tempfile.gettempdir(), "xiaoyun_user_state"))
+USER_STATE_SIZE_SAMPLE = 50  # 估算熱層位元組數時抽樣的用戶數
+
+TIER_USERS = metrics.REGISTRY.gauge("xiaoyun_user_state_users", "各層的用戶數 (hot / cold)", ("tier",))
+TIER_BYTES = metrics.REGISTRY.gauge("xiaoyun_user_state_cold_bytes", "冷層壓縮後的總位元組數")
+DEMOTIONS = metrics.REGISTRY.counter("xiaoyun_user_state_demotions_total", "轉入冷層的次數")
+REHYDRATE_SECONDS = metrics.REGISTRY.histogram(
+    "xiaoyun_user_state_rehydrate_seconds", "冷層用戶還原成 UserState 的耗時",
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+
+
+def _deep_sizeof(state, shared_head):
+    """一個 UserState 實際多佔的位元組 (slot、緩衝區、每輪的 tuple / 字串 / TurnRecord)；共用的 head 不算。"""
+    seen = set()
+
+    def size(obj):
+        if id(obj) in seen or obj is None:
+            return 0
+        seen.add(id(obj))
+        total = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            total += sum(size(key) + size(value) for key, value in obj.items())
+        elif isinstance(obj, (list, tuple)):
+            total += sum(size(item) for item in obj)
+        elif hasattr(obj, "__slots__"):
+            total += sum(size(getattr(obj, name, None)) for name in obj.__slots__)
+        return total
+
+    seen.update(id(part) for part in shared_head)
+    return size(state)
+
+
+class TieredUserStates(state_store.StateStore):
+    def __init__(self, lock, shared_head, capacity, idle_seconds=USER_STATE_IDLE_SECONDS, cold_mode=USER_STATE_COLD_MODE,
+                 spill_dir=USER_STATE_SPILL_DIR, compress_level=state_store.USER_STATE_COMPRESS_LEVEL):
+        if cold_mode not in ("memory", "file"):
+            raise ValueError(f"USER_STATE_COLD_MODE 只能是 memory 或 file：{cold_mode}")
+        self.lock = lock
+        self.shared_head = shared_head
+        self.capacity = capacity
+        self.idle_seconds = idle_seconds
+        self.cold_mode = cold_mode
+        # 說明：每個 worker 各自有一份用戶狀態，溢出檔也各放各的目錄
+        self.spill_dir = os.path.join(spill_dir, str(os.getpid()))
+        self.compress_level = compress_level
+        self.hot = {}
+        self.last_access = {}
+        # 說明：cold[user_id] 在 memory 模式是壓縮後的 bytes，file 模式是檔案大小 (int)
+        self.cold = {}
+        self.cold_bytes = 0
+        self.stats = {"demoted": 0, "rehydrated": 0, "rehydrate_failed": 0, "spill_failed": 0}
+        self._rehydrate_total = 0.0
+        self._rehydrate_max = 0.0
+        self._sweeper_started = False
+
+    # --- dict 介面 (呼叫端持有 self.lock) ---
+
+    def get(self, user_id, default=None):
+        if (state := self.hot.get(user_id)) is None:
+            if user_id not in self.cold:
+                return default
+            state = self._rehydrate(user_id)
+            if state is None:
+                return default
+        self.last_access[user_id] = time.monotonic()
+        return state
+
+    def __setitem__(self, user_id, state):
+        self._drop_cold(user_id)
+        self.hot[user_id] = state
+        self.last_access[user_id] = time.monotonic()
+
+    def __contains__(self, user_id):
+        return user_id in self.hot or user_id in self.cold
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    def pop(self, user_id, default=None):
+        self.last_access.pop(user_id, None)
+        self._drop_cold(user_id)
+        return self.hot.pop(user_id, default)
+
+    def items(self):
+        """只列熱層的用戶 (冷層的用戶要還原才看得到內容，/memory_status 不為了列表把它們全部叫醒)。"""
+        return self.hot.items()
+
+    # --- 冷熱轉換 ---
+
+    def _spill_path(self, user_id):
+        return os.path.join(self.spill_dir, hashlib.sha1(user_id.encode("utf-8")).hexdigest() + ".json.z")
+
+    def _drop_cold(self, user_id):
+        if (entry := self.cold.pop(user_id, None)) is None:
+            return False
+        self.cold_bytes -= entry if isinstance(entry, int) else len(entry)
+        if isinstance(entry, int):
+            self._remove_spill_file(user_id)
+        return True
+
+    def _remove_spill_file(self, user_id):
+        try:
+            os.remove(self._spill_path(user_id))
+        except OSError:
+            pass
+
+    def _rehydrate(self, user_id):
+        started = time.perf_counter()
+        entry = self.cold[user_id]
+        try:
+            if isinstance(entry, int):
+                with open(self._spill_path(user_id), "rb") as f:
+                    entry_bytes = f.read()
+            else:
+                entry_bytes = entry
+            state = state_store.decode_state(zlib.decompress(entry_bytes), self.shared_head, self.capacity)
+        except (OSError, ValueError, KeyError, TypeError, zlib.error) as e:
+            # 說明：還原失敗就當成新用戶，不讓一份壞掉的冷資料卡住這位用戶的對話
+            logger.error("還原 User ID (%s) 的冷資料失敗，改用新的狀態: %s", user_id, e)
+            self.stats["rehydrate_failed"] += 1
+            self._drop_cold(user_id)
+            return None
+        self._drop_cold(user_id)
+        self.hot[user_id] = state
+        elapsed = time.perf_counter() - started
+        self.stats["rehydrated"] += 1
+        self._rehydrate_total += elapsed
+        self._rehydrate_max = max(self._rehydrate_max, elapsed)
+        REHYDRATE_SECONDS.labels().observe(elapsed)
+        return state
+
+    def sweep(self, now=None):
+        """把閒置超過 idle_seconds 的熱層用戶轉入冷層，回傳轉了幾位。"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            idle = [(user_id, accessed) for user_id, accessed in self.last_access.items()
+                    if now - accessed >= self.idle_seconds and user_id in self.hot]
+        demoted = 0
+        # 說明：to_dict() 要在鎖內做，但分批拿鎖 (同 SqliteStateStore._flush_once)；
+        # 閒置一段時間後第一次掃描可能涵蓋大部分用戶，不讓整批的序列化長時間擋住請求
+        for index in range(0, len(idle), state_store.USER_STATE_SNAPSHOT_CHUNK):
+            with self.lock:
+                candidates = [(user_id, state, accessed, state.to_dict(self.shared_head))
+                              for user_id, accessed in idle[index:index + state_store.USER_STATE_SNAPSHOT_CHUNK]
+                              if self.last_access.get(user_id) == accessed and (state := self.hot.get(user_id)) is not None]
+            demoted += self._demote(candidates)
+        DEMOTIONS.labels().inc(demoted)
+        self._update_gauges()
+        return demoted
+
+    def _demote(self, candidates):
+        """把 sweep() 一批的快照壓縮 (file 模式再寫檔) 後換進冷層，回傳轉了幾位。"""
+        demoted = 0
+        for user_id, state, accessed, data in candidates:
+            compressed = zlib.compress(state_store.encode_state(data), self.compress_level)
+            entry = compressed
+            if self.cold_mode == "file":
+                try:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                    tmp_path = self._spill_path(user_id) + ".tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(compressed)
+                    os.replace(tmp_path, self._spill_path(user_id))
+                except OSError as e:
+                    logger.warning("寫入 User ID (%s) 的冷資料檔失敗，留在熱層: %s", user_id, e)
+                    self.stats["spill_failed"] += 1
+                    continue
+                entry = len(compressed)
+            with self.lock:
+                # 說明：壓縮期間用戶又傳了訊息 (或被 /clear_memory 換掉)，這份快照就作廢
+                stale = self.hot.get(user_id) is not state or self.last_access.get(user_id) != accessed
+                if not stale:
+                    del self.hot[user_id]
+                    del self.last_access[user_id]
+                    self.cold[user_id] = entry
+                    self.cold_bytes += len(compressed)
+                    self.stats["demoted"] += 1
+            if stale:
+                if isinstance(entry, int):
+                    self._remove_spill_file(user_id)
+                continue
+            demoted += 1
+        return demoted
+
+    def _update_gauges(self):
+        with self.lock:
+            hot_count, cold_count, cold_bytes = len(self.hot), len(self.cold), self.cold_bytes
+        TIER_USERS.labels("hot").set(hot_count)
+        TIER_USERS.labels("cold").set(cold_count)
+        TIER_BYTES.labels().set(cold_bytes)
+
+    def start(self, interval=USER_STATE_SWEEP_SECONDS):
+        """啟動背景執行緒定期 sweep()；USER_STATE_TIERING_ENABLED=0 時不做事。"""
+        if not USER_STATE_TIERING_ENABLED or self._sweeper_started:
+            return
+        self._sweeper_started = True
+
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error("用戶狀態冷熱分層掃描失敗: %s", e, exc_info=True)
+
+        threading.Thread(target=_loop, name="user-state-sweeper", daemon=True).start()
+
+    def status(self):
+        with self.lock:
+            hot_count, cold_count, cold_bytes = len(self.hot), len(self.cold), self.cold_bytes
+            sample = random.sample(list(self.hot.values()), min(USER_STATE_SIZE_SAMPLE, hot_count))
+            sampled_bytes = sum(_deep_sizeof(state, self.shared_head) for state in sample)
+            stats = dict(self.stats)
+            rehydrate_total, rehydrate_max = self._rehydrate_total, self._rehydrate_max
+        rehydrated = stats["rehydrated"]
+        return stats | {
+            "backend": "memory",
+            "tiering_enabled": USER_STATE_TIERING_ENABLED,
+            "cold_mode": self.cold_mode,
+            "idle_seconds": self.idle_seconds,
+            "hot_users": hot_count,
+            "cold_users": cold_count,
+            "estimated_hot_bytes": round(sampled_bytes / len(sample) * hot_count) if sample else 0,
+            "cold_bytes": cold_bytes,
+            "avg_rehydrate_ms": round(rehydrate_total / rehydrated * 1000, 3) if rehydrated else None,
+            "max_rehydrate_ms": round(rehydrate_max * 1000, 3) if rehydrated else None,
+        }
@@ -0,0 +1,133 @@
+"""各外部依賴 (endpoint) 與 Gemini 任務的自適應逾時：連線逾時固定，讀取逾時依最近的 p99 推算。
+
+- 讀取逾時 = p99 × TIMEOUT_P99_MULTIPLIER + TIMEOUT_HEADROOM_SECONDS，限制在該 endpoint 的 [min_read, max_read] 之間；
+  樣本不足 TIMEOUT_MIN_SAMPLES 時用 DEFAULT_READ_TIMEOUTS (原本寫死在程式裡的秒數)。
+- 成功的請求記錄實際耗時；逾時的請求記錄當時的讀取逾時 (實際耗時至少這麼長)，依賴變慢時 p99 會跟著往上推，
+  不會因為只看得到「來得及回來的」請求而越縮越短。
+- 以 (endpoint, task) 為 key；非 Gemini 的 endpoint task 為 None。
+"""
+import asyncio
+import collections
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT_MIN_SAMPLES = int(os.getenv("TIMEOUT_MIN_SAMPLES", "30"))
+TIMEOUT_WINDOW = int(os.getenv("TIMEOUT_WINDOW", "500"))
+TIMEOUT_P99_MULTIPLIER = float(os.getenv("TIMEOUT_P99_MULTIPLIER", "1.5"))
+TIMEOUT_HEADROOM_SECONDS = float(os.getenv("TIMEOUT_HEADROOM_SECONDS", "1.0"))
+
+# endpoint: (連線逾時, 讀取逾時下限, 讀取逾時上限)
+ENDPOINT_BOUNDS = {
+    "gemini": (5.0, 5.0, 60.0),
+    "pexels_search": (3.05, 2.0, 15.0),
+    "unsplash_search": (3.05, 2.0, 15.0),
+    "image_download": (3.05, 2.0, 15.0),
+    "sticker_cdn": (2.0, 1.0, 8.0),
+    "line_content": (3.05, 5.0, 45.0),
+    "line_reply": (3.05, 3.0, 15.0),
+}
+# 說明：還沒有足夠樣本時的讀取逾時，沿用各呼叫點原本的秒數
+DEFAULT_READ_TIMEOUTS = {
+    ("gemini", "chat_text"): 40,
+    ("gemini", "chat_image"): 45,
+    ("gemini", "chat_sticker"): 45,
+    ("gemini", "chat_audio"): 45,
+    ("gemini", "image_relevance"): 30,
+    ("gemini", "quick_replies"): 20,
+    ("gemini", "secret"): 35,
+    ("gemini", "secret_template"): 45,
+    ("gemini", "scenario"): 45,
+    ("gemini", "scenario_prefetch"): 40,
+    ("gemini", "scenario_follow_up"): 40,
+    ("gemini", "memory_note"): 30,
+    ("gemini", "status"): 40,
+    ("gemini", "feed_template"): 45,
+    ("gemini", "feed_now"): 30,
+    ("gemini", "response_pool"): 40,
+    ("pexels_search", None): 12,
+    ("unsplash_search", None): 12,
+    ("image_download", None): 10,
+    ("sticker_cdn", None): 5,
+    ("line_content", None): 30,
+    ("line_reply", None): 10,
+}
+
+READ_TIMEOUT = metrics.REGISTRY.gauge(
+    "xiaoyun_read_timeout_seconds", "目前使用的讀取逾時，依外部依賴與任務區分", ("endpoint", "task"))
+TIMEOUTS_HIT = metrics.REGISTRY.counter(
+    "xiaoyun_timeouts_total", "請求逾時次數，依外部依賴與任務區分", ("endpoint", "task"))
+
+_TIMEOUT_EXCEPTIONS = (requests.exceptions.Timeout, asyncio.TimeoutError)
+
+
+def is_timeout(exc):
+    """stream=True 讀 body 時的讀取逾時，requests 會包成 ConnectionError(ReadTimeoutError)，也算逾時。"""
+    if isinstance(exc, _TIMEOUT_EXCEPTIONS):
+        return True
+    return isinstance(exc, requests.exceptions.ConnectionError) and bool(exc.args) and isinstance(exc.args[0], ReadTimeoutError)
+
+
+class TimeoutManager:
+    def __init__(self, bounds=None, defaults=None, min_samples=TIMEOUT_MIN_SAMPLES, window=TIMEOUT_WINDOW):
+        self.bounds = dict(bounds or ENDPOINT_BOUNDS)
+        self.defaults = dict(defaults or DEFAULT_READ_TIMEOUTS)
+        self.min_samples = min_samples
+        self._windows = collections.defaultdict(lambda: metrics.LatencyWindow(window))
+
+    def read_timeout(self, endpoint, task=None):
+        _, min_read, max_read = self.bounds[endpoint]
+        window = self._windows.get((endpoint, task))
+        if window is None or len(window) < self.min_samples:
+            read = self.defaults.get((endpoint, task), max_read)
+        else:
+            read = min(max_read, max(min_read, window.quantile(0.99) * TIMEOUT_P99_MULTIPLIER + TIMEOUT_HEADROOM_SECONDS))
+        READ_TIMEOUT.labels(endpoint, task or "").set(read)
+        return read
+
+    def get(self, endpoint, task=None, read=None):
+        """回傳給 requests 用的 (連線逾時, 讀取逾時)；read 有給時 (例如對沖剩下的時間) 直接使用。"""
+        return self.bounds[endpoint][0], read if read is not None else self.read_timeout(endpoint, task)
+
+    def observe(self, endpoint, task, seconds):
+        self._windows[(endpoint, task)].add(seconds)
+
+    def observe_timeout(self, endpoint, task, read_timeout):
+        TIMEOUTS_HIT.labels(endpoint, task or "").inc()
+        self._windows[(endpoint, task)].add(read_timeout)
+
+    @contextmanager
+    def track(self, endpoint, task=None, read=None):
+        """with TIMEOUTS.track("pexels_search") as timeout: http_session.get(..., timeout=timeout)
+        成功時記錄耗時、逾時時記錄讀取逾時；其他錯誤不列入樣本。"""
+        timeout = self.get(endpoint, task, read)
+        started = time.perf_counter()
+        try:
+            yield timeout
+        except Exception as e:
+            if is_timeout(e):
+                self.observe_timeout(endpoint, task, timeout[1])
+            raise
+        self.observe(endpoint, task, time.perf_counter() - started)
+
+    def status(self):
+        status = {}
+        for (endpoint, task), window in list(self._windows.items()):
+            p99 = window.quantile(0.99)
+            status[f"{endpoint}:{task}" if task else endpoint] = {
+                "samples": len(window),
+                "p99_seconds": round(p99, 3) if p99 is not None else None,
+                "read_timeout_seconds": round(self.read_timeout(endpoint, task), 2),
+            }
+        return status
+
+
+TIMEOUTS = TimeoutManager()
@@ -0,0 +1,132 @@
+"""本機估算 Gemini 輸入 token 數，並依 usageMetadata 回報的實際值持續校正。
+
+- 文字：中日韓字元約 1 token、其他字元約 4 字元 1 token，再乘上校正係數。
+- inline_data：圖片以固定 258 token 計 (Gemini 對 384px 以下圖片的計價)，語音依 base64 長度粗估秒數、每秒 32 token。
+- 校正係數只用「純文字」請求更新 (媒體的估算誤差不該拉偏文字的係數)，以指數移動平均收斂。
+
+trim_history() / turns_within_budget() 依 token 預算從最舊的對話輪開始丟，開頭的角色設定 (與初始回應) 與最新一輪一定保留。
+"""
+import functools
+import logging
+import os
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CALIBRATION_ALPHA = float(os.getenv("TOKEN_CALIBRATION_ALPHA", "0.1"))
+IMAGE_TOKENS = 258
+AUDIO_TOKENS_PER_SECOND = 32
+AUDIO_BYTES_PER_SECOND = 8000  # 約 64 kbps 的 m4a
+MESSAGE_OVERHEAD_TOKENS = 4
+
+PROMPT_ESTIMATE_RATIO = metrics.REGISTRY.histogram(
+    "xiaoyun_gemini_prompt_estimate_ratio", "Gemini 實際 promptTokenCount / 本機估算值", ("task",),
+    buckets=(0.5, 0.7, 0.8, 0.9, 0.95, 1.0, 1.05, 1.1, 1.2, 1.3, 1.5, 2.0))
+
+
+def _is_cjk(ch):
+    code = ord(ch)
+    return 0x2E80 <= code <= 0x9FFF or 0xAC00 <= code <= 0xD7AF or 0xF900 <= code <= 0xFAFF or 0xFF00 <= code <= 0xFFEF
+
+
+@functools.lru_cache(maxsize=4096)
+def _raw_text_tokens(text):
+    # 說明：角色設定檔有上萬字、每次請求都會帶；以字串本身為 key 快取，同一個物件再次查詢只需比對 identity。
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk + (len(text) - cjk) / 4.0
+
+
+def _payload_contents(payload):
+    contents = list(payload.get("contents") or [])
+    if system_instruction := payload.get("systemInstruction") or payload.get("system_instruction"):
+        contents.append(system_instruction)
+    return contents
+
+
+class TokenEstimator:
+    def __init__(self, alpha=TOKEN_CALIBRATION_ALPHA):
+        self.alpha = alpha
+        self.text_factor = 1.0
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def _parts_tokens(self, parts):
+        text_tokens, media_tokens = 0.0, 0.0
+        for part in parts or []:
+            if "text" in part:
+                text_tokens += _raw_text_tokens(part["text"])
+            elif "inline_data" in part or "inlineData" in part:
+                inline = part.get("inline_data") or part.get("inlineData") or {}
+                mime_type = inline.get("mime_type") or inline.get("mimeType") or ""
+                if mime_type.startswith("audio/"):
+                    audio_bytes = len(inline.get("data", "")) * 3 / 4
+                    media_tokens += audio_bytes / AUDIO_BYTES_PER_SECOND * AUDIO_TOKENS_PER_SECOND
+                else:
+                    media_tokens += IMAGE_TOKENS
+        return text_tokens, media_tokens
+
+    def _raw(self, contents):
+        text_tokens, media_tokens = 0.0, 0.0
+        for message in contents or []:
+            message_text, message_media = self._parts_tokens(message.get("parts"))
+            text_tokens += message_text + MESSAGE_OVERHEAD_TOKENS
+            media_tokens += message_media
+        return text_tokens, media_tokens
+
+    def estimate_contents(self, contents):
+        text_tokens, media_tokens = self._raw(contents)
+        return int(text_tokens * self.text_factor + media_tokens)
+
+    def estimate_payload(self, payload):
+        return self.estimate_contents(_payload_contents(payload))
+
+    def observe(self, task, payload, result):
+        """拿 usageMetadata 的 promptTokenCount 跟估算值比較；回傳 (估算, 實際)，沒有 usageMetadata 時回傳 None。"""
+        actual = ((result or {}).get("usageMetadata") or {}).get("promptTokenCount")
+        if not actual:
+            return None
+        text_tokens, media_tokens = self._raw(_payload_contents(payload))
+        estimate = int(text_tokens * self.text_factor + media_tokens)
+        if estimate > 0:
+            PROMPT_ESTIMATE_RATIO.labels(task).observe(actual / estimate)
+        if media_tokens == 0 and text_tokens > 0:
+            with self._lock:
+                observed_factor = min(3.0, max(0.3, actual / text_tokens))
+                self.text_factor += self.alpha * (observed_factor - self.text_factor)
+                self.samples += 1
+        logger.info("Gemini %s 輸入 token：估算 %s / 實際 %s", task, estimate, actual)
+        return estimate, actual
+
+    def status(self):
+        return {"text_factor": round(self.text_factor, 4), "calibration_samples": self.samples}
+
+
+ESTIMATOR = TokenEstimator()
+
+
+def turns_within_budget(head_tokens, turn_tokens, budget_tokens, max_turns=None):
+    """turn_tokens 是每一輪的 token 數 (由舊到新)；從最新一輪往回累加，回傳預算內能保留幾輪 (最新一輪一定保留)。"""
+    if not turn_tokens:
+        return 0
+    used = head_tokens + turn_tokens[-1]
+    kept = 1
+    while kept < len(turn_tokens) and (max_turns is None or kept < max_turns):
+        if used + turn_tokens[-kept - 1] > budget_tokens:
+            break
+        used += turn_tokens[-kept - 1]
+        kept += 1
+    return kept
+
+
+def trim_history(history, budget_tokens, keep_head=2, max_turns=None, estimator=None):
+    """回傳修剪後的新列表：保留開頭 keep_head 則 (角色設定)，其後以 (user, model) 兩則為一輪，
+    從最新一輪往回累加，超出預算就停；最新一輪一定保留。"""
+    estimator = estimator or ESTIMATOR
+    head, turns = history[:keep_head], history[keep_head:]
+    if len(turns) <= 2:
+        return list(history)
+    turn_tokens = [estimator.estimate_contents(turns[index:index + 2]) for index in range(0, len(turns), 2)]
+    kept = turns_within_budget(estimator.estimate_contents(head), turn_tokens, budget_tokens, max_turns)
+    return head + turns[len(turns) - kept * 2:]
@@ -0,0 +1,298 @@
+"""每個 webhook 事件的輕量追蹤 (span)，批次寫入本機輪替的 JSONL 檔。
+
+- 以 contextvars 記錄目前的 span，同步 (Flask / gevent) 與 asyncio 入口都適用。
+- 根 span 建立時依 TRACE_SAMPLE_RATE 抽樣；沒被抽中的事件其下所有 span 都是空操作。
+- span 結束後放進有上限的佇列，由背景執行緒批次寫檔；佇列滿時直接丟棄並計數，不拖慢請求。
+
+查看某個事件的關鍵路徑：
+    python tracing.py <webhook_event_id> [--dir traces]
+"""
+import argparse
+import contextvars
+import functools
+import glob
+import hashlib
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_DIR = os.getenv("TRACE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces"))
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(20 * 1024 * 1024)))
+TRACE_FILE_BACKUP_COUNT = int(os.getenv("TRACE_FILE_BACKUP_COUNT", "5"))
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "10000"))
+TRACE_FLUSH_INTERVAL_SECONDS = float(os.getenv("TRACE_FLUSH_INTERVAL_SECONDS", "1"))
+TRACE_USER_HASH_SALT = os.getenv("TRACE_USER_HASH_SALT", "xiaoyun")
+
+_current_span = contextvars.ContextVar("xiaoyun_current_span", default=None)
+# 說明：事件沒被抽樣時放這個標記，而不是 None，這樣巢狀的 start_trace() (例如 asgi 轉交給同步處理函式) 才不會重新抽樣。
+_NOT_SAMPLED = object()
+
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "event_id", "user", "name", "attrs", "start", "_started")
+
+    def __init__(self, name, trace_id, parent_id, event_id, user, attrs):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.event_id = event_id
+        self.user = user
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_record(self, outcome, error=None):
+        record = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "event_id": self.event_id,
+            "user": self.user,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round((time.perf_counter() - self._started) * 1000, 3),
+            "outcome": outcome,
+        }
+        if error:
+            record["error"] = error
+        if self.attrs:
+            record["attrs"] = self.attrs
+        return record
+
+
+def hash_user_id(user_id):
+    if not user_id:
+        return None
+    return hashlib.sha256(f"{TRACE_USER_HASH_SALT}:{user_id}".encode("utf-8")).hexdigest()[:16]
+
+
+@contextmanager
+def _run_span(span):
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        _exporter.submit(span.to_record("error", f"{type(e).__name__}: {e}"[:300]))
+        raise
+    else:
+        _exporter.submit(span.to_record("ok"))
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def start_trace(name, event_id=None, user_id=None, sample_rate=None, **attrs):
+    """建立事件的根 span；抽樣沒中時 yield None，底下的 span() 全部略過。已在某個事件之內時視同 span()。"""
+    if _current_span.get() is not None:
+        with span(name, **attrs) as child:
+            yield child
+        return
+    rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0 or random.random() >= rate:
+        token = _current_span.set(_NOT_SAMPLED)
+        try:
+            yield None
+        finally:
+            _current_span.reset(token)
+        return
+    root = Span(name, os.urandom(8).hex(), None, event_id, hash_user_id(user_id), attrs)
+    with _run_span(root):
+        yield root
+
+
+@contextmanager
+def span(name, **attrs):
+    parent = _current_span.get()
+    if parent is None or parent is _NOT_SAMPLED:
+        yield None
+        return
+    with _run_span(Span(name, parent.trace_id, parent.span_id, parent.event_id, parent.user, attrs)):
+        yield _current_span.get()
+
+
+def traced(name):
+    """函式裝飾器版的 span()，一般函式與 async 函式都可用。"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def traced_event(name):
+    """給 LINE 事件處理函式用：以 webhook_event_id 與 user id 建立根 span。
+    wrapper 只收 event 一個參數，因為 WebhookHandler 是用 getfullargspec 決定要不要多傳 destination。"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(event):
+            with start_trace(name, getattr(event, "webhook_event_id", None), getattr(getattr(event, "source", None), "user_id", None),
+                             message_type=getattr(getattr(event, "message", None), "type", None)):
+                return func(event)
+        return wrapper
+    return decorator
+
+
+class JsonlSpanExporter:
+    def __init__(self, directory, max_bytes, backup_count, queue_size, flush_interval):
+        self.directory = directory
+        self.path = os.path.join(directory, "spans.jsonl")
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, record):
+        if self._thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < 500 and (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except OSError as e:
+                logger.warning("寫入追蹤檔失敗，丟棄 %s 筆 span: %s", len(batch), e)
+
+    def _write(self, batch):
+        data = "".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in batch)
+        if os.path.exists(self.path) and os.path.getsize(self.path) + len(data) > self.max_bytes:
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def _rotate(self):
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+_exporter = JsonlSpanExporter(TRACE_DIR, TRACE_FILE_MAX_BYTES, TRACE_FILE_BACKUP_COUNT, TRACE_QUEUE_SIZE, TRACE_FLUSH_INTERVAL_SECONDS)
+
+
+# --- 關鍵路徑 CLI ---
+
+def load_spans(directory, event_id):
+    spans = []
+    for path in sorted(glob.glob(os.path.join(directory, "spans.jsonl*"))):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if event_id in line:
+                    record = json.loads(line)
+                    if record.get("event_id") == event_id:
+                        spans.append(record)
+    return spans
+
+
+def critical_path(spans):
+    """由根 span 的結束時間往回走：每一步挑在目前時間點之前最晚結束的子 span。回傳 [(span, 自身佔用毫秒)]。"""
+    children = {}
+    for record in spans:
+        record["end"] = record["start"] + record["duration_ms"] / 1000
+        children.setdefault(record["parent_id"], []).append(record)
+
+    def walk(node, until):
+        path = []
+        cursor = min(node["end"], until)
+        own_ms = 0.0
+        for child in sorted(children.get(node["span_id"], []), key=lambda c: c["end"], reverse=True):
+            if child["end"] > cursor or child["start"] < node["start"]:
+                continue
+            own_ms += (cursor - child["end"]) * 1000
+            path = walk(child, cursor) + path
+            cursor = child["start"]
+        own_ms += max(0.0, cursor - node["start"]) * 1000
+        return [(node, own_ms)] + path
+
+    roots = children.get(None, [])
+    return walk(roots[0], roots[0]["end"]) if roots else []
+
+
+def _print_tree(spans):
+    children = {}
+    for record in spans:
+        children.setdefault(record["parent_id"], []).append(record)
+
+    def show(node, depth):
+        marker = "" if node["outcome"] == "ok" else f"  !! {node.get('error', node['outcome'])}"
+        attrs = f"  {node['attrs']}" if node.get("attrs") else ""
+        print(f"{'  ' * depth}{node['name']:<{40 - 2 * depth}} {node['duration_ms']:>10.1f} ms{attrs}{marker}")
+        for child in sorted(children.get(node["span_id"], []), key=lambda c: c["start"]):
+            show(child, depth + 1)
+
+    for root in children.get(None, []):
+        show(root, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="顯示某個 webhook 事件的 span 樹與關鍵路徑")
+    parser.add_argument("event_id", help="LINE webhookEventId")
+    parser.add_argument("--dir", default=TRACE_DIR, help="追蹤檔目錄")
+    args = parser.parse_args()
+
+    spans = load_spans(args.dir, args.event_id)
+    if not spans:
+        raise SystemExit(f"找不到事件 {args.event_id} 的 span (可能沒被抽樣到)")
+    # 說明：LINE 重送 (isRedelivery) 時同一個 webhookEventId 會有多個 trace，分開列出
+    traces = {}
+    for record in spans:
+        traces.setdefault(record["trace_id"], []).append(record)
+    for trace_id, trace_spans in sorted(traces.items(), key=lambda item: min(record["start"] for record in item[1])):
+        started = datetime.fromtimestamp(min(record["start"] for record in trace_spans)).isoformat(timespec="milliseconds")
+        print(f"=== trace {trace_id}  user {trace_spans[0]['user']}  開始於 {started} ===")
+        _print_tree(trace_spans)
+        path = critical_path(trace_spans)
+        total_ms = path[0][0]["duration_ms"] if path else 0.0
+        print("關鍵路徑 (依自身佔用時間排序)：")
+        for node, own_ms in sorted(path, key=lambda item: item[1], reverse=True):
+            share = own_ms / total_ms * 100 if total_ms else 0.0
+            print(f"  {node['name']:<40} {own_ms:>10.1f} ms  {share:5.1f}%")
+        print()
+
+
+if __name__ == "__main__":
+    main()
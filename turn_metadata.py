@@ -0,0 +1,67 @@
+"""每一輪對話 (用戶訊息 + 小雲回覆) 寫入歷史時順便算好的摘要，之後的「緊扣上文」提示、記憶筆記與 /memory_status 直接讀，不必再 json.loads 小雲的回覆。
+
+- user_text：用戶這輪的文字 part (一般訊息含前面的上下文提醒與時間氛圍，真正說的話在最後)；user_media：image / audio。
+- bot_text：小雲回覆裡所有 text 物件接起來的文字 (回覆不是 JSON 列表時就是原文)；stickers：用到的貼圖關鍵字；
+  bot_media：image (image_theme / image_key) 與 audio (meow_sound)。
+- emotion：小雲在這輪表達的狀態 ("委屈" / "飢餓" / None)，判斷方式沿用原本的「緊扣上文」規則。
+- tokens：這一輪 (兩則訊息) 寫入當下的 token 估算值。
+"""
+import json
+import time
+
+_BOT_MEDIA_TYPES = {"image_theme": "image", "image_key": "image", "meow_sound": "audio"}
+
+
+class TurnRecord:
+    __slots__ = ("message_type", "user_text", "user_media", "bot_text", "stickers", "bot_media", "emotion", "tokens", "created_at")
+
+    def __init__(self, message_type, user_text, user_media, bot_text, stickers, bot_media, emotion, tokens, created_at):
+        self.message_type = message_type
+        self.user_text = user_text
+        self.user_media = user_media
+        self.bot_text = bot_text
+        self.stickers = stickers
+        self.bot_media = bot_media
+        self.emotion = emotion
+        self.tokens = tokens
+        self.created_at = created_at
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _user_summary(user_parts):
+    texts, media = [], []
+    for part in user_parts:
+        if isinstance(part.get("text"), str):
+            texts.append(part["text"])
+        elif "inline_data" in part:
+            media.append("audio" if part["inline_data"].get("mime_type", "").startswith("audio/") else "image")
+    return " ".join(texts), tuple(media)
+
+
+def _bot_summary(bot_response_str):
+    """回傳 (文字, 貼圖關鍵字, 媒體種類, 情緒)。"""
+    try:
+        objects = json.loads(bot_response_str) if bot_response_str.startswith("[") else None
+    except ValueError:
+        objects = None
+    if not isinstance(objects, list):
+        return bot_response_str, (), (), None
+    objects = [obj for obj in objects if isinstance(obj, dict)]
+    text = " ".join(filter(None, (obj.get("content", "") for obj in objects if obj.get("type") == "text"))).strip()
+    stickers = tuple(obj.get("keyword", "") for obj in objects if obj.get("type") == "sticker")
+    media = tuple(_BOT_MEDIA_TYPES[obj["type"]] for obj in objects if obj.get("type") in _BOT_MEDIA_TYPES)
+    emotion = None
+    if "委屈" in text or "哭哭" in stickers:
+        emotion = "委屈"
+    elif "餓" in text or "肚子餓" in stickers:
+        emotion = "飢餓"
+    return text, stickers, media, emotion
+
+
+def build_turn_record(user_parts, bot_response_str, message_type, estimator):
+    user_text, user_media = _user_summary(user_parts)
+    bot_text, stickers, bot_media, emotion = _bot_summary(bot_response_str)
+    tokens = estimator.estimate_contents([{"role": "user", "parts": user_parts}, {"role": "model", "parts": [{"text": bot_response_str}]}])
+    return TurnRecord(message_type, user_text, user_media, bot_text, stickers, bot_media, emotion, tokens, time.time())
@@ -0,0 +1,228 @@
+"""每位用戶的狀態集中在一個 UserState (__slots__)，取代原本分散在幾個 dict 裡的對話歷史、秘密索引與互動情境。
+
+- head：歷史開頭兩則 (角色設定 + 初始回應)。沒有記憶筆記的用戶全部共用同一份 (見 app.PERSONA_HEAD)，有筆記時才換成自己的。
+- 記憶筆記：文字只存在 head 的筆記 part 裡 (memory_note 從那裡取回)，note_meta 是 (更新時間, 已摺進的輪數)；
+  pending_memory 是被修剪掉、還沒摺進筆記的 TurnRecord。都跟著 UserState 一起進冷層 / 資料庫。
+- 對話輪存在固定容量的環狀緩衝區，每輪是 (用戶訊息, 小雲回覆字串, TurnRecord)；用戶訊息只有一段文字時直接存字串。
+  加一輪不必複製整個列表，滿了直接覆蓋最舊的一輪；history() 需要時才組出 Gemini 的 contents 列表。
+- 已分享過的預設秘密是整數位元遮罩 (第 i 位代表第 i 則)；互動情境只留文字與貼圖兩個欄位 (沒有情境時為 None)。
+- version 每寫入一輪就加一，用來判斷歷史在某段期間內有沒有變動 (例如預先生成的情境後續)。
+- epoch 是這份狀態的代號：建立時隨機產生、跟著序列化，從冷層或資料庫重新載入都不會變；
+  /clear_memory 之後的新 UserState 才會換一個。背景工作用它判斷用戶在期間內有沒有被清掉，而不是比物件是不是同一個。
+- journal：SQLite 後端 (state_store.SqliteStateStore) 會設成一個列表，之後每個會改動狀態的方法都記一筆 (方法名, 參數)；
+  寫入 DB 時跟別的 worker 撞到，就在對方的版本上 replay() 還沒寫出去的那幾筆再寫一次。行程內的後端保持 None，不記錄。
+"""
+import random
+import time
+
+import turn_metadata
+
+MEMORY_NOTE_PREFIX = "（小雲記得關於這位主人的事："
+MEMORY_NOTE_SUFFIX = "）"
+
+
+def memory_note_part(note):
+    return {"text": f"{MEMORY_NOTE_PREFIX}{note}{MEMORY_NOTE_SUFFIX}"}
+
+
+# 說明：只跟記憶筆記有關的操作；要重做到已經被 /clear_memory 清掉的狀態 (epoch 不同) 上時略過，不把清掉的記憶寫回去
+NOTE_OPS = frozenset({"set_memory_note", "add_pending_memory", "_remove_pending"})
+
+
+def _record_from_dict(record):
+    record["user_media"], record["stickers"], record["bot_media"] = \
+        tuple(record["user_media"]), tuple(record["stickers"]), tuple(record["bot_media"])
+    return turn_metadata.TurnRecord(**record)
+
+
+class UserState:
+    __slots__ = ("head", "epoch", "version", "secrets_mask", "scenario_text", "scenario_sticker", "note_meta", "pending_memory",
+                 "journal", "_slots", "_start", "_count")
+
+    def __init__(self, head):
+        self.head = head
+        self.epoch = random.getrandbits(32)
+        self.note_meta = None
+        self.pending_memory = None
+        self.version = 0
+        self.secrets_mask = 0
+        self.scenario_text = None
+        self.scenario_sticker = None
+        self.journal = None
+        # 說明：第一次寫入對話時才配置緩衝區，只傳過一次訊息 (或只查過秘密) 的用戶不必多付這份記憶體
+        self._slots = None
+        self._start = 0
+        self._count = 0
+
+    @property
+    def turn_count(self):
+        return self._count
+
+    def _log(self, name, *args):
+        if self.journal is not None:
+            self.journal.append((name, args))
+
+    def replay(self, journal):
+        """依序重做另一份狀態記下的改動 (見 journal)。"""
+        for name, args in journal:
+            getattr(self, name)(*args)
+
+    def push_turn(self, user_parts, bot_response, record, capacity):
+        """加一輪；緩衝區已滿時覆蓋最舊的一輪並回傳它 (user_parts, bot_response, record)，否則回傳 None。"""
+        self._log("push_turn", user_parts, bot_response, record, capacity)
+        if self._slots is None:
+            self._slots = [None] * capacity
+        if len(user_parts) == 1 and len(user_parts[0]) == 1 and isinstance(user_parts[0].get("text"), str):
+            user_parts = user_parts[0]["text"]
+        turn = (user_parts, bot_response, record)
+        slots = self._slots
+        evicted = None
+        if self._count == len(slots):
+            evicted = slots[self._start]
+            slots[self._start] = turn
+            self._start = (self._start + 1) % len(slots)
+        else:
+            slots[(self._start + self._count) % len(slots)] = turn
+            self._count += 1
+        self.version += 1
+        return self._expand(evicted) if evicted else None
+
+    def drop_oldest(self, count):
+        """丟掉最舊的 count 輪，回傳被丟掉的輪 (由舊到新)。"""
+        if count > 0 and self._count:
+            self._log("drop_oldest", count)
+        dropped = []
+        for _ in range(min(count, self._count)):
+            dropped.append(self._expand(self._slots[self._start]))
+            self._slots[self._start] = None
+            self._start = (self._start + 1) % len(self._slots)
+            self._count -= 1
+        return dropped
+
+    @staticmethod
+    def _expand(turn):
+        user_parts, bot_response, record = turn
+        return ([{"text": user_parts}] if isinstance(user_parts, str) else user_parts), bot_response, record
+
+    def turns(self):
+        """由舊到新的 (user_parts, bot_response, record)。"""
+        if not self._count:
+            return []
+        slots, start, size = self._slots, self._start, len(self._slots)
+        return [self._expand(slots[(start + index) % size]) for index in range(self._count)]
+
+    def records(self):
+        if not self._count:
+            return []
+        slots, start, size = self._slots, self._start, len(self._slots)
+        return [slots[(start + index) % size][2] for index in range(self._count)]
+
+    def last_record(self):
+        if not self._count:
+            return None
+        return self._slots[(self._start + self._count - 1) % len(self._slots)][2]
+
+    def history(self):
+        """組出 Gemini 的 contents：開頭兩則 + 每輪的 user / model 兩則 (每次呼叫都是新的列表)。"""
+        contents = list(self.head)
+        for user_parts, bot_response, _ in self.turns():
+            contents.append({"role": "user", "parts": user_parts})
+            contents.append({"role": "model", "parts": [{"text": bot_response}]})
+        return contents
+
+    def to_dict(self, shared_head):
+        """轉成可以 JSON 序列化的 dict；head 只存共用開頭之外的額外 part (例如記憶筆記)。"""
+        return {
+            "head_extra_parts": None if self.head is shared_head else self.head[0]["parts"][1:],
+            "turns": [[user_parts, bot_response, record.as_dict()] for user_parts, bot_response, record in self.turns()],
+            "epoch": self.epoch,
+            "version": self.version,
+            "secrets_mask": self.secrets_mask,
+            "scenario": [self.scenario_text, self.scenario_sticker],
+            "note_meta": self.note_meta,
+            "pending_memory": [record.as_dict() for record in self.pending_memory or ()],
+        }
+
+    @classmethod
+    def from_dict(cls, data, shared_head, capacity):
+        extra_parts = data["head_extra_parts"]
+        state = cls(shared_head if extra_parts is None else
+                    ({"role": "user", "parts": [shared_head[0]["parts"][0]] + extra_parts}, shared_head[1]))
+        for user_parts, bot_response, record in data["turns"]:
+            state.push_turn(user_parts, bot_response, _record_from_dict(record), capacity)
+        state.epoch = data.get("epoch", 0)
+        state.version = data["version"]
+        state.secrets_mask = data["secrets_mask"]
+        state.scenario_text, state.scenario_sticker = data["scenario"]
+        if note_meta := data.get("note_meta"):
+            state.note_meta = tuple(note_meta)
+        if pending := data.get("pending_memory"):
+            state.pending_memory = [_record_from_dict(record) for record in pending]
+        return state
+
+    @property
+    def memory_note(self):
+        """目前的記憶筆記文字；沒有時回傳 None。"""
+        if self.note_meta is None:
+            return None
+        return self.head[0]["parts"][1]["text"][len(MEMORY_NOTE_PREFIX):-len(MEMORY_NOTE_SUFFIX)]
+
+    def set_memory_note(self, note, summarized_turns, shared_head):
+        """換上新的筆記：這位用戶改用自己的開頭 (角色設定 + 筆記 part)，初始回應仍共用 shared_head 的那一則。"""
+        self._log("set_memory_note", note, summarized_turns, shared_head)
+        self.head = ({"role": "user", "parts": [shared_head[0]["parts"][0], memory_note_part(note)]}, shared_head[1])
+        self.note_meta = (time.time(), summarized_turns)
+
+    def add_pending_memory(self, records, max_pending):
+        """累積被修剪掉的對話輪，最多留 max_pending 輪 (丟最舊的)；回傳 (目前累積的輪數, 丟掉的輪數)。"""
+        records = list(records)
+        self._log("add_pending_memory", records, max_pending)
+        pending = (self.pending_memory or []) + records
+        discarded = max(0, len(pending) - max_pending)
+        self.pending_memory = pending[discarded:] or None
+        return len(self.pending_memory or ()), discarded
+
+    def take_pending_memory(self):
+        pending, self.pending_memory = self.pending_memory or [], None
+        if pending:
+            self._log("_remove_pending", pending)
+        return pending
+
+    def _remove_pending(self, records):
+        """replay 用：只拿掉當初取走的那幾輪 (對方的版本可能多累積了別的輪)。"""
+        taken = [record.as_dict() for record in records]
+        kept = []
+        for record in self.pending_memory or ():
+            if (data := record.as_dict()) in taken:
+                taken.remove(data)
+            else:
+                kept.append(record)
+        self.pending_memory = kept or None
+
+    def shared_secret_count(self):
+        return self.secrets_mask.bit_count()
+
+    def unshared_secret_indices(self, total):
+        mask = self.secrets_mask
+        return [index for index in range(total) if not mask >> index & 1]
+
+    def mark_secret_shared(self, index):
+        self._log("mark_secret_shared", index)
+        self.secrets_mask |= 1 << index
+
+    def reset_secrets(self):
+        self._log("reset_secrets")
+        self.secrets_mask = 0
+
+    def set_scenario(self, text, sticker):
+        self._log("set_scenario", text, sticker)
+        self.scenario_text, self.scenario_sticker = text, sticker
+
+    def take_scenario(self):
+        """取出並清掉目前的互動情境；沒有時回傳 None。"""
+        if self.scenario_text is None:
+            return None
+        self._log("take_scenario")
+        scenario = {"last_scenario_text": self.scenario_text, "last_scenario_sticker": self.scenario_sticker}
+        self.scenario_text = self.scenario_sticker = None
+        return scenario